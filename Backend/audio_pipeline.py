@@ -0,0 +1,182 @@
+"""
+audio_pipeline.py
+Streaming transcode of uploaded speech before it is sent to Gemini
+Request body chunks are piped into ffmpeg as they arrive; no temp files
+"""
+
+import asyncio
+import logging
+import os
+import shutil
+import time
+from dataclasses import dataclass, asdict
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from image_pipeline import UploadTooLargeError
+
+logger = logging.getLogger(__name__)
+
+FFMPEG_PATH = os.getenv("FFMPEG_PATH", "ffmpeg")
+AUDIO_MAX_UPLOAD_BYTES = int(os.getenv("AUDIO_MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+AUDIO_FORMAT = os.getenv("AUDIO_FORMAT", "opus").lower()
+AUDIO_BITRATE = os.getenv("AUDIO_BITRATE", "24k")
+AUDIO_MAX_SECONDS = int(os.getenv("AUDIO_MAX_SECONDS", "120"))
+
+# Speech only needs 16 kHz mono; Opus at 24 kbit/s is roughly 3 KB per second
+_OUTPUTS = {
+    "opus": (["-c:a", "libopus", "-b:a", AUDIO_BITRATE, "-application", "voip", "-f", "ogg"], "audio/ogg"),
+    "flac": (["-c:a", "flac", "-f", "flac"], "audio/flac"),
+}
+
+# What Gemini accepts inline, for passing audio through when ffmpeg is missing
+GEMINI_AUDIO_TYPES = {
+    "audio/wav", "audio/x-wav", "audio/mp3", "audio/mpeg", "audio/aiff",
+    "audio/aac", "audio/ogg", "audio/flac",
+}
+
+
+class TranscodeError(Exception):
+    """ffmpeg rejected the input or is not available for a type Gemini cannot take"""
+
+
+@dataclass
+class TranscodedAudio:
+    data: bytes
+    mime_type: str
+    bytes_in: int
+    bytes_out: int
+    upload_ms: float
+    elapsed_ms: float
+    passthrough: bool
+
+    def as_blob(self) -> Dict[str, Any]:
+        """Inline part accepted by generate_content"""
+        return {"mime_type": self.mime_type, "data": self.data}
+
+    def stats(self) -> Dict[str, Any]:
+        stats = asdict(self)
+        stats.pop("data")
+        return stats
+
+
+def ffmpeg_available() -> bool:
+    return shutil.which(FFMPEG_PATH) is not None
+
+
+class StreamingTranscoder:
+    """
+    One ffmpeg process reading stdin and writing stdout concurrently
+    stdout/stderr are drained by tasks from the start, so a full pipe never stalls the feed
+    """
+
+    def __init__(self, output_format: str = AUDIO_FORMAT, max_seconds: int = AUDIO_MAX_SECONDS):
+        if output_format not in _OUTPUTS:
+            output_format = "opus"
+        self.codec_args, self.mime_type = _OUTPUTS[output_format]
+        self.max_seconds = max_seconds
+        self.proc: Optional[asyncio.subprocess.Process] = None
+        self._stdout: Optional[asyncio.Task] = None
+        self._stderr: Optional[asyncio.Task] = None
+        self._broken = False
+
+    async def start(self):
+        self.proc = await asyncio.create_subprocess_exec(
+            FFMPEG_PATH, "-hide_banner", "-loglevel", "error", "-nostdin",
+            "-i", "pipe:0",
+            "-vn", "-ac", "1", "-ar", "16000", "-t", str(self.max_seconds),
+            *self.codec_args, "pipe:1",
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        self._stdout = asyncio.create_task(self.proc.stdout.read())
+        self._stderr = asyncio.create_task(self.proc.stderr.read())
+
+    async def feed(self, chunk: bytes):
+        if self._broken:
+            return
+        try:
+            self.proc.stdin.write(chunk)
+            await self.proc.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg gave up on the input; finish() reports why
+            self._broken = True
+
+    async def finish(self) -> bytes:
+        if not self._broken:
+            try:
+                self.proc.stdin.close()
+                await self.proc.stdin.wait_closed()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+        data = await self._stdout
+        error = (await self._stderr).decode("utf-8", "replace").strip()
+        if await self.proc.wait() != 0 or not data:
+            raise TranscodeError(error.splitlines()[-1] if error else "ffmpeg produced no audio")
+        return data
+
+    async def abort(self):
+        if self.proc is not None and self.proc.returncode is None:
+            self.proc.kill()
+            await self.proc.wait()
+        for task in (self._stdout, self._stderr):
+            if task is not None:
+                task.cancel()
+
+
+async def transcode_stream(
+    chunks: AsyncIterator[bytes],
+    content_type: Optional[str] = None,
+    max_bytes: int = AUDIO_MAX_UPLOAD_BYTES
+) -> TranscodedAudio:
+    """
+    Feed an upload into ffmpeg while it is still arriving
+    Without ffmpeg, audio Gemini can read is passed through unchanged
+    """
+    started = time.perf_counter()
+    bytes_in = 0
+    content_type = (content_type or "").split(";")[0].strip().lower()
+
+    transcoder: Optional[StreamingTranscoder] = StreamingTranscoder()
+    try:
+        await transcoder.start()
+    except FileNotFoundError:
+        logger.warning("ffmpeg not found, passing audio through untranscoded")
+        transcoder = None
+
+    buffered: List[bytes] = []
+    try:
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            bytes_in += len(chunk)
+            if bytes_in > max_bytes:
+                raise UploadTooLargeError(max_bytes)
+            if transcoder is not None:
+                await transcoder.feed(chunk)
+            else:
+                buffered.append(chunk)
+        uploaded = time.perf_counter()
+
+        if transcoder is not None:
+            data = await transcoder.finish()
+            mime_type = transcoder.mime_type
+        elif content_type in GEMINI_AUDIO_TYPES:
+            data = b"".join(buffered)
+            mime_type = content_type
+        else:
+            raise TranscodeError(f"ffmpeg unavailable and {content_type or 'unknown type'} is not accepted upstream")
+    except BaseException:
+        if transcoder is not None:
+            await transcoder.abort()
+        raise
+
+    return TranscodedAudio(
+        data=data,
+        mime_type=mime_type,
+        bytes_in=bytes_in,
+        bytes_out=len(data),
+        upload_ms=round((uploaded - started) * 1000, 2),
+        elapsed_ms=round((time.perf_counter() - started) * 1000, 2),
+        passthrough=transcoder is None,
+    )
@@ -0,0 +1,83 @@
+"""
+benchmarks/bench_parse.py
+Compare the legacy fence-scan parser with crop_analysis.parse_crop_analysis
+Reports microseconds per parse and how often each falls back to the text placeholder
+
+Run from Backend/:  python benchmarks/bench_parse.py [iterations]
+"""
+
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from crop_analysis import parse_crop_analysis  # noqa: E402
+
+_ANALYSIS = {
+    "crop_type": "Wheat",
+    "disease_name": "Yellow Rust",
+    "disease_name_hindi": "पीला रतुआ",
+    "disease_name_scientific": "Puccinia striiformis",
+    "severity": "Severe",
+    "symptoms_observed": ["Yellow stripes of pustules on leaves", "Powdery spores on touch"],
+    "treatment_steps": ["Spray propiconazole 25% EC at 0.1%", "Repeat after 15 days if needed"],
+    "organic_solutions": ["Remove infected leaves", "Spray 5% neem seed kernel extract"],
+    "chemical_solutions": ["Propiconazole 25% EC (wear gloves and mask)"],
+    "prevention_tips": ["Sow resistant varieties such as HD 3086", "Avoid late sowing"],
+    "estimated_recovery_time": "2-3 weeks",
+    "cost_estimate_inr": "800-1200 per acre",
+    "urgent_action_required": True,
+}
+_BARE = json.dumps(_ANALYSIS, ensure_ascii=False)
+
+SAMPLES = {
+    "bare_json": _BARE,
+    "fenced_json": f"Here is the analysis:\n```json\n{_BARE}\n```\nConsult your KVK.",
+    "truncated": _BARE[: int(len(_BARE) * 0.7)],
+    "malformed": _BARE.replace('"Avoid late sowing"]', '"Avoid late sowing",]'),
+}
+
+
+def legacy_parse(text: str):
+    """Parser used before structured output; None means the text placeholder"""
+    try:
+        if "```json" in text:
+            json_start = text.find("```json") + 7
+            json_end = text.find("```", json_start)
+            return json.loads(text[json_start:json_end].strip())
+        return json.loads(text)
+    except json.JSONDecodeError:
+        return None
+
+
+def typed_parse(text: str):
+    analysis, _ = parse_crop_analysis(text)
+    return analysis
+
+
+def bench(parser, text: str, iterations: int):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        result = parser(text)
+    elapsed = time.perf_counter() - started
+    return elapsed / iterations * 1e6, result is None
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    report = {}
+    for name, parser in (("legacy", legacy_parse), ("typed", typed_parse)):
+        rows = {}
+        fallbacks = 0
+        for sample, text in SAMPLES.items():
+            us, fell_back = bench(parser, text, iterations)
+            fallbacks += fell_back
+            rows[sample] = {"us_per_parse": round(us, 2), "fallback": fell_back}
+        report[name] = {"samples": rows, "fallback_rate": fallbacks / len(SAMPLES)}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
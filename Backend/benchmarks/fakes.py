@@ -0,0 +1,372 @@
+"""
+benchmarks/fakes.py
+Deterministic local stand-ins for Gemini and Firestore
+Lets the load tests drive main.py and the services without any Google credentials
+"""
+
+import asyncio
+import itertools
+import json
+import operator
+import random
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from firebase_admin import firestore
+
+import firebase_service
+import gemini_service
+
+FAKE_ANALYSIS = {
+    "crop_type": "Tomato",
+    "disease_name": "Early Blight",
+    "disease_name_hindi": "अगेती झुलसा",
+    "disease_name_scientific": "Alternaria solani",
+    "severity": "Moderate",
+    "symptoms_observed": ["Concentric brown rings on older leaves"],
+    "treatment_steps": ["Remove infected leaves", "Spray mancozeb 75% WP at 2 g per litre"],
+    "organic_solutions": ["Spray 5% neem seed kernel extract"],
+    "chemical_solutions": ["Mancozeb 75% WP (wear gloves and mask)"],
+    "prevention_tips": ["Rotate crops", "Avoid overhead irrigation"],
+    "estimated_recovery_time": "2 weeks",
+    "cost_estimate_inr": "500-700 per acre",
+    "urgent_action_required": False,
+}
+
+FAKE_VOICE = {
+    "transcript": "मेरे टमाटर के पत्तों पर भूरे धब्बे हैं, क्या करूं",
+    "language": "hi",
+    "transcript_confidence": 0.92,
+    "answer": "प्रभावित पत्तियां हटा दें और शाम को नीम तेल का छिड़काव करें।",
+}
+
+FAKE_ANSWER = (
+    "Your crop shows early signs of fungal infection. Remove the affected leaves and burn them. "
+    "Spray neem oil in the evening and repeat after a week. "
+    "अगर समस्या बढ़े तो नज़दीकी कृषि विज्ञान केंद्र से संपर्क करें।"
+)
+
+
+@dataclass
+class FakeGeminiSettings:
+    """Latency and failure profile shared by every fake model"""
+    latency_ms: float = 200.0
+    jitter_ms: float = 50.0
+    error_rate: float = 0.0
+    stream_chunks: int = 4
+    seed: int = 7
+
+    def __post_init__(self):
+        self._random = random.Random(self.seed)
+        self.calls = 0
+        self.errors = 0
+
+    def next_delay(self) -> float:
+        jitter = self._random.uniform(-self.jitter_ms, self.jitter_ms)
+        return max(self.latency_ms + jitter, 0.0) / 1000
+
+    def should_fail(self) -> bool:
+        return self._random.random() < self.error_rate
+
+
+class _Usage:
+    def __init__(self, prompt_tokens: int, output_tokens: int):
+        self.prompt_token_count = prompt_tokens
+        self.candidates_token_count = output_tokens
+        self.total_token_count = prompt_tokens + output_tokens
+        self.cached_content_token_count = 0
+
+
+class FakeResponse:
+    def __init__(self, text: str, prompt_tokens: int = 0):
+        self.text = text
+        self.usage_metadata = _Usage(prompt_tokens, len(text) // 4)
+
+
+class FakeGenerativeModel:
+    """Accepts the same constructor and generate_content_async arguments as genai.GenerativeModel"""
+
+    settings = FakeGeminiSettings()
+
+    def __init__(self, model_name: str = "gemini-1.5-flash", generation_config=None, **kwargs):
+        self.model_name = model_name
+        self._generation_config = dict(generation_config or {})
+        # Billed as input on every call, like the real API
+        self._system_tokens = _estimate_tokens(kwargs["system_instruction"]) if kwargs.get("system_instruction") else 0
+
+    async def generate_content_async(self, contents, generation_config=None, stream: bool = False, **kwargs):
+        settings = self.settings
+        settings.calls += 1
+        config = {**self._generation_config, **(generation_config or {})}
+        text = self._answer_for(config)
+        prompt_tokens = _estimate_tokens(contents) + self._system_tokens
+
+        if settings.should_fail():
+            await asyncio.sleep(settings.next_delay() / 4)
+            settings.errors += 1
+            raise google_exceptions.ResourceExhausted("429 Quota exceeded (fake)")
+
+        if not stream:
+            await asyncio.sleep(settings.next_delay())
+            return FakeResponse(text, prompt_tokens)
+        return self._stream(text, prompt_tokens)
+
+    async def _stream(self, text: str, prompt_tokens: int):
+        settings = self.settings
+        delay = settings.next_delay()
+        chunks = max(settings.stream_chunks, 1)
+        size = -(-len(text) // chunks)
+        # First chunk pays most of the latency, like a real time-to-first-token
+        await asyncio.sleep(delay * 0.6)
+        for start in range(0, len(text), size):
+            yield FakeResponse(text[start:start + size], prompt_tokens)
+            await asyncio.sleep(delay * 0.4 / chunks)
+
+    def count_tokens(self, contents):
+        return type("CountTokensResponse", (), {"total_tokens": _estimate_tokens(contents) + self._system_tokens})()
+
+    async def count_tokens_async(self, contents):
+        return self.count_tokens(contents)
+
+    @staticmethod
+    def _answer_for(config: Dict[str, Any]) -> str:
+        if config.get("response_mime_type") == "application/json":
+            schema = config.get("response_schema") or {}
+            if "transcript" in schema.get("properties", {}):
+                return json.dumps(FAKE_VOICE, ensure_ascii=False)
+            return json.dumps(FAKE_ANALYSIS, ensure_ascii=False)
+        return FAKE_ANSWER
+
+
+class _FakeModelInfo:
+    def __init__(self, name: str):
+        self.name = name
+        self.supported_generation_methods = ["generateContent", "countTokens"]
+
+
+def _estimate_tokens(contents) -> int:
+    """About four characters per token for text and 258 tokens per image, as Gemini bills"""
+    if isinstance(contents, (str, dict)):
+        contents = [contents]
+    tokens = 0
+    for part in contents or []:
+        if isinstance(part, str):
+            tokens += len(part) // 4
+        elif isinstance(part, dict) and "data" in part:
+            tokens += 258
+    return tokens
+
+
+class _Snapshot:
+    def __init__(self, doc_id: str, data: Optional[Dict[str, Any]]):
+        self.id = doc_id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return dict(self._data) if self._data is not None else None
+
+
+class _DocumentRef:
+    _ids = itertools.count(1)
+
+    def __init__(self, db: "FakeFirestore", collection: str, doc_id: Optional[str]):
+        self._db = db
+        self._collection = collection
+        self.id = doc_id or f"fake{next(self._ids):012d}"
+
+    def set(self, data: Dict[str, Any], merge: bool = False):
+        self._db._set(self._collection, self.id, data, merge)
+
+    def get(self) -> _Snapshot:
+        return _Snapshot(self.id, self._db._docs(self._collection).get(self.id))
+
+
+_OPERATORS = {
+    "==": operator.eq,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+def _select(data: Dict[str, Any], fields: List[str]) -> Dict[str, Any]:
+    """Projection with dotted paths into maps, like Firestore's select"""
+    result: Dict[str, Any] = {}
+    for path in fields:
+        source, target = data, result
+        *parents, leaf = path.split(".")
+        for key in parents:
+            source = source.get(key) if isinstance(source, dict) else None
+            target = target.setdefault(key, {})
+        if isinstance(source, dict) and leaf in source:
+            target[leaf] = source[leaf]
+    return result
+
+
+def _order_value(row: tuple, field: str) -> Any:
+    return row[0] if field == "__name__" else row[1].get(field)
+
+
+def _after(row: tuple, marker: Dict[str, Any], orders: List[tuple]) -> bool:
+    """Whether `row` sorts after the cursor values in `marker`; fields it leaves out end the comparison"""
+    for field, descending in orders:
+        if field not in marker:
+            return False
+        value = _order_value(row, field)
+        if value != marker[field]:
+            return value < marker[field] if descending else value > marker[field]
+    return False
+
+
+class _Query:
+    def __init__(self, db: "FakeFirestore", collection: str):
+        self._db = db
+        self._collection = collection
+        self._filters: List[tuple] = []
+        self._order: List[tuple] = []
+        self._fields: Optional[List[str]] = None
+        self._limit: Optional[int] = None
+        self._start_after: Optional[Dict[str, Any]] = None
+
+    def _copy(self, **changes) -> "_Query":
+        query = _Query(self._db, self._collection)
+        query.__dict__.update({**self.__dict__, **changes})
+        return query
+
+    def where(self, field: str, op: str, value: Any) -> "_Query":
+        if op not in _OPERATORS:
+            raise NotImplementedError(f"FakeFirestore does not support {op!r} filters")
+        return self._copy(_filters=self._filters + [(field, op, value)])
+
+    def order_by(self, field: str, direction: str = "ASCENDING") -> "_Query":
+        return self._copy(_order=self._order + [(field, direction == firestore.Query.DESCENDING)])
+
+    def select(self, fields: List[str]) -> "_Query":
+        return self._copy(_fields=list(fields))
+
+    def limit(self, count: int) -> "_Query":
+        return self._copy(_limit=count)
+
+    def start_after(self, values) -> "_Query":
+        # A dict of field values, or a snapshot from an earlier page
+        return self._copy(_start_after=values)
+
+    def stream(self):
+        self._db.reads += 1
+        with self._db._lock:
+            rows = [
+                (doc_id, data) for doc_id, data in self._db._docs(self._collection).items()
+                if all(
+                    data.get(field) is not None and _OPERATORS[op](data.get(field), value)
+                    for field, op, value in self._filters
+                )
+            ]
+        if self._order:
+            # Firestore breaks remaining ties on the document id, in the last order's direction
+            orders = self._order + [("__name__", self._order[-1][1])]
+            for field, descending in reversed(orders):
+                rows.sort(key=lambda row: _order_value(row, field), reverse=descending)
+            if isinstance(self._start_after, _Snapshot):
+                ids = [doc_id for doc_id, _ in rows]
+                rows = rows[ids.index(self._start_after.id) + 1:] if self._start_after.id in ids else rows
+            elif self._start_after:
+                rows = [row for row in rows if _after(row, self._start_after, orders)]
+        if self._limit is not None:
+            rows = rows[:self._limit]
+        for doc_id, data in rows:
+            if self._fields is not None:
+                data = _select(data, self._fields)
+            yield _Snapshot(doc_id, data)
+
+
+class _CollectionRef(_Query):
+    def document(self, doc_id: Optional[str] = None) -> _DocumentRef:
+        return _DocumentRef(self._db, self._collection, doc_id)
+
+
+class _WriteBatch:
+    def __init__(self, db: "FakeFirestore"):
+        self._db = db
+        self._writes = []
+
+    def set(self, ref: _DocumentRef, data: Dict[str, Any], merge: bool = False):
+        self._writes.append((ref, data, merge))
+
+    def commit(self):
+        time_per_batch = self._db.commit_latency_ms / 1000
+        if time_per_batch:
+            # Runs in a worker thread (asyncio.to_thread), like the real client
+            threading.Event().wait(time_per_batch)
+        for ref, data, merge in self._writes:
+            ref.set(data, merge)
+        self._db.batches += 1
+
+
+class FakeFirestore:
+    """
+    In-memory Firestore client covering what FirebaseService uses
+    collection/document/set, batched writes and where (equality and range)/order_by/select/
+    limit/start_after queries, start_after taking field values or a snapshot
+    """
+
+    def __init__(self, commit_latency_ms: float = 0.0):
+        self.commit_latency_ms = commit_latency_ms
+        self._collections: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+        self.writes = 0
+        self.batches = 0
+        self.reads = 0
+
+    def collection(self, name: str) -> _CollectionRef:
+        return _CollectionRef(self, name)
+
+    def batch(self) -> _WriteBatch:
+        return _WriteBatch(self)
+
+    def _docs(self, collection: str) -> Dict[str, Dict[str, Any]]:
+        return self._collections.setdefault(collection, {})
+
+    def _set(self, collection: str, doc_id: str, data: Dict[str, Any], merge: bool):
+        now = datetime.now(timezone.utc)
+        data = {k: (now if v is firestore.SERVER_TIMESTAMP else v) for k, v in data.items()}
+        with self._lock:
+            docs = self._docs(collection)
+            docs[doc_id] = {**docs.get(doc_id, {}), **data} if merge else data
+            self.writes += 1
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "documents": sum(len(docs) for docs in self._collections.values()),
+            "writes": self.writes,
+            "batches": self.batches,
+            "reads": self.reads,
+        }
+
+
+def install_fakes(settings: Optional[FakeGeminiSettings] = None, db: Optional[FakeFirestore] = None):
+    """
+    Route genai and FirebaseService to the fakes for this process
+    Call before GeminiService / FirebaseService (or main.app's lifespan) are created
+    """
+    settings = settings or FakeGeminiSettings()
+    db = db or FakeFirestore()
+    FakeGenerativeModel.settings = settings
+
+    genai.configure = lambda *args, **kwargs: None
+    genai.GenerativeModel = FakeGenerativeModel
+    genai.list_models = lambda: [_FakeModelInfo("models/gemini-1.5-flash"), _FakeModelInfo("models/gemini-flash-latest")]
+
+    def _initialize_firebase(service):
+        service.db = db
+        service.bucket = None
+
+    firebase_service.FirebaseService._initialize_firebase = _initialize_firebase
+    # No channels to the real API from an offline run
+    gemini_service.GeminiService._initialize_transport = lambda service: None
+    return settings, db
@@ -0,0 +1,428 @@
+"""
+benchmarks/load_test.py
+Offline load test of /analyze and the service layer against local fakes
+Reports throughput, p50/p95/p99 latency, event-loop lag and peak RSS as JSON,
+and optionally fails when a result regresses against a stored baseline
+HTTP scenarios also report bytes on the wire per request, and the latency a
+client on a slow mobile link would see (--link-kbps, --link-rtt-ms)
+
+Run from Backend/:
+    python benchmarks/load_test.py --output bench.json --baseline benchmarks/baseline.json
+Refresh the baseline with --output benchmarks/baseline.json on the reference machine
+"""
+
+import argparse
+import asyncio
+import contextlib
+import contextvars
+import io
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Settings read at import time by the services; the benchmark measures the
+# uncached path and keeps spill files out of the working tree
+os.environ.setdefault("RESPONSE_CACHE_BACKEND", "off")
+os.environ.setdefault("GOOGLE_API_KEY", "offline-benchmark")
+# Quotas off: the fake has none, and throttling would hide the code under test
+os.environ.setdefault("GEMINI_RPM", "0")
+os.environ.setdefault("GEMINI_RPD", "0")
+os.environ.setdefault("FIRESTORE_SPILL_PATH", os.path.join(tempfile.gettempdir(), "bench_spill.jsonl"))
+_STATE_DIR = tempfile.mkdtemp(prefix="bench_state_")
+os.environ.setdefault("IMAGE_INDEX_PATH", os.path.join(_STATE_DIR, "image_index"))
+os.environ.setdefault("JOB_QUEUE_PATH", os.path.join(_STATE_DIR, "jobs.sqlite3"))
+os.environ.setdefault("ANALYTICS_PATH", os.path.join(_STATE_DIR, "analytics.sqlite3"))
+
+from fakes import FakeFirestore, FakeGeminiSettings, install_fakes  # noqa: E402
+
+import httpx  # noqa: E402
+from PIL import Image  # noqa: E402
+
+SCENARIOS = [
+    "analyze_text", "analyze_faq", "analyze_image", "analyze_mixed",
+    "service_crop_analysis", "service_query", "firestore_write", "firestore_history",
+    "job_poll_full", "job_poll_compact", "job_poll_revalidate",
+]
+
+FAQ_QUESTIONS = [
+    "how to make neem oil spray",
+    "neem oil spray dose per litre",
+    "नीम तेल का छिड़काव कैसे करें",
+]
+
+
+# (request bytes, response bytes) of each HTTP exchange made by the current call
+_WIRE: contextvars.ContextVar[List[tuple]] = contextvars.ContextVar("wire")
+
+
+def _header_bytes(headers: httpx.Headers) -> int:
+    # Roughly as HTTP/1.1 sends them: "name: value\r\n"
+    return sum(len(name) + len(value) + 4 for name, value in headers.raw)
+
+
+async def send(client: httpx.AsyncClient, method: str, url: str, **kwargs) -> httpx.Response:
+    """client.request that also records the bytes each direction took, compressed as sent"""
+    request = client.build_request(method, url, **kwargs)
+    response = await client.send(request)
+    request_bytes = _header_bytes(request.headers) + int(request.headers.get("content-length", 0))
+    response_bytes = _header_bytes(response.headers) + response.num_bytes_downloaded
+    wire = _WIRE.get(None)
+    if wire is not None:
+        wire.append((request_bytes, response_bytes))
+    return response
+
+
+def make_photo(index: int, width: int = 2000, height: int = 1500) -> bytes:
+    """Phone-sized JPEG; gradients keep it realistic to encode, index keeps digests distinct"""
+    gradient = Image.linear_gradient("L")
+    image = Image.merge("RGB", (
+        gradient,
+        gradient.rotate(90),
+        Image.radial_gradient("L").point(lambda v: (v + index * 37) % 256),
+    )).resize((width, height))
+    out = io.BytesIO()
+    image.save(out, format="JPEG", quality=92)
+    return out.getvalue()
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(pct / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+class LoopLagMonitor:
+    """Samples how late a periodic sleep wakes up; blocking code on the loop shows up as lag"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(loop.time() - expected, 0.0) * 1000)
+
+    def start(self):
+        self.samples = []
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> Dict[str, float]:
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        lags = sorted(self.samples)
+        return {
+            "loop_lag_p99_ms": round(percentile(lags, 99), 2),
+            "loop_lag_max_ms": round(lags[-1], 2) if lags else 0.0,
+        }
+
+
+async def run_scenario(
+    call: Callable[[int], Awaitable[bool]],
+    total: int,
+    concurrency: int,
+    link_kbps: float = 128.0,
+    link_rtt_ms: float = 400.0
+) -> Dict[str, Any]:
+    """`concurrency` workers issue `total` calls; a call returns False (or raises) on error"""
+    latencies: List[float] = []
+    # Latency plus a round trip and serialisation time per exchange on the slow link
+    throttled: List[float] = []
+    request_bytes: List[int] = []
+    response_bytes: List[int] = []
+    errors = 0
+    next_index = iter(range(total))
+    monitor = LoopLagMonitor()
+
+    async def worker():
+        nonlocal errors
+        for index in next_index:
+            wire = []
+            _WIRE.set(wire)
+            started = time.perf_counter()
+            try:
+                ok = await call(index)
+            except Exception:
+                ok = False
+            latency = (time.perf_counter() - started) * 1000
+            latencies.append(latency)
+            errors += not ok
+            if wire:
+                request_bytes.append(sum(sent for sent, _ in wire))
+                response_bytes.append(sum(received for _, received in wire))
+                throttled.append(
+                    latency + len(wire) * link_rtt_ms
+                    + (request_bytes[-1] + response_bytes[-1]) * 8 / link_kbps
+                )
+
+    monitor.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    lag = await monitor.stop()
+
+    latencies.sort()
+    result = {
+        "requests": total,
+        "concurrency": concurrency,
+        "errors": errors,
+        "throughput_rps": round(total / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        **lag,
+        # High-water mark of the whole process so far (KB on Linux)
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+    if throttled:
+        throttled.sort()
+        result.update({
+            "request_bytes_avg": round(sum(request_bytes) / len(request_bytes)),
+            "response_bytes_avg": round(sum(response_bytes) / len(response_bytes)),
+            "throttled_p50_ms": round(percentile(throttled, 50), 2),
+            "throttled_p95_ms": round(percentile(throttled, 95), 2),
+        })
+    return result
+
+
+def _answered(response: httpx.Response) -> bool:
+    if response.status_code >= 400:
+        return False
+    body = response.json()
+    return not str(body.get("answer", "")).startswith("Error:")
+
+
+async def finished_job(client: httpx.AsyncClient, photo: bytes) -> Dict[str, str]:
+    """Submit one crop analysis job and wait for it; the job_poll scenarios read it back"""
+    response = await client.post("/jobs", data={"user_id": "bench"}, files={"image": ("leaf.jpg", photo, "image/jpeg")})
+    job_id = response.json()["job_id"]
+    while True:
+        response = await client.get(f"/jobs/{job_id}")
+        if response.json()["status"] in ("done", "failed"):
+            return {"id": job_id, "etag": response.headers["etag"]}
+        await asyncio.sleep(0.05)
+
+
+def build_calls(
+    app,
+    client: httpx.AsyncClient,
+    photos: List[bytes],
+    job: Optional[Dict[str, str]] = None
+) -> Dict[str, Callable[[int], Awaitable[bool]]]:
+    gemini = app.state.gemini_service
+    firebase = app.state.firebase_service
+
+    def photo(index):
+        return ("leaf.jpg", photos[index % len(photos)], "image/jpeg")
+
+    async def analyze_text(i):
+        # The request number keeps every question distinct, so nothing is coalesced
+        data = {"text": f"My paddy plants in plot {i} are wilting after heavy rain, what should I do", "user_id": f"u{i % 50}"}
+        return _answered(await send(client, "POST", "/analyze", data=data))
+
+    async def analyze_faq(i):
+        data = {"text": FAQ_QUESTIONS[i % len(FAQ_QUESTIONS)], "user_id": f"u{i % 50}"}
+        return _answered(await send(client, "POST", "/analyze", data=data))
+
+    async def analyze_image(i):
+        data = {"text": f"photo {i}", "user_id": f"u{i % 50}"}
+        return _answered(await send(client, "POST", "/analyze", data=data, files={"image": photo(i)}))
+
+    async def analyze_mixed(i):
+        return await (analyze_text, analyze_faq, analyze_image)[i % 3](i)
+
+    async def service_crop_analysis(i):
+        analysis = await gemini.analyze_crop_disease(photos[i % len(photos)], f"plot {i}")
+        return bool(analysis.get("disease_name"))
+
+    async def service_query(i):
+        result = await gemini.process_agricultural_query(f"Best sowing window for mustard in plot {i}?", "en")
+        return bool(result.get("response_text"))
+
+    async def firestore_write(i):
+        return bool(await firebase.store_voice_query(f"u{i % 50}", f"question {i}", "en", 0.9))
+
+    async def firestore_history(i):
+        page = await firebase.get_user_history_page(f"u{i % 50}", 20)
+        return "history" in page
+
+    async def job_poll_full(i):
+        # What a client got before: the whole record, uncompressed JSON
+        response = await send(client, "GET", f"/jobs/{job['id']}?fields=all", headers={"Accept-Encoding": "identity"})
+        return response.status_code == 200
+
+    async def job_poll_compact(i):
+        headers = {"Accept-Encoding": "br, gzip", "Accept": "application/msgpack, application/json"}
+        response = await send(client, "GET", f"/jobs/{job['id']}", headers=headers)
+        return response.status_code == 200
+
+    async def job_poll_revalidate(i):
+        headers = {"Accept-Encoding": "br, gzip", "If-None-Match": job["etag"]}
+        response = await send(client, "GET", f"/jobs/{job['id']}", headers=headers)
+        return response.status_code == 304
+
+    return {
+        "analyze_text": analyze_text,
+        "analyze_faq": analyze_faq,
+        "analyze_image": analyze_image,
+        "analyze_mixed": analyze_mixed,
+        "service_crop_analysis": service_crop_analysis,
+        "service_query": service_query,
+        "firestore_write": firestore_write,
+        "firestore_history": firestore_history,
+        "job_poll_full": job_poll_full,
+        "job_poll_compact": job_poll_compact,
+        "job_poll_revalidate": job_poll_revalidate,
+    }
+
+
+def token_totals() -> Dict[str, int]:
+    """Gemini calls and tokens so far, summed over endpoints"""
+    from metrics import TOKENS
+    totals = {"calls": 0, "prompt": 0, "output": 0}
+    for row in TOKENS.snapshot().values():
+        for key in totals:
+            totals[key] += row[key]
+    return totals
+
+
+def token_delta(before: Dict[str, int]) -> Dict[str, Any]:
+    after = token_totals()
+    calls = after["calls"] - before["calls"]
+    return {
+        "gemini_calls": calls,
+        "prompt_tokens_per_call": round((after["prompt"] - before["prompt"]) / calls, 1) if calls else 0.0,
+        "output_tokens_per_call": round((after["output"] - before["output"]) / calls, 1) if calls else 0.0,
+    }
+
+
+def compare(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """Throughput drops, p95 or response size rises beyond `tolerance` (fraction) count as regressions"""
+    regressions = []
+    for name, current in results.items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        # Sub-millisecond paths (queue enqueue, FAQ) swing too much run to run
+        # for their throughput to be a useful gate; their p95 still is
+        if base["p50_ms"] >= 1.0 and current["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {current['throughput_rps']} < baseline {base['throughput_rps']}")
+        # A couple of milliseconds of noise is not a regression on very fast paths
+        if current["p95_ms"] > base["p95_ms"] * (1 + tolerance) + 2.0:
+            regressions.append(f"{name}: p95 {current['p95_ms']} ms > baseline {base['p95_ms']} ms")
+        # Older baselines have no byte counts
+        if "response_bytes_avg" in base and current.get("response_bytes_avg", 0) > base["response_bytes_avg"] * (1 + tolerance):
+            regressions.append(
+                f"{name}: {current['response_bytes_avg']} bytes/response > baseline {base['response_bytes_avg']}"
+            )
+        if current["errors"] > base["errors"]:
+            regressions.append(f"{name}: {current['errors']} errors > baseline {base['errors']}")
+    return regressions
+
+
+async def run(args) -> Dict[str, Any]:
+    settings = FakeGeminiSettings(
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    db = FakeFirestore(commit_latency_ms=args.firestore_latency_ms)
+    install_fakes(settings, db)
+
+    import main  # after install_fakes so the lifespan builds services on the fakes
+
+    photos = [make_photo(i) for i in range(4)]
+    scenarios = SCENARIOS if args.scenarios == "all" else args.scenarios.split(",")
+    results = {}
+
+    # main.py prints a line or more per request; keep it out of the report
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        async with main.app.router.lifespan_context(main.app):
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+                job = None
+                if any(name.startswith("job_poll") for name in scenarios):
+                    job = await finished_job(client, photos[0])
+                calls = build_calls(main.app, client, photos, job)
+                for name in scenarios:
+                    before = token_totals()
+                    results[name] = await run_scenario(
+                        calls[name], args.requests, args.concurrency, args.link_kbps, args.link_rtt_ms
+                    )
+                    results[name].update(token_delta(before))
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "fake_latency_ms": args.latency_ms,
+            "fake_error_rate": args.error_rate,
+            "firestore_latency_ms": args.firestore_latency_ms,
+            "link_kbps": args.link_kbps,
+            "link_rtt_ms": args.link_rtt_ms,
+            "gemini_calls": settings.calls,
+            "firestore": db.stats(),
+        },
+        "scenarios": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default="all", help=f"comma separated subset of {', '.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="fake Gemini latency")
+    parser.add_argument("--jitter-ms", type=float, default=50.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of fake Gemini calls raising 429")
+    parser.add_argument("--firestore-latency-ms", type=float, default=20.0, help="fake batch commit latency")
+    parser.add_argument("--link-kbps", type=float, default=128.0, help="throttled link bandwidth (2G/EDGE ~ 128)")
+    parser.add_argument("--link-rtt-ms", type=float, default=400.0, help="throttled link round trip")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="baseline JSON to compare against; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    report = asyncio.run(run(args))
+
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            report["regressions"] = compare(report["scenarios"], json.load(f), args.tolerance)
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    for name, row in report["scenarios"].items():
+        print(
+            f"{name:24} {row['throughput_rps']:>9} rps  p50 {row['p50_ms']:>8} ms  "
+            f"p95 {row['p95_ms']:>8} ms  p99 {row['p99_ms']:>8} ms  "
+            f"lag {row['loop_lag_max_ms']:>6} ms  in/call {row.get('prompt_tokens_per_call', 0):>7}  "
+            f"errors {row['errors']}"
+            + (f"  {row['response_bytes_avg']:>6} B/resp  slow link p95 {row['throttled_p95_ms']} ms"
+               if "response_bytes_avg" in row else "")
+        )
+    for regression in report.get("regressions", []):
+        print(f"REGRESSION {regression}")
+    sys.exit(1 if report.get("regressions") else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""
+channel_pool.py
+Long-lived, pooled connections to Gemini and Firestore
+Both SDKs open one gRPC channel lazily on the first call, so the first request
+after a cold start (or after the connection went idle) pays DNS, TCP, TLS,
+HTTP/2 and an OAuth token fetch. Here each service gets a few channels with
+keepalive pings and no idle timeout, opened and kept open by warm() /
+keep_warm(), and every connect is timed into bhasha_connection_setup_seconds
+"""
+
+import asyncio
+import itertools
+import logging
+import os
+import time
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple
+
+import grpc
+
+from metrics import CONNECT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+GEMINI_CHANNELS = int(os.getenv("GEMINI_CHANNELS", "2"))
+FIRESTORE_CHANNELS = int(os.getenv("FIRESTORE_CHANNELS", "2"))
+# Connections kept by the Cloud Storage HTTP session (media uploads)
+STORAGE_HTTP_POOL = int(os.getenv("STORAGE_HTTP_POOL", "16"))
+# Seconds between keep-warm passes; 0 leaves reconnecting to the next request
+KEEP_WARM_SECONDS = float(os.getenv("KEEP_WARM_SECONDS", "0"))
+CONNECT_TIMEOUT = float(os.getenv("GRPC_CONNECT_TIMEOUT", "10"))
+
+
+def channel_options() -> List[Tuple[str, Any]]:
+    """
+    gRPC channel arguments for every pooled channel
+    Pings keep NAT and load-balancer state alive between requests; a server
+    that finds them too frequent answers GOAWAY and gRPC backs the interval off
+    """
+    return [
+        ("grpc.max_send_message_length", -1),
+        ("grpc.max_receive_message_length", -1),
+        ("grpc.keepalive_time_ms", int(os.getenv("GRPC_KEEPALIVE_MS", "60000"))),
+        ("grpc.keepalive_timeout_ms", int(os.getenv("GRPC_KEEPALIVE_TIMEOUT_MS", "20000"))),
+        ("grpc.keepalive_permit_without_calls", int(os.getenv("GRPC_KEEPALIVE_WITHOUT_CALLS", "1"))),
+        ("grpc.http2.max_pings_without_data", 0),
+        # gRPC drops a channel after 30 idle minutes by default; scale-to-zero
+        # hosts idle for longer than that between farmers
+        ("grpc.client_idle_timeout_ms", int(os.getenv("GRPC_IDLE_TIMEOUT_MS", str(24 * 3600 * 1000)))),
+    ]
+
+
+class ChannelPool:
+    """
+    Several gRPC channels behind one client-shaped object
+    Every attribute lookup (in practice, a method call) goes to the next client
+    round-robin, so concurrent calls spread over `size` HTTP/2 connections
+    instead of queueing behind one connection's stream limit
+    """
+
+    def __init__(self, target: str, clients: List[Any], channels: List[Any], credentials=None):
+        self.target = target
+        self.clients = clients
+        self.channels = channels
+        self.credentials = credentials
+        self.states = ["idle"] * len(channels)
+        self.connects = 0
+        self.warm_connects = 0
+        self.last_setup_ms = 0.0
+        self._connecting_since: Dict[int, float] = {}
+        self._turn = itertools.cycle(range(len(clients)))
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._watchers: List[asyncio.Task] = []
+
+    def __getattr__(self, name: str) -> Any:
+        clients = self.__dict__.get("clients")
+        if not clients:
+            raise AttributeError(name)
+        return getattr(clients[next(self._turn)], name)
+
+    @property
+    def size(self) -> int:
+        return len(self.channels)
+
+    def start(self):
+        """Follow channel state so connects are timed, including ones a request triggers"""
+        self._loop = asyncio.get_running_loop()
+        for index, channel in enumerate(self.channels):
+            if isinstance(channel, grpc.aio.Channel):
+                self._watchers.append(asyncio.create_task(self._watch(index, channel)))
+            else:
+                # Called on a gRPC thread; metrics are only touched on the loop
+                channel.subscribe(partial(self._on_state_threadsafe, index), try_to_connect=False)
+
+    async def _watch(self, index: int, channel):
+        state = channel.get_state(try_to_connect=False)
+        while True:
+            self._on_state(index, state)
+            await channel.wait_for_state_change(state)
+            state = channel.get_state(try_to_connect=False)
+
+    def _on_state_threadsafe(self, index: int, state):
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._on_state, index, state)
+
+    def _on_state(self, index: int, state):
+        name = state.name.lower()
+        self.states[index] = name
+        now = time.perf_counter()
+        if name == "connecting":
+            # Through TRANSIENT_FAILURE retries too: the time until the channel is usable
+            self._connecting_since.setdefault(index, now)
+        elif name == "ready" and index in self._connecting_since:
+            seconds = now - self._connecting_since.pop(index)
+            self.connects += 1
+            self.last_setup_ms = round(seconds * 1000, 2)
+            CONNECT_SECONDS.observe(seconds, self.target, "connect")
+        elif name in ("idle", "shutdown"):
+            self._connecting_since.pop(index, None)
+
+    async def warm(self, timeout: float = CONNECT_TIMEOUT) -> int:
+        """Connect every channel that is not ready and refresh the OAuth token; returns channels connected"""
+        cold = [index for index, state in enumerate(self.states) if state != "ready"]
+        results = await asyncio.gather(
+            self._refresh_credentials(),
+            *(self._connect(self.channels[index], timeout) for index in cold),
+            return_exceptions=True
+        )
+        for error in results:
+            if isinstance(error, Exception):
+                logger.warning(f"{self.target} warmup: {type(error).__name__}: {str(error)}")
+        connected = sum(1 for result in results[1:] if not isinstance(result, Exception))
+        self.warm_connects += connected
+        return connected
+
+    @staticmethod
+    async def _connect(channel, timeout: float):
+        if isinstance(channel, grpc.aio.Channel):
+            await asyncio.wait_for(channel.channel_ready(), timeout)
+        else:
+            await asyncio.to_thread(grpc.channel_ready_future(channel).result, timeout)
+
+    async def _refresh_credentials(self):
+        # Service-account tokens last an hour; fetching one is another TLS round trip
+        credentials = self.credentials
+        if credentials is None or not hasattr(credentials, "refresh") or credentials.valid:
+            return
+        from google.auth.transport.requests import Request as AuthRequest
+        started = time.perf_counter()
+        await asyncio.to_thread(credentials.refresh, AuthRequest())
+        CONNECT_SECONDS.observe(time.perf_counter() - started, self.target, "auth")
+
+    async def close(self):
+        for task in self._watchers:
+            task.cancel()
+        for channel in self.channels:
+            result = channel.close()
+            if asyncio.iscoroutine(result):
+                await result
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "channels": self.size,
+            "ready": self.states.count("ready"),
+            "connects": self.connects,
+            "warm_connects": self.warm_connects,
+            "last_setup_ms": self.last_setup_ms,
+        }
+
+
+def gemini_channel_pool(size: int = GEMINI_CHANNELS) -> Optional[ChannelPool]:
+    """
+    Async GenerativeService clients on pooled keepalive channels, installed as
+    the google.generativeai default so every GenerativeModel (built now or
+    later) sends through them. Call after genai.configure(), whose API key and
+    client options they reuse, on the running event loop. None when size is 0
+    or this SDK version cannot take a custom transport
+    """
+    if size <= 0:
+        return None
+    try:
+        from google.ai import generativelanguage as glm
+        from google.ai.generativelanguage_v1beta.services.generative_service.transports import (
+            GenerativeServiceGrpcAsyncIOTransport,
+        )
+        from google.generativeai import client as genai_client
+    except ImportError as e:
+        logger.warning(f"Gemini channel pool unavailable: {str(e)}")
+        return None
+
+    transports = []
+
+    def make_channel(host, options=(), **kwargs):
+        return GenerativeServiceGrpcAsyncIOTransport.create_channel(
+            host, options=[*dict(options).items(), *dict(channel_options()).items()], **kwargs
+        )
+
+    def make_transport(**kwargs):
+        transport = GenerativeServiceGrpcAsyncIOTransport(channel=make_channel, **kwargs)
+        transports.append(transport)
+        return transport
+
+    try:
+        manager = genai_client._client_manager
+        clients = [
+            glm.GenerativeServiceAsyncClient(
+                transport=make_transport,
+                client_options=manager.client_config.get("client_options"),
+                client_info=manager.client_config.get("client_info"),
+            )
+            for _ in range(size)
+        ]
+    except (TypeError, ValueError) as e:
+        logger.warning(f"Gemini channel pool unavailable, using the SDK default channel: {str(e)}")
+        return None
+
+    pool = ChannelPool("gemini", clients, [transport.grpc_channel for transport in transports])
+    manager.clients["generative_async"] = pool
+    logger.info(f"Gemini calls pooled over {size} gRPC channels")
+    return pool
+
+
+def firestore_channel_pool(db, size: int = FIRESTORE_CHANNELS) -> Optional[ChannelPool]:
+    """
+    The same for a google.cloud.firestore Client: its gapic client is built on
+    first use, so filling that slot first routes every call through the pool
+    None against the emulator, or when size is 0
+    """
+    if size <= 0 or getattr(db, "_emulator_host", None):
+        return None
+    try:
+        from google.cloud.firestore_v1.services.firestore import client as firestore_client
+        from google.cloud.firestore_v1.services.firestore.transports.grpc import FirestoreGrpcTransport
+    except ImportError as e:
+        logger.warning(f"Firestore channel pool unavailable: {str(e)}")
+        return None
+
+    transports = [
+        FirestoreGrpcTransport(
+            host=db._target,
+            channel=FirestoreGrpcTransport.create_channel(
+                db._target, credentials=db._credentials, options=channel_options()
+            ),
+        )
+        for _ in range(size)
+    ]
+    clients = [
+        firestore_client.FirestoreClient(transport=transport, client_options=db._client_options)
+        for transport in transports
+    ]
+    pool = ChannelPool(
+        "firestore", clients, [transport.grpc_channel for transport in transports], db._credentials
+    )
+    db._transport = transports[0]
+    db._firestore_api_internal = pool
+    logger.info(f"Firestore calls pooled over {size} gRPC channels")
+    return pool
+
+
+def pool_http_connections(client, size: int = STORAGE_HTTP_POOL):
+    """
+    Let a google-cloud HTTP client (Cloud Storage) keep `size` connections
+    per host; requests' default of 10 makes concurrent uploads reconnect
+    """
+    from requests.adapters import HTTPAdapter
+    client._http.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=size))
+
+
+async def keep_warm(pools: List[ChannelPool], interval: float = KEEP_WARM_SECONDS):
+    """Reconnect any channel that went idle or was closed by the server, every `interval` seconds"""
+    while True:
+        await asyncio.sleep(interval)
+        for pool in pools:
+            try:
+                await pool.warm()
+            except Exception as e:
+                logger.warning(f"Keep-warm of {pool.target} failed: {str(e)}")
@@ -0,0 +1,265 @@
+"""
+compact.py
+Low-bandwidth responses for farmers on metered mobile data
+Field selection, MessagePack for clients that ask for it, weak ETags with
+304s, and gzip/brotli compression that keeps streamed events flowing
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import zlib
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from fastapi import Request, Response
+
+logger = logging.getLogger(__name__)
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+
+# Debug-only fields left out unless a client names them (or asks for fields=all)
+VERBOSE_FIELDS = {"raw_response"}
+
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "512"))
+COMPRESSION_GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+# Brotli 5 compresses about as fast as gzip 6 and noticeably smaller
+COMPRESSION_BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "5"))
+
+# Already compressed, or binary that does not shrink
+_INCOMPRESSIBLE = ("image/", "audio/", "video/", "application/zip", "application/gzip",
+                   "application/octet-stream", "application/vnd.apache.parquet")
+
+
+def parse_fields(value: Optional[str]) -> Optional[Set[str]]:
+    """`?fields=disease_name,severity` -> set; None when absent"""
+    if not value:
+        return None
+    return {name.strip() for name in value.split(",") if name.strip()} or None
+
+
+def select_fields(payload: Any, fields: Optional[Set[str]] = None) -> Any:
+    """
+    Keep only `fields` of an answer; without a selection keep everything but
+    the verbose fields. "all" returns the payload untouched
+    """
+    if not isinstance(payload, dict) or (fields and "all" in fields):
+        return payload
+    if fields:
+        return {key: value for key, value in payload.items() if key in fields}
+    return {key: value for key, value in payload.items() if key not in VERBOSE_FIELDS}
+
+
+def wants_msgpack(accept: Optional[str]) -> bool:
+    if msgpack is None or not accept:
+        return False
+    return any(media_type in accept for media_type in MSGPACK_TYPES)
+
+
+def encode_payload(payload: Any, accept: Optional[str] = None) -> Tuple[bytes, str]:
+    """MessagePack when the Accept header asks for it and msgpack is installed, else compact JSON"""
+    if wants_msgpack(accept):
+        return msgpack.packb(payload, default=str, use_bin_type=True), MSGPACK_TYPES[0]
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=str)
+    return body.encode("utf-8"), "application/json"
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    # Weak comparison: W/"x" and "x" name the same representation
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    wanted = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == wanted for tag in if_none_match.split(","))
+
+
+def compact_response(
+    request: Request,
+    payload: Any,
+    status_code: int = 200,
+    headers: Optional[Dict[str, str]] = None,
+    etag: bool = False
+) -> Response:
+    """
+    Encode `payload` for this client; with `etag`, answer a matching If-None-Match with 304
+    The tag is weak because the compression middleware may re-encode the bytes
+    """
+    body, media_type = encode_payload(payload, request.headers.get("accept"))
+    headers = {**(headers or {}), "Vary": "Accept"}
+    if etag:
+        headers["ETag"] = 'W/"' + hashlib.sha1(body).hexdigest() + '"'
+        if _etag_matches(request.headers.get("if-none-match"), headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+    return Response(content=body, status_code=status_code, media_type=media_type, headers=headers)
+
+
+def negotiate_encoding(accept_encoding: str, available: Iterable[str]) -> Optional[str]:
+    """Highest-q coding we support; ties go to the order of `available`"""
+    quality: Dict[str, float] = {}
+    for item in accept_encoding.lower().split(","):
+        name, _, params = item.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        quality[name.strip()] = q
+    best, best_q = None, 0.0
+    for coding in available:
+        q = quality.get(coding, quality.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+class _GzipEncoder:
+    def __init__(self, level: int):
+        # wbits 31: gzip container
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def chunk(self, data: bytes) -> bytes:
+        # Sync flush: everything so far is decodable, so a streamed event is not held back
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self, data: bytes = b"") -> bytes:
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_FINISH)
+
+
+class _BrotliEncoder:
+    def __init__(self, quality: int):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def chunk(self, data: bytes) -> bytes:
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self, data: bytes = b"") -> bytes:
+        return self._compressor.process(data) + self._compressor.finish()
+
+
+class CompressionStats:
+    """Bytes before and after compression per coding, for /metrics"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows: Dict[str, Dict[str, int]] = {}
+
+    def record(self, coding: str, bytes_in: int, bytes_out: int):
+        with self._lock:
+            row = self._rows.setdefault(coding, {"responses": 0, "bytes_in": 0, "bytes_out": 0})
+            row["responses"] += 1
+            row["bytes_in"] += bytes_in
+            row["bytes_out"] += bytes_out
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        with self._lock:
+            return {coding: dict(row) for coding, row in self._rows.items()}
+
+
+COMPRESSION = CompressionStats()
+
+
+class CompressionMiddleware:
+    """
+    Pure ASGI gzip/brotli (brotli when the package is installed and preferred)
+    Single-body responses under `minimum_size` go out as they are; streamed
+    bodies (SSE, NDJSON) are compressed and flushed chunk by chunk
+    """
+
+    def __init__(
+        self,
+        app,
+        minimum_size: int = COMPRESSION_MIN_BYTES,
+        gzip_level: int = COMPRESSION_GZIP_LEVEL,
+        brotli_quality: int = COMPRESSION_BROTLI_QUALITY
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.codings = ("br", "gzip") if brotli is not None else ("gzip",)
+
+    def _encoder(self, coding: str):
+        return _BrotliEncoder(self.brotli_quality) if coding == "br" else _GzipEncoder(self.gzip_level)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = ""
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+        coding = negotiate_encoding(accept_encoding, self.codings) if accept_encoding else None
+        if coding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start: Optional[Dict[str, Any]] = None
+        encoder = None
+        passthrough = False
+        bytes_in = 0
+        bytes_out = 0
+
+        async def compressing_send(message):
+            nonlocal start, encoder, passthrough, bytes_in, bytes_out
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if encoder is None:
+                # The first body message decides: size is only known when it is the only one
+                if not self._compressible(start) or (not more_body and len(body) < self.minimum_size):
+                    passthrough = True
+                    await send(start)
+                    await send(message)
+                    return
+                encoder = self._encoder(coding)
+                start["headers"] = self._encoded_headers(start["headers"], coding)
+                await send(start)
+
+            bytes_in += len(body)
+            data = encoder.chunk(body) if more_body else encoder.finish(body)
+            bytes_out += len(data)
+            await send({"type": "http.response.body", "body": data, "more_body": more_body})
+            if not more_body:
+                COMPRESSION.record(coding, bytes_in, bytes_out)
+
+        await self.app(scope, receive, compressing_send)
+
+    @staticmethod
+    def _compressible(start: Dict[str, Any]) -> bool:
+        if start["status"] in (204, 304) or start["status"] < 200:
+            return False
+        for name, value in start["headers"]:
+            if name == b"content-encoding":
+                return False
+            if name == b"content-type" and value.decode("latin-1").startswith(_INCOMPRESSIBLE):
+                return False
+        return True
+
+    @staticmethod
+    def _encoded_headers(headers: List[Tuple[bytes, bytes]], coding: str) -> List[Tuple[bytes, bytes]]:
+        vary = [value for name, value in headers if name == b"vary"]
+        result = [(name, value) for name, value in headers if name not in (b"content-length", b"vary")]
+        result.append((b"content-encoding", coding.encode("latin-1")))
+        result.append((b"vary", b", ".join(vary + [b"Accept-Encoding"])))
+        return result
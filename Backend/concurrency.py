@@ -0,0 +1,146 @@
+"""
+concurrency.py
+Bounded in-flight gate and request coalescing for upstream Gemini calls
+Keeps slow model round trips from piling up without limit
+"""
+
+import asyncio
+import copy
+import logging
+import os
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class GateFullError(Exception):
+    """Raised when the gate has no free slot and its wait queue is full"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Model capacity exhausted, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class ConcurrencyGate:
+    """
+    Semaphore with a bounded wait queue
+    Callers beyond `max_in_flight + max_waiting` fail fast instead of queueing
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = 8,
+        max_waiting: int = 32,
+        wait_timeout: float = 15.0,
+        retry_after: int = 5
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.retry_after = retry_after
+
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._in_flight = 0
+        self._waiting = 0
+        self._rejected = 0
+
+    @classmethod
+    def from_env(cls) -> "ConcurrencyGate":
+        """Build a gate from GEMINI_* environment variables"""
+        return cls(
+            max_in_flight=int(os.getenv("GEMINI_MAX_IN_FLIGHT", "8")),
+            max_waiting=int(os.getenv("GEMINI_MAX_WAITING", "32")),
+            wait_timeout=float(os.getenv("GEMINI_WAIT_TIMEOUT", "15")),
+            retry_after=int(os.getenv("GEMINI_RETRY_AFTER", "5")),
+        )
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one in-flight slot for the duration of the block"""
+        if not self._semaphore.locked():
+            # Free slot: acquire() returns without suspending
+            await self._semaphore.acquire()
+        else:
+            if self._waiting >= self.max_waiting:
+                self._rejected += 1
+                raise GateFullError(self.retry_after)
+
+            self._waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.wait_timeout)
+            except asyncio.TimeoutError:
+                self._rejected += 1
+                logger.warning("Gemini gate wait timed out after %ss", self.wait_timeout)
+                raise GateFullError(self.retry_after)
+            finally:
+                self._waiting -= 1
+
+        self._in_flight += 1
+        try:
+            yield
+        finally:
+            self._in_flight -= 1
+            self._semaphore.release()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": self._in_flight,
+            "waiting": self._waiting,
+            "rejected": self._rejected,
+            "max_in_flight": self.max_in_flight,
+            "max_waiting": self.max_waiting,
+        }
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls that share a key into one upstream call
+    Every waiter receives the same result or the same exception
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._calls.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.leaders += 1
+            # A task, not a bare await: if the first caller disconnects, the
+            # upstream call keeps running for everyone else waiting on it
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+
+        result = await asyncio.shield(task)
+        # Each waiter gets its own copy so nobody mutates a shared answer
+        return copy.deepcopy(result)
+
+    def _finish(self, key: str, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved even if every waiter went away
+            task.exception()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight_keys": len(self._calls),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+        }
+
+
+_default_gate: Optional[ConcurrencyGate] = None
+
+
+def get_default_gate() -> ConcurrencyGate:
+    """Process-wide gate shared by main.py and GeminiService"""
+    global _default_gate
+    if _default_gate is None:
+        _default_gate = ConcurrencyGate.from_env()
+    return _default_gate
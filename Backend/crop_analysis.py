@@ -0,0 +1,219 @@
+"""
+crop_analysis.py
+Typed crop analysis schema and tolerant JSON parsing of model output
+The same model doubles as Gemini's response_schema for structured output
+"""
+
+import json
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel, ValidationError, field_validator
+
+SEVERITY_LEVELS = ["Mild", "Moderate", "Severe", "Critical"]
+
+# Bump when fields change so cached analyses of the old shape are not reused
+SCHEMA_VERSION = 1
+
+
+class CropAnalysis(BaseModel):
+    """Diagnosis returned by analyze_crop_disease (before confidence/raw_response)"""
+    crop_type: str = "Unknown"
+    disease_name: str = "Analysis Pending"
+    disease_name_hindi: str = ""
+    disease_name_scientific: str = ""
+    severity: str = "Moderate"
+    symptoms_observed: List[str] = []
+    treatment_steps: List[str] = []
+    organic_solutions: List[str] = []
+    chemical_solutions: List[str] = []
+    prevention_tips: List[str] = []
+    estimated_recovery_time: str = "Unknown"
+    cost_estimate_inr: str = "Varies"
+    urgent_action_required: bool = False
+
+    @field_validator("disease_name", mode="before")
+    @classmethod
+    def _flatten_bilingual(cls, value: Any) -> Any:
+        # Free-form answers sometimes send {"english": ..., "hindi": ...}
+        if isinstance(value, dict):
+            return " / ".join(str(v) for v in value.values() if v)
+        return value
+
+    @field_validator(
+        "symptoms_observed", "treatment_steps", "organic_solutions",
+        "chemical_solutions", "prevention_tips", mode="before"
+    )
+    @classmethod
+    def _as_list(cls, value: Any) -> Any:
+        if value is None:
+            return []
+        if isinstance(value, str):
+            return [value]
+        if isinstance(value, list):
+            return [v if isinstance(v, str) else json.dumps(v, ensure_ascii=False) for v in value]
+        return value
+
+    @field_validator(
+        "crop_type", "disease_name_hindi", "disease_name_scientific",
+        "estimated_recovery_time", "cost_estimate_inr", mode="before"
+    )
+    @classmethod
+    def _as_text(cls, value: Any) -> Any:
+        if value is None:
+            return ""
+        if isinstance(value, (int, float, dict, list)):
+            return json.dumps(value, ensure_ascii=False) if isinstance(value, (dict, list)) else str(value)
+        return value
+
+    @field_validator("severity", mode="before")
+    @classmethod
+    def _normalize_severity(cls, value: Any) -> Any:
+        if isinstance(value, str):
+            for level in SEVERITY_LEVELS:
+                if level.lower() in value.lower():
+                    return level
+        return value or "Moderate"
+
+
+def response_schema() -> Dict[str, Any]:
+    """
+    OpenAPI-subset schema for generation_config["response_schema"]
+    Written out by hand because Gemini rejects pydantic's defaults/$defs
+    """
+    text_list = {"type": "array", "items": {"type": "string"}}
+    return {
+        "type": "object",
+        "properties": {
+            "crop_type": {"type": "string"},
+            "disease_name": {"type": "string"},
+            "disease_name_hindi": {"type": "string"},
+            "disease_name_scientific": {"type": "string"},
+            "severity": {"type": "string", "enum": SEVERITY_LEVELS},
+            "symptoms_observed": text_list,
+            "treatment_steps": text_list,
+            "organic_solutions": text_list,
+            "chemical_solutions": text_list,
+            "prevention_tips": text_list,
+            "estimated_recovery_time": {"type": "string"},
+            "cost_estimate_inr": {"type": "string"},
+            "urgent_action_required": {"type": "boolean"},
+        },
+        "required": ["crop_type", "disease_name", "severity", "treatment_steps", "urgent_action_required"],
+    }
+
+
+_TRAILING_COMMA = re.compile(r",\s*([}\]])")
+
+
+def parse_crop_analysis(text: str) -> Tuple[Optional[CropAnalysis], str]:
+    """
+    Single strict decode first (the structured-output path), tolerant parse second
+    Returns the analysis (or None) and which path produced it: json / tolerant / none
+    """
+    try:
+        return CropAnalysis.model_validate_json(text), "json"
+    except ValidationError:
+        pass
+
+    data = parse_partial_json(text)
+    if isinstance(data, dict):
+        try:
+            return CropAnalysis.model_validate(data), "tolerant"
+        except ValidationError:
+            pass
+    return None, "none"
+
+
+def parse_partial_json(text: str) -> Optional[Any]:
+    """
+    Best-effort decode of a truncated, fenced or slightly malformed JSON object
+    Closes open strings and containers; drops a dangling key or half-written literal
+    """
+    start = text.find("{")
+    if start < 0:
+        return None
+    body = text[start:]
+    fence = body.rfind("```")
+    if fence > 0:
+        body = body[:fence]
+    body = _TRAILING_COMMA.sub(r"\1", body.rstrip())
+
+    stack: List[str] = []
+    expect: List[str] = []          # per open container: key / colon / value / comma
+    in_string = False
+    string_is_key = False
+    open_literal = False             # body ends inside a number/literal
+    escape = False
+    safe_end, safe_stack = 0, []     # longest prefix that is valid once closed
+
+    def value_done(end: int):
+        nonlocal safe_end, safe_stack
+        if expect:
+            expect[-1] = "comma"
+        safe_end, safe_stack = end, stack[:]
+
+    for i, ch in enumerate(body):
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+                if string_is_key:
+                    expect[-1] = "colon"
+                else:
+                    value_done(i + 1)
+            continue
+
+        if ch == '"':
+            in_string = True
+            string_is_key = bool(stack) and stack[-1] == "{" and expect[-1] == "key"
+        elif ch in "{[":
+            stack.append(ch)
+            expect.append("key" if ch == "{" else "value")
+            safe_end, safe_stack = i + 1, stack[:]
+        elif ch in "}]":
+            if not stack:
+                break
+            stack.pop()
+            expect.pop()
+            value_done(i + 1)
+            if not stack:
+                break
+        elif ch == ":":
+            if expect:
+                expect[-1] = "value"
+        elif ch == ",":
+            if expect:
+                expect[-1] = "key" if stack[-1] == "{" else "value"
+        elif not ch.isspace() and expect and expect[-1] == "value":
+            # Start of a number/literal; it is complete once a delimiter follows
+            end = i
+            while end < len(body) and body[end] not in ",}]" and not body[end].isspace():
+                end += 1
+            if end < len(body):
+                value_done(end)
+            else:
+                open_literal = True
+
+    closers = "".join("}" if c == "{" else "]" for c in reversed(stack))
+    # A trailing number may itself be cut short ("5" of "500"), so skip it
+    candidates = [] if open_literal else [body + closers]
+    if in_string and not string_is_key:
+        # Keep the partial string value, minus any half-written escape
+        cut = len(body)
+        tail = body[max(0, cut - 6):]
+        backslash = tail.rfind("\\")
+        if backslash >= 0:
+            cut -= len(tail) - backslash
+        candidates.append(body[:cut] + '"' + closers)
+    candidates.append(body[:safe_end] + "".join("}" if c == "{" else "]" for c in reversed(safe_stack)))
+
+    for candidate in candidates:
+        try:
+            return json.loads(candidate)
+        except ValueError:
+            continue
+    return None
@@ -3,34 +3,130 @@ from firebase_admin import credentials, firestore, storage
 import logging
 import os
 import json
+import asyncio
+import base64
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from channel_pool import firestore_channel_pool, pool_http_connections
+from media_store import MediaStore
+from outbreak_analytics import EXPORT_SELECT, OutbreakRollups, pseudonymize, report_fields
+from shared_state import get_shared_state
+from write_behind import WriteBehindQueue
 
 logger = logging.getLogger(__name__)
 
+# Summary fields returned by /history; the full documents are never fetched
+HISTORY_FIELDS = ['transcript', 'language', 'confidence', 'timestamp', 'response.answer']
+# Crop analyses appear in the same history, as the photo's question and diagnosis
+ANALYSIS_HISTORY_FIELDS = [
+    'timestamp', 'image_url', 'analysis.query', 'analysis.answer',
+    'analysis.disease_name', 'analysis.severity',
+]
+
+
+class HistoryCache:
+    """
+    Per-user read-through cache of history pages, dropped whenever the user writes
+    With shared state a write in any worker bumps the user's generation, which
+    retires the pages every other worker cached before it
+    """
+
+    def __init__(self, ttl=60.0, max_users=1000, shared=None):
+        self.ttl = ttl
+        self.max_users = max_users
+        self.shared = shared
+        self._users = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _generation(self, user_id):
+        return self.shared.generation(f"history:{user_id}") if self.shared is not None else 0
+
+    def get(self, user_id, page_key):
+        pages = self._users.get(user_id)
+        entry = pages.get(page_key) if pages else None
+        if entry is None or entry[0] < time.monotonic() or entry[2] != self._generation(user_id):
+            self.misses += 1
+            return None
+        self._users.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, user_id, page_key, page):
+        entry = (time.monotonic() + self.ttl, page, self._generation(user_id))
+        self._users.setdefault(user_id, {})[page_key] = entry
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self._users.pop(user_id, None)
+        if self.shared is not None:
+            self.shared.bump(f"history:{user_id}")
+
+    def stats(self):
+        return {"users": len(self._users), "hits": self.hits, "misses": self.misses}
+
+
+def encode_cursor(timestamp, doc_id=None):
+    # Batched writes share one server timestamp, so the document id breaks ties
+    value = timestamp.isoformat() if doc_id is None else f"{timestamp.isoformat()}|{doc_id}"
+    return base64.urlsafe_b64encode(value.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """(timestamp, document id or None); raises ValueError on anything else"""
+    padded = cursor + '=' * (-len(cursor) % 4)
+    timestamp, _, doc_id = base64.urlsafe_b64decode(padded).decode().partition('|')
+    return datetime.fromisoformat(timestamp), doc_id or None
+
+
+def cursor_values(start_after):
+    """start_after() values for a decoded cursor, matching order_by(timestamp).order_by(__name__)"""
+    timestamp, doc_id = start_after
+    return {'timestamp': timestamp, '__name__': doc_id} if doc_id else {'timestamp': timestamp}
+
+
 class FirebaseService:
     def __init__(self):           # KJ
         self.db = None
         self.bucket = None
+        self.writer = None
+        self.channels = None
+        self.history_cache = HistoryCache(
+            ttl=float(os.getenv('HISTORY_CACHE_TTL', '60')), shared=get_shared_state()
+        )
         self._initialize_firebase()
+        if self.db is not None and os.getenv('FIRESTORE_WRITE_BEHIND', '1') != '0':
+            self.writer = WriteBehindQueue.from_env(self.db)
+            # Records become readable only once committed, so drop pages again then
+            self.writer.on_commit = self._invalidate_committed
+        # Content-addressed images/audio in the bucket (or MEDIA_STORE_PATH locally)
+        self.media = MediaStore.from_env(self.bucket)
+        # Disease counts by district and day, bumped as analyses are stored
+        self.analytics = OutbreakRollups.from_env()
     
     def _initialize_firebase(self):
         try:
             if not firebase_admin._apps:
-                # 1. Local Development
-                if os.path.exists('serviceAccountKey.json'):
-                    cred = credentials.Certificate('serviceAccountKey.json')
+                # 1. Render Deployment (Env Variable, takes precedence)
+                if os.getenv('FIREBASE_CREDENTIALS'):
+                    creds_dict = json.loads(os.getenv('FIREBASE_CREDENTIALS'))
+                    cred = credentials.Certificate(creds_dict)
                     firebase_admin.initialize_app(cred, {
                         'storageBucket': os.getenv('FIREBASE_STORAGE_BUCKET')
                     })
-                    logger.info("Firebase initialized from local file")
+                    logger.info("Firebase initialized from Environment Variable")
                 
-                # 2. Render Deployment (Env Variable)
-                elif os.getenv('FIREBASE_CREDENTIALS'):
-                    creds_dict = json.loads(os.getenv('FIREBASE_CREDENTIALS'))
-                    cred = credentials.Certificate(creds_dict)
+                # 2. Local Development
+                elif os.path.exists('serviceAccountKey.json'):
+                    cred = credentials.Certificate('serviceAccountKey.json')
                     firebase_admin.initialize_app(cred, {
                         'storageBucket': os.getenv('FIREBASE_STORAGE_BUCKET')
                     })
-                    logger.info("Firebase initialized from Environment Variable")
+                    logger.info("Firebase initialized from local file")
                 
                 # 3. Default (Cloud Run / Auto-discovery)
                 else:
@@ -38,35 +134,165 @@ class FirebaseService:
                     logger.info("Firebase initialized from Default Credentials")
             
             self.db = firestore.client()
-            self.bucket = storage.bucket()
+            # storage.bucket() raises without a configured bucket name,
+            # which used to take Firestore down with it
+            if os.getenv('FIREBASE_STORAGE_BUCKET'):
+                self.bucket = storage.bucket()
+            self._initialize_transport()
             
         except Exception as e:
             logger.error(f"Firebase initialization error: {str(e)}")
             self.db = None
 
+    def _initialize_transport(self):
+        """Keepalive channel pool for Firestore, a bigger connection pool for Storage"""
+        try:
+            self.channels = firestore_channel_pool(self.db)
+            if self.bucket is not None:
+                pool_http_connections(self.bucket.client)
+        except Exception as e:
+            # The client's own lazily-built channel still works
+            logger.error(f"Firestore channel pool failed: {str(e)}")
+            self.channels = None
+
+    async def start(self):
+        """Start background writes (call from the app lifespan)"""
+        if self.writer is not None:
+            await self.writer.start()
+
+    async def close(self):
+        """Flush queued writes before the process exits"""
+        if self.media is not None:
+            await self.media.close()
+        if self.writer is not None:
+            await self.writer.close()
+        if self.analytics is not None:
+            self.analytics.close()
+        if self.channels is not None:
+            await self.channels.close()
+
+    async def _write(self, collection, data):
+        """
+        Queue a new document and return its id without waiting for Firestore
+        Falls back to a direct write (off the event loop) when the queue is not running
+        """
+        doc_ref = self.db.collection(collection).document()
+        if self.writer is not None and self.writer.running:
+            self.writer.enqueue(collection, doc_ref.id, data)
+        else:
+            await asyncio.to_thread(doc_ref.set, data)
+        return doc_ref.id
+
     async def create_user_profile(self, user_id, profile_data):
         if not self.db: return {}
         try:
             user_ref = self.db.collection('users').document(user_id)
-            user_ref.set(profile_data, merge=True)
+            await asyncio.to_thread(user_ref.set, profile_data, merge=True)
             return profile_data
         except Exception as e:
             logger.error(f"Error creating profile: {e}")
             return {}
 
     async def get_user_history(self, user_id, limit=20):
-        if not self.db: return []
+        page = await self.get_user_history_page(user_id, limit)
+        return page["history"]
+
+    async def get_user_history_page(self, user_id, limit=20, cursor=None):
+        """
+        Newest-first page of summary fields plus a cursor for the next page
+        Served from the per-user cache when possible; raises ValueError on a bad cursor
+        and lets Firestore errors through, so a failed query is not an empty history
+        """
+        empty = {"history": [], "next_cursor": None}
+        if not self.db: return empty
+        start_after = decode_cursor(cursor) if cursor else None
+        page_key = (limit, cursor)
+        cached = self.history_cache.get(user_id, page_key)
+        if cached is not None:
+            return cached
         try:
-            docs = self.db.collection('voice_queries').where('user_id', '==', user_id).limit(limit).stream()
-            return [doc.to_dict() for doc in docs]
+            page = await asyncio.to_thread(self._fetch_history_page, user_id, limit, start_after)
         except Exception as e:
             logger.error(f"Error getting history: {e}")
-            return []
+            raise
+        self.history_cache.set(user_id, page_key, page)
+        return page
+
+    def _fetch_history_page(self, user_id, limit, start_after):
+        # Both collections share the (timestamp, id) order, so one cursor pages through either
+        items = [
+            *self._history_query('voice_queries', HISTORY_FIELDS, user_id, limit, start_after),
+            *(
+                self._analysis_history_item(item)
+                for item in self._history_query('crop_analyses', ANALYSIS_HISTORY_FIELDS, user_id, limit, start_after)
+            ),
+        ]
+        items.sort(key=lambda item: (item['timestamp'], item['id']), reverse=True)
+
+        next_cursor = None
+        if len(items) > limit:
+            items = items[:limit]
+            next_cursor = encode_cursor(items[-1]['timestamp'], items[-1]['id'])
+        for item in items:
+            if isinstance(item.get('timestamp'), datetime):
+                item['timestamp'] = item['timestamp'].isoformat()
+        return {"history": items, "next_cursor": next_cursor}
+
+    def _history_query(self, collection, fields, user_id, limit, start_after):
+        query = (
+            self.db.collection(collection)
+            .where('user_id', '==', user_id)
+            .order_by('timestamp', direction=firestore.Query.DESCENDING)
+            .order_by('__name__', direction=firestore.Query.DESCENDING)
+            .select(fields)
+            .limit(limit + 1)  # one extra tells us whether another page exists
+        )
+        if start_after:
+            query = query.start_after(cursor_values(start_after))
+
+        items = []
+        for doc in query.stream():
+            item = doc.to_dict()
+            item['id'] = doc.id
+            # A write still waiting for its server timestamp cannot be ordered yet
+            if isinstance(item.get('timestamp'), datetime):
+                items.append(item)
+        return items
+
+    @staticmethod
+    def _analysis_history_item(item):
+        """The shape the history panel renders: question, answer and an "Image Analysis" tag"""
+        analysis = item.pop('analysis', None) or {}
+        disease, severity = analysis.get('disease_name'), analysis.get('severity')
+        answer = analysis.get('answer')
+        if not answer and disease:
+            answer = f"{disease} ({severity})" if severity else disease
+        return {
+            **item,
+            'analysis': "Image Analysis",
+            'transcript': analysis.get('query') or "",
+            'response': {'answer': answer or ""},
+            'disease_name': disease,
+            'severity': severity,
+        }
+
+    def _invalidate_committed(self, records):
+        for _, _, data in records:
+            self.history_cache.invalidate(data.get('user_id'))
+
+    def store_media(self, data, content_type, kind):
+        """Start a background upload and return the object URL (None without storage)"""
+        if self.media is None or not data:
+            return None
+        try:
+            return self.media.put(data, content_type, kind)
+        except Exception as e:
+            logger.error(f"Error storing media: {e}")
+            return None
 
     async def store_crop_analysis(self, user_id, analysis, image_url, audio_url):
         if not self.db: return "db_error"
         try:
-            doc_ref = self.db.collection('crop_analyses').document()
             data = {
                 "user_id": user_id,
                 "analysis": analysis,
@@ -74,25 +300,87 @@ class FirebaseService:
                 "audio_url": audio_url,
                 "timestamp": firestore.SERVER_TIMESTAMP
             }
-            doc_ref.set(data)
-            return doc_ref.id
+            self.history_cache.invalidate(user_id)
+            doc_id = await self._write('crop_analyses', data)
         except Exception as e:
             logger.error(f"Error storing analysis: {e}")
             return None
+        await self._roll_up(analysis)
+        return doc_id
 
-    async def store_voice_query(self, user_id, transcript, language, confidence):
+    async def _roll_up(self, analysis):
+        if self.analytics is None or not isinstance(analysis, dict):
+            return
+        try:
+            await asyncio.to_thread(self.analytics.record, analysis)
+        except Exception as e:
+            logger.error(f"Error updating outbreak rollups: {e}")
+
+    async def export_crop_analyses(self, since=None, until=None, cursor=None, page_size=500, limit=None):
+        """
+        Oldest-first pages of flat analysis rows for bulk export
+        Pages through Firestore with cursors and selected fields only, so memory
+        stays at one page; each row's cursor resumes an interrupted export.
+        Raises ValueError on a bad cursor
+        """
+        start_after = decode_cursor(cursor) if cursor else None
+        last = None
+        sent = 0
+        while limit is None or sent < limit:
+            size = page_size if limit is None else min(page_size, limit - sent)
+            docs = await asyncio.to_thread(self._fetch_export_page, since, until, start_after, last, size)
+            if not docs:
+                return
+            last = docs[-1]
+            sent += len(docs)
+            yield [self._export_row(doc) for doc in docs]
+            if len(docs) < size:
+                return
+
+    def _fetch_export_page(self, since, until, start_after, last, size):
+        query = self.db.collection('crop_analyses').order_by('timestamp').order_by('__name__')
+        if since:
+            query = query.where('timestamp', '>=', since)
+        if until:
+            query = query.where('timestamp', '<', until)
+        query = query.select(EXPORT_SELECT).limit(size)
+        # The previous page's last snapshot, or the resume cursor, names the document too
+        if last is not None:
+            query = query.start_after(last)
+        elif start_after:
+            query = query.start_after(cursor_values(start_after))
+        return list(query.stream())
+
+    @staticmethod
+    def _export_row(doc):
+        data = doc.to_dict()
+        analysis = data.get('analysis') or {}
+        timestamp = data.get('timestamp')
+        return {
+            "id": doc.id,
+            "timestamp": timestamp,
+            "cursor": encode_cursor(timestamp, doc.id) if isinstance(timestamp, datetime) else None,
+            "user": pseudonymize(data.get('user_id')),
+            **report_fields(analysis),
+            "image_url": data.get('image_url'),
+        }
+
+    async def store_voice_query(self, user_id, transcript, language, confidence, audio_url=None, answer=None):
         if not self.db: return "db_error"
         try:
-            doc_ref = self.db.collection('voice_queries').document()
             data = {
                 "user_id": user_id,
                 "transcript": transcript,
                 "language": language,
                 "confidence": confidence,
+                "audio_url": audio_url,
                 "timestamp": firestore.SERVER_TIMESTAMP
             }
-            doc_ref.set(data)
-            return doc_ref.id
+            if answer is not None:
+                # Shown under the question in the history panel
+                data["response"] = {"answer": answer}
+            self.history_cache.invalidate(user_id)
+            return await self._write('voice_queries', data)
         except Exception as e:
             logger.error(f"Error storing voice query: {e}")
             return None
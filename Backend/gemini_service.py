@@ -7,25 +7,142 @@ Optimized for Indian agricultural context
 import google.generativeai as genai
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
 import logging
-from typing import Dict, Optional, List, Any
+from typing import Dict, Optional, List, Any, AsyncIterator, Iterator, Tuple
 import json
 import base64
-from PIL import Image
-import io
 import os
+import asyncio
+import re
+import time
+from collections import Counter
+
+from channel_pool import ChannelPool, gemini_channel_pool
+from concurrency import ConcurrencyGate, SingleFlight, get_default_gate
+from crop_analysis import SCHEMA_VERSION, parse_crop_analysis, parse_partial_json, response_schema
+from intent_router import IntentRouter, guess_language
+from metrics import GEMINI_TTFT_SECONDS, record_image, record_stage, stage
+from prompts import CHAT, CROP_ANALYSIS, QUERY, REGIONAL_ADVICE, TEMPLATES, VOICE
+from image_index import ImageIndex, image_features
+from image_pipeline import get_preprocess_pool, preprocess_image
+from region_resolver import Region, RegionResolver
+from response_cache import ResponseCache, digest_bytes, make_cache_key
+from scheduler import INTERACTIVE, CircuitOpenError, GeminiScheduler
+from shared_state import SharedSingleFlight, get_shared_state
 
 logger = logging.getLogger(__name__)
 
+SEVERITY_ORDER = ["Mild", "Moderate", "Severe", "Critical"]
+
+# Served instantly while the Gemini circuit breaker is open
+DEGRADED_ANSWERS = {
+    "en": (
+        "Our crop advisory service is under heavy load right now. Please try again in a few minutes. "
+        "For urgent help, call the Kisan Call Centre on 1800-180-1551 (toll free)."
+    ),
+    "hi": (
+        "इस समय हमारी फसल सलाह सेवा पर बहुत भार है। कृपया कुछ मिनट बाद फिर से प्रयास करें। "
+        "तुरंत सहायता के लिए किसान कॉल सेंटर 1800-180-1551 (टोल फ्री) पर कॉल करें।"
+    ),
+    "hi-latn": (
+        "Is samay hamari fasal salah seva par bahut bhaar hai. Kripya kuch minute baad phir se koshish karen. "
+        "Turant sahayata ke liye Kisan Call Centre 1800-180-1551 (toll free) par call karen."
+    ),
+}
+
+# Voice questions: transcript and answer come back from one audio call
+VOICE_RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "transcript": {"type": "string"},
+        "language": {"type": "string"},
+        "transcript_confidence": {"type": "number"},
+        "answer": {"type": "string"},
+    },
+    "required": ["transcript", "language", "answer"],
+}
+
+# Sentence ends in Latin and Indic scripts (danda / double danda)
+_SENTENCE_END = re.compile(r"(?<=[.!?\u0964\u0965])\s+|\n+")
+
+
+class SentenceSplitter:
+    """
+    Regroups streamed text chunks into whole sentences
+    Lets speech output start on the first sentence while the rest generates
+    """
+    
+    def __init__(self):
+        self._pending = ""
+    
+    def feed(self, chunk: str) -> List[str]:
+        """Add a chunk, return the sentences it completed"""
+        parts = _SENTENCE_END.split(self._pending + chunk)
+        self._pending = parts.pop()
+        return [part.strip() for part in parts if part.strip()]
+    
+    def flush(self) -> List[str]:
+        """Whatever is left once the stream has ended"""
+        rest, self._pending = self._pending.strip(), ""
+        return [rest] if rest else []
+
+
+async def stream_sentences(chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+    """Sentence-by-sentence view over an async stream of text chunks"""
+    splitter = SentenceSplitter()
+    async for chunk in chunks:
+        for sentence in splitter.feed(chunk):
+            yield sentence
+    for sentence in splitter.flush():
+        yield sentence
+
 class GeminiService:
     """
     Gemini 1.5 Flash service for agricultural intelligence
     Handles both text and vision tasks
     """
     
-    def __init__(self):
+    def __init__(
+        self,
+        gate: Optional[ConcurrencyGate] = None,
+        cache: Optional[ResponseCache] = None,
+        scheduler: Optional[GeminiScheduler] = None
+    ):
         self.model = None
         self.vision_model = None
+        self.chat_model = None
+        self._available_models: Optional[List[str]] = None
+        self._available_models_at = 0.0
+        self.model_list_ttl = float(os.getenv("GEMINI_MODEL_LIST_TTL", "3600"))
+        # System-instruction tokens per template id, filled by count_template_tokens()
+        self.template_tokens: Dict[str, int] = {}
+        # Shared in-flight limit for every generate_content call
+        self.gate = gate or get_default_gate()
+        # Quota buckets, priority lanes, retry/fallback and circuit breaker
+        self.scheduler = scheduler or GeminiScheduler.from_env(self.gate)
+        # Answers keyed on normalized text + image digest + model config
+        self.cache = cache or ResponseCache.from_env()
+        # Identical requests already in flight share one upstream call; across
+        # workers too when the cache is one they all read
+        shared = get_shared_state()
+        if shared is not None and self.cache.shared:
+            self.flight = SharedSingleFlight(shared, self.cache, max_wait=self.scheduler.max_wait)
+        else:
+            self.flight = SingleFlight()
+        # Content-addressed image storage, attached by the app when configured
+        self.media = None
+        # Near-duplicate photos: reuse a close match, seed the prompt with a looser one
+        self.image_index = ImageIndex.from_env()
+        self.reuse_hamming = int(os.getenv("IMAGE_INDEX_REUSE_HAMMING", "8"))
+        self.reuse_cosine = float(os.getenv("IMAGE_INDEX_REUSE_COSINE", "0.95"))
+        self.seed_hamming = int(os.getenv("IMAGE_INDEX_SEED_HAMMING", "14"))
+        self.seed_cosine = float(os.getenv("IMAGE_INDEX_SEED_COSINE", "0.9"))
+        self._index_writes = set()
+        # Offline lat/lng -> district, state, agro-climatic zone
+        self.regions = RegionResolver.load_default()
         self._initialize_models()
+        # Keepalive gRPC channels shared by every model; None keeps the SDK default
+        self.channels: Optional[ChannelPool] = None
+        self._initialize_transport()
         
         # Indian agricultural context
         self.crop_knowledge_base = {
@@ -41,6 +158,9 @@ class GeminiService:
             }
         }
         
+        # Local tier: intent keywords + FAQ answers that skip the model entirely
+        self.router = IntentRouter.load_default(self.crop_knowledge_base)
+        
     def _initialize_models(self):
         """Initialize Gemini models"""
         try:
@@ -50,45 +170,151 @@ class GeminiService:
             # --- FIX: Switched to Stable 1.5 Flash Model (High Quota) ---
             # This fixes the "429 Quota Exceeded" error (Limit: 1500/day)
             model_name = "gemini-1.5-flash"
+            self.model_name = model_name
+            self.vision_generation_config = {
+                "temperature": 0.4,  # Lower for factual accuracy
+                "top_p": 0.95,
+                "max_output_tokens": 3072,
+                # Structured output: the model emits bare JSON matching CropAnalysis
+                "response_mime_type": "application/json",
+                "response_schema": response_schema(),
+            }
 
+            # Tried in order when a model is out of quota or failing
+            self.fallback_model_names = [
+                name.strip() for name in os.getenv("GEMINI_FALLBACK_MODELS", "").split(",") if name.strip()
+            ]
+            
             # Text model for queries
-            self.model = genai.GenerativeModel(
-                model_name=model_name,
-                generation_config={
+            text_model_kwargs = {
+                "generation_config": {
                     "temperature": 0.7,
                     "top_p": 0.95,
                     "top_k": 40,
                     "max_output_tokens": 2048,
                 },
-                safety_settings={
+                "safety_settings": {
                     HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
                     HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
                     HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
                     HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_MEDIUM_AND_ABOVE,
                 }
-            )
+            }
+            # Static instructions live in system_instruction; requests carry only their variable lines
+            self.text_models = self._model_chain(model_name, system_instruction=QUERY.system, **text_model_kwargs)
+            self.model = self.text_models[0]
             
             # Vision model for image analysis
-            self.vision_model = genai.GenerativeModel(
-                model_name=model_name,
+            self.vision_models = self._model_chain(
+                model_name,
+                generation_config=self.vision_generation_config,
+                system_instruction=CROP_ANALYSIS.system,
+            )
+            self.vision_model = self.vision_models[0]
+            
+            # Audio in, {transcript, language, answer} out
+            self.voice_models = self._model_chain(
+                model_name,
                 generation_config={
-                    "temperature": 0.4,  # Lower for factual accuracy
-                    "top_p": 0.95,
-                    "max_output_tokens": 3072,
-                }
+                    **text_model_kwargs["generation_config"],
+                    "response_mime_type": "application/json",
+                    "response_schema": VOICE_RESPONSE_SCHEMA,
+                },
+                safety_settings=text_model_kwargs["safety_settings"],
+                system_instruction=VOICE.system,
             )
             
+            # Region-specific treatment section, cached per district
+            self.advice_models = self._model_chain(
+                model_name, system_instruction=REGIONAL_ADVICE.system, **text_model_kwargs
+            )
+            
+            # General chat model behind /analyze
+            self.chat_model_name = os.getenv("GEMINI_CHAT_MODEL", "gemini-flash-latest")
+            self.chat_models = self._model_chain(self.chat_model_name, system_instruction=CHAT.system)
+            self.chat_model = self.chat_models[0]
+            
             logger.info(f"Gemini models initialized successfully using {model_name}")
             
         except Exception as e:
             logger.error(f"Failed to initialize Gemini: {str(e)}")
             raise
     
+    def _initialize_transport(self):
+        """Pooled channels for generate_content and count_tokens (call on the event loop)"""
+        try:
+            self.channels = gemini_channel_pool()
+        except Exception as e:
+            logger.error(f"Gemini channel pool failed, using the SDK default channel: {str(e)}")
+            self.channels = None
+    
+    def _model_chain(self, primary: str, **model_kwargs) -> List[Any]:
+        """Primary model plus the configured fallbacks, all with the same settings"""
+        names = [primary] + [name for name in self.fallback_model_names if name != primary]
+        return [genai.GenerativeModel(model_name=name, **model_kwargs) for name in names]
+    
+    async def list_available_models(self, refresh: bool = False) -> List[str]:
+        """
+        Names of models supporting generateContent
+        Cached for GEMINI_MODEL_LIST_TTL seconds since listing is a network round trip
+        """
+        expired = time.monotonic() - self._available_models_at > self.model_list_ttl
+        if self._available_models is None or expired or refresh:
+            self._available_models = await asyncio.to_thread(self._fetch_model_names)
+            self._available_models_at = time.monotonic()
+        return self._available_models
+    
+    async def count_template_tokens(self, refresh: bool = False) -> Dict[str, int]:
+        """
+        System-instruction size of each prompt template, via count_tokens
+        These tokens are billed as input on every call that uses the template
+        """
+        if self.template_tokens and not refresh:
+            return self.template_tokens
+        # A bare model, so the count is not mixed with its own system_instruction
+        counter = genai.GenerativeModel(model_name=self.model_name)
+        counts = {}
+        for template in TEMPLATES.values():
+            response = await counter.count_tokens_async(template.system)
+            counts[template.id] = response.total_tokens
+        self.template_tokens = counts
+        return counts
+    
+    @staticmethod
+    def _fetch_model_names() -> List[str]:
+        return [
+            m.name for m in genai.list_models()
+            if 'generateContent' in m.supported_generation_methods
+        ]
+    
+    @property
+    def models_cached(self) -> bool:
+        return self._available_models is not None
+    
+    async def generate_answer(self, prompt_parts: List[Any], priority: int = INTERACTIVE) -> str:
+        """
+        Free-form answer for the /analyze route
+        prompt_parts may mix text and {"mime_type", "data"} blobs
+        """
+        with stage("model_call"):
+            response = await self.scheduler.generate(self.chat_models, prompt_parts, priority)
+        return response.text
+    
+    def degraded_answer(self, query: Optional[str] = None) -> Dict[str, Any]:
+        """Fast fallback while the circuit is open; never cached"""
+        language = guess_language(query) if query else "en"
+        return {
+            "answer": DEGRADED_ANSWERS.get(language, DEGRADED_ANSWERS["en"]),
+            "source": "degraded",
+            "degraded": True,
+        }
+    
     async def analyze_crop_disease(
         self,
         image_data: bytes,
         additional_context: Optional[str] = None,
-        location: Optional[Dict[str, float]] = None
+        location: Optional[Dict[str, float]] = None,
+        priority: int = INTERACTIVE
     ) -> Dict[str, Any]:
         """
         Analyze crop disease from image using Gemini 1.5 Flash
@@ -96,124 +322,271 @@ class GeminiService:
         Returns detailed diagnosis with Indian agricultural regulations
         """
         try:
-            # Convert bytes to PIL Image
-            image = Image.open(io.BytesIO(image_data))
-            
-            # Construct detailed prompt for Indian context
-            prompt = self._build_crop_analysis_prompt(additional_context, location)
-            
-            # Generate multimodal response
-            response = self.vision_model.generate_content([prompt, image])
-            
-            # Parse structured response
-            analysis = self._parse_crop_analysis(response.text)
-            
-            # Add confidence score based on response quality
-            analysis["confidence"] = self._calculate_confidence(response)
-            analysis["raw_response"] = response.text
-            
+            region = self.resolve_region(location)
+            cache_key = make_cache_key(
+                additional_context,
+                digest_bytes(image_data),
+                self.model_name,
+                self.vision_generation_config,
+                # The prompt only carries the district, so nearby farms share answers
+                extra={
+                    "location": region.key if region else self._location_key(location),
+                    "schema": SCHEMA_VERSION,
+                    "prompt": CROP_ANALYSIS.id,
+                }
+            )
+            analysis = self.cache.get(cache_key)
+            if analysis is None:
+                # Identical uploads arriving together wait on one Gemini call
+                analysis = await self.flight.do(
+                    cache_key,
+                    lambda: self._run_crop_analysis(
+                        cache_key, image_data, additional_context, location, priority, region
+                    )
+                )
+            if region is not None:
+                analysis = await self._with_regional_advice(analysis, region, priority)
             return analysis
             
+        except CircuitOpenError:
+            logger.warning("Gemini circuit open, returning degraded crop analysis")
+            analysis = self._extract_structured_data("")
+            analysis.update(
+                symptoms_observed=[],
+                confidence=0.0,
+                degraded=True,
+                note="Image analysis is temporarily unavailable. Please retry in a few minutes."
+            )
+            return analysis
         except Exception as e:
             logger.error(f"Crop analysis error: {str(e)}")
             raise
     
+    async def _run_crop_analysis(
+        self,
+        cache_key: str,
+        image_data: bytes,
+        additional_context: Optional[str],
+        location: Optional[Dict[str, float]],
+        priority: int = INTERACTIVE,
+        region: Optional[Region] = None
+    ) -> Dict[str, Any]:
+        # Downscale + recompress before upload (CPU-bound, keep it off the loop)
+        with stage("preprocess"):
+            prepared = await asyncio.get_running_loop().run_in_executor(
+                get_preprocess_pool(), preprocess_image, image_data
+            )
+        record_image(prepared.bytes_in, prepared.bytes_out)
+        logger.info(f"Image preprocessed: {prepared.stats()}")
+        
+        features = None
+        match = None
+        if self.image_index is not None:
+            with stage("near_duplicate"):
+                features = await asyncio.get_running_loop().run_in_executor(
+                    get_preprocess_pool(), image_features, prepared.data
+                )
+                match = self.image_index.search(*features, self.seed_hamming, self.seed_cosine)
+        
+        if match and match["hamming"] <= self.reuse_hamming and match["cosine"] >= self.reuse_cosine:
+            # Same plant from a slightly different angle / recompressed: reuse the diagnosis
+            analysis = dict(match["record"]["analysis"])
+            analysis["near_duplicate"] = self._match_summary(match, reused=True)
+            if self.media is not None:
+                analysis["image_url"] = self.media.put(prepared.data, prepared.mime_type, "images")
+            self.cache.set(cache_key, analysis)
+            return analysis
+        
+        # Construct detailed prompt for Indian context
+        with stage("prompt_build"):
+            prompt = self._build_crop_analysis_prompt(
+                additional_context, location, prior=match["record"]["analysis"] if match else None, region=region
+            )
+        
+        # Generate multimodal response
+        with stage("model_call"):
+            response = await self.scheduler.generate(self.vision_models, [prompt, prepared.as_blob()], priority)
+        
+        # Parse structured response
+        with stage("parse"):
+            analysis, parse_mode = self._parse_crop_analysis(response.text)
+        
+        # Add confidence score based on response quality
+        analysis["confidence"] = self._calculate_confidence(response.text, parse_mode)
+        analysis["raw_response"] = response.text
+        if self.media is not None:
+            # Same photo -> same object name, so cached answers keep a valid URL
+            analysis["image_url"] = self.media.put(prepared.data, prepared.mime_type, "images")
+        if match:
+            analysis["near_duplicate"] = self._match_summary(match, reused=False)
+        if parse_mode != "none":
+            # The text fallback is not a diagnosis: the next upload of this photo asks again
+            if features is not None:
+                self._index_analysis(features, analysis)
+            self.cache.set(cache_key, analysis)
+        return analysis
+    
+    @staticmethod
+    def _match_summary(match: Dict[str, Any], reused: bool) -> Dict[str, Any]:
+        return {
+            "reused": reused,
+            "match_row": match["row"],
+            "hamming_distance": match["hamming"],
+            "cosine_similarity": match["cosine"],
+        }
+    
+    def _index_analysis(self, features: Tuple[Any, Any], analysis: Dict[str, Any]):
+        """Append to the near-duplicate index in the background (file I/O off the loop)"""
+        record = {"analysis": {
+            key: value for key, value in analysis.items()
+            if key not in ("raw_response", "near_duplicate", "image_url")
+        }}
+        task = asyncio.create_task(asyncio.to_thread(self.image_index.add, *features, record))
+        self._index_writes.add(task)
+        task.add_done_callback(self._index_writes.discard)
+    
+    def resolve_region(self, location: Optional[Dict]) -> Optional[Region]:
+        if self.regions is None or not location:
+            return None
+        with stage("region_resolve"):
+            return self.regions.resolve_location(location)
+    
+    async def _with_regional_advice(
+        self,
+        analysis: Dict[str, Any],
+        region: Region,
+        priority: int = INTERACTIVE
+    ) -> Dict[str, Any]:
+        """
+        Attach the region and its treatment advice for this crop + disease
+        Advice is cached per district, so an outbreak reported many times
+        from one district reuses the first answer
+        """
+        result = {**analysis, "region": region.as_dict()}
+        disease = self._disease_label(analysis.get("disease_name"))
+        crop = str(analysis.get("crop_type") or "Unknown").strip()
+        if analysis.get("degraded") or disease.lower() in ("unknown", "healthy", "none"):
+            return result
+        
+        key = make_cache_key(
+            f"{crop} {disease}", "", self.model_name, extra={"region": region.key, "prompt": REGIONAL_ADVICE.id}
+        )
+        advice = self.cache.get(key)
+        result["regional_advice_cached"] = advice is not None
+        if advice is None:
+            try:
+                advice = await self.flight.do(
+                    key, lambda: self._generate_regional_advice(key, region, crop, disease, priority)
+                )
+            except Exception as e:
+                # The diagnosis stands on its own; advice comes back on a later request
+                logger.warning(f"Regional advice unavailable for {region.key}: {str(e)}")
+                return result
+        result["regional_advice"] = advice["text"]
+        return result
+    
+    async def _generate_regional_advice(
+        self,
+        key: str,
+        region: Region,
+        crop: str,
+        disease: str,
+        priority: int
+    ) -> Dict[str, Any]:
+        prompt = REGIONAL_ADVICE.render(crop=crop, disease=disease, region=region.prompt_line())
+        with stage("regional_advice"):
+            response = await self.scheduler.generate(self.advice_models, prompt, priority)
+        advice = {"text": response.text.strip()}
+        self.cache.set(key, advice)
+        return advice
+    
+    def summarize_field_analyses(self, analyses: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Field-level view over per-image analyses
+        Majority disease, worst severity and whether anything needs urgent action
+        Degraded placeholders (served while the circuit was open) are not counted
+        """
+        analyses = [analysis for analysis in analyses if not analysis.get("degraded")]
+        diseases = Counter()
+        crops = Counter()
+        worst = None
+        for analysis in analyses:
+            diseases[self._disease_label(analysis.get("disease_name"))] += 1
+            crops[str(analysis.get("crop_type", "Unknown"))] += 1
+            severity = str(analysis.get("severity", "")).strip().capitalize()
+            if severity in SEVERITY_ORDER and (
+                worst is None or SEVERITY_ORDER.index(severity) > SEVERITY_ORDER.index(worst)
+            ):
+                worst = severity
+        
+        majority, majority_count = diseases.most_common(1)[0] if diseases else (None, 0)
+        return {
+            "images_analyzed": len(analyses),
+            "majority_disease": majority,
+            "majority_share": round(majority_count / len(analyses), 2) if analyses else 0.0,
+            "disease_counts": dict(diseases),
+            "crop_counts": dict(crops),
+            "max_severity": worst,
+            "urgent_action_required": any(a.get("urgent_action_required") for a in analyses),
+        }
+    
+    @staticmethod
+    def _disease_label(disease_name: Any) -> str:
+        # The prompt asks for English and Hindi names, which may arrive as a dict
+        if isinstance(disease_name, dict):
+            disease_name = disease_name.get("english") or disease_name.get("en") or next(iter(disease_name.values()), "")
+        return str(disease_name or "Unknown").strip()
+    
+    @staticmethod
+    def _location_key(location: Optional[Dict]) -> Optional[List[float]]:
+        # ~1 km grid so GPS jitter does not defeat the cache
+        if not location:
+            return None
+        return [round(float(location.get('lat', 0)), 2), round(float(location.get('lng', 0)), 2)]
+    
     def _build_crop_analysis_prompt(
         self,
         context: Optional[str],
-        location: Optional[Dict]
+        location: Optional[Dict],
+        prior: Optional[Dict[str, Any]] = None,
+        region: Optional[Region] = None
     ) -> str:
         """
-        Build comprehensive prompt for crop disease analysis
-        Includes Indian agricultural regulations and best practices
+        Variable part of the crop analysis prompt
+        The diagnosis instructions are the vision models' system_instruction
         """
-        base_prompt = """
-You are an expert agricultural AI assistant specializing in Indian farming practices and crop diseases.
-
-Analyze this crop image and provide a comprehensive diagnosis following this structure:
-
-1. **CROP IDENTIFICATION**
-   - Identify the crop type
-   - Growth stage
-   - Overall health assessment
-
-2. **DISEASE/PEST DIAGNOSIS**
-   - Specific disease or pest name (scientific and common name in English and Hindi)
-   - Severity level: Mild / Moderate / Severe / Critical
-   - Affected parts of the plant
-   - Stage of infection
-
-3. **TREATMENT PLAN (Compliant with Indian Agricultural Regulations)**
-   - Organic/natural remedies (first priority)
-   - Chemical pesticides (only if necessary, with proper safety warnings)
-   - Bio-pesticides approved by CIB&RC (Central Insecticides Board & Registration Committee)
-   - Dosage and application method
-   - Safety precautions
-   - Re-entry interval (REI) and pre-harvest interval (PHI)
-
-4. **PREVENTION MEASURES**
-   - Cultural practices
-   - Crop rotation suggestions
-   - Irrigation management
-   - Soil health improvement
-
-5. **REGIONAL CONSIDERATIONS**
-   - Season-specific advice
-   - Local climate factors
-   - Region-specific best practices
-
-**IMPORTANT GUIDELINES:**
-- Prioritize farmer safety and environmental sustainability
-- Follow BIS (Bureau of Indian Standards) guidelines
-- Recommend only legally approved pesticides in India
-- Provide cost-effective solutions for small-scale farmers
-- Include traditional/indigenous practices where applicable
-- Warn against banned pesticides (e.g., Monocrotophos, Methyl Parathion)
-
-Format your response as structured JSON with these keys:
-- crop_type
-- disease_name (in English and Hindi)
-- disease_name_scientific
-- severity
-- symptoms_observed
-- treatment_steps (array)
-- organic_solutions (array)
-- chemical_solutions (array with safety warnings)
-- prevention_tips (array)
-- estimated_recovery_time
-- cost_estimate_inr
-- urgent_action_required (boolean)
-"""
-        
-        if context:
-            base_prompt += f"\n\nADDITIONAL CONTEXT: {context}"
+        if region:
+            # Regional treatment advice is generated separately and cached per district
+            location_line = region.prompt_line()
+        elif location:
+            location_line = (
+                f"Latitude {location.get('lat')}, Longitude {location.get('lng')}; "
+                "give region-specific advice for it"
+            )
+        else:
+            location_line = None
         
-        if location:
-            base_prompt += f"\n\nLOCATION: Latitude {location.get('lat')}, Longitude {location.get('lng')}"
-            base_prompt += "\nProvide region-specific advice based on this location."
+        prior_line = None
+        if prior:
+            prior_line = (
+                f"{self._disease_label(prior.get('disease_name'))} on {prior.get('crop_type', 'unknown crop')} "
+                f"({prior.get('severity', 'unknown')} severity)"
+            )
         
-        return base_prompt
+        return CROP_ANALYSIS.render(context=context, location=location_line, prior=prior_line)
     
-    def _parse_crop_analysis(self, response_text: str) -> Dict[str, Any]:
+    def _parse_crop_analysis(self, response_text: str) -> Tuple[Dict[str, Any], str]:
         """
         Parse Gemini response into structured format
-        Handles both JSON and natural language responses
+        Strict JSON first, then a tolerant parse of fenced/truncated output,
+        then the natural-language fallback; also returns which path was taken
         """
-        try:
-            # Try to extract JSON from response
-            # Gemini may wrap JSON in markdown code blocks
-            if "```json" in response_text:
-                json_start = response_text.find("```json") + 7
-                json_end = response_text.find("```", json_start)
-                json_str = response_text[json_start:json_end].strip()
-                return json.loads(json_str)
-            
-            # If no JSON, attempt to parse as JSON directly
-            return json.loads(response_text)
-            
-        except json.JSONDecodeError:
-            # Fallback: Extract structured data from natural language
-            return self._extract_structured_data(response_text)
+        analysis, mode = parse_crop_analysis(response_text or "")
+        if analysis is not None:
+            return analysis.model_dump(), mode
+        
+        logger.warning("Crop analysis was not parseable JSON, using fallback")
+        return self._extract_structured_data(response_text or ""), mode
     
     def _extract_structured_data(self, text: str) -> Dict[str, Any]:
         """
@@ -236,28 +609,25 @@ Format your response as structured JSON with these keys:
             "estimated_recovery_time": "Unknown",
             "cost_estimate_inr": "Varies",
             "urgent_action_required": False,
-            "note": "Response parsing incomplete. Full text available in raw_response."
+            "note": "Response parsing incomplete. Full text available in raw_response.",
+            # Not a diagnosis: kept out of outbreak analytics
+            "parse_failed": True
         }
     
-    def _calculate_confidence(self, response) -> float:
+    def _calculate_confidence(self, response_text: str, parse_mode: str) -> float:
         """
         Calculate confidence score based on response quality
         """
-        try:
-            # Check for safety ratings and response completeness
-            if not response.text or len(response.text) < 100:
-                return 0.3
-            
-            # Higher confidence for longer, detailed responses
-            length_score = min(len(response.text) / 1000, 0.5)
-            
-            # Check for structured data
-            structure_score = 0.3 if "```json" in response.text else 0.2
-            
-            return min(length_score + structure_score + 0.2, 0.95)
-            
-        except:
-            return 0.5
+        if not response_text or len(response_text) < 100:
+            return 0.3
+        
+        # Higher confidence for longer, detailed responses
+        length_score = min(len(response_text) / 1000, 0.5)
+        
+        # Schema-valid output beats a repaired one beats the text fallback
+        structure_score = {"json": 0.3, "tolerant": 0.2}.get(parse_mode, 0.1)
+        
+        return min(length_score + structure_score + 0.2, 0.95)
     
     async def process_agricultural_query(
         self,
@@ -270,57 +640,153 @@ Format your response as structured JSON with these keys:
         Handles voice transcription results
         """
         try:
-            # Build context-aware prompt
-            prompt = f"""
-You are a knowledgeable agricultural expert assistant for Indian farmers.
-
-User Query: {query}
-Query Language: {language}
-
-Provide practical, actionable advice considering:
-- Indian agricultural practices and regulations
-- Cost-effectiveness for small farmers
-- Regional climate and soil conditions
-- Seasonal factors
-- Traditional knowledge integration
-
-Respond in a conversational, farmer-friendly tone.
-Include specific steps, measurements, and timelines.
-Warn about safety precautions where applicable.
-
-If you recommend any chemicals or fertilizers, ensure they are:
-1. Approved by Indian authorities (CIB&RC, FSSAI)
-2. Readily available in rural markets
-3. Within the economic reach of small farmers
-"""
+            local = self.router.timed_answer(query, language)
+            if local is not None:
+                return {
+                    "response_text": local.answer,
+                    "query_category": local.category,
+                    "confidence": local.confidence,
+                    "follow_up_suggestions": self._generate_follow_ups(query),
+                    "source": "faq"
+                }
+            
+            started = time.perf_counter()
+            prompt = self._build_query_prompt(query, language)
             
-            response = self.model.generate_content(prompt)
+            with stage("model_call"):
+                response = await self.scheduler.generate(self.text_models, prompt)
+            self.router.stats.record("gemini", (time.perf_counter() - started) * 1000)
             
             return {
                 "response_text": response.text,
                 "query_category": self._categorize_query(query),
                 "confidence": 0.85,
-                "follow_up_suggestions": self._generate_follow_ups(query)
+                "follow_up_suggestions": self._generate_follow_ups(query),
+                "source": "gemini"
             }
             
+        except CircuitOpenError:
+            degraded = self.degraded_answer(query)
+            return {
+                "response_text": degraded["answer"],
+                "query_category": self._categorize_query(query),
+                "confidence": 0.0,
+                "follow_up_suggestions": [],
+                "source": "degraded"
+            }
         except Exception as e:
             logger.error(f"Query processing error: {str(e)}")
             raise
     
+    async def process_voice_query(
+        self,
+        audio: Dict[str, Any],
+        language_hint: Optional[str] = None,
+        text: Optional[str] = None,
+        priority: int = INTERACTIVE
+    ) -> Dict[str, Any]:
+        """
+        Transcribe and answer a spoken question in a single Gemini call
+        audio is an inline {"mime_type", "data"} blob, already transcoded
+        """
+        try:
+            with stage("model_call"):
+                response = await self.scheduler.generate(
+                    self.voice_models,
+                    [self._build_voice_prompt(language_hint, text), audio],
+                    priority
+                )
+        except CircuitOpenError:
+            degraded = self.degraded_answer()
+            return {
+                "transcript": "",
+                "language": language_hint or "en",
+                "transcript_confidence": 0.0,
+                "answer": DEGRADED_ANSWERS.get(language_hint, degraded["answer"]),
+                "source": "degraded",
+                "degraded": True,
+            }
+
+        with stage("parse"):
+            data = None
+            try:
+                data = json.loads(response.text)
+            except (json.JSONDecodeError, ValueError):
+                data = parse_partial_json(response.text)
+            if not isinstance(data, dict):
+                data = {"answer": response.text}
+
+        transcript = str(data.get("transcript") or "").strip()
+        language = str(data.get("language") or "").strip().lower() or (
+            guess_language(transcript) if transcript else (language_hint or "en")
+        )
+        try:
+            confidence = min(max(float(data.get("transcript_confidence", 0.8)), 0.0), 1.0)
+        except (TypeError, ValueError):
+            confidence = 0.8
+        return {
+            "transcript": transcript,
+            "language": language,
+            "transcript_confidence": confidence,
+            "answer": str(data.get("answer") or "").strip(),
+            "query_category": self._categorize_query(transcript) if transcript else "general",
+            "source": "gemini",
+        }
+    
+    def _build_voice_prompt(self, language_hint: Optional[str], text: Optional[str]) -> str:
+        """Variable lines sent alongside the audio part"""
+        return VOICE.render(language_hint=language_hint, text=text)
+    
+    def _build_query_prompt(self, query: str, language: str) -> str:
+        """Variable part of a text query; the guidelines are the text models' system_instruction"""
+        return QUERY.render(query=query, language=language)
+    
+    async def stream_agricultural_query(
+        self,
+        query: str,
+        language: str,
+        user_context: Optional[Dict] = None
+    ) -> AsyncIterator[str]:
+        """
+        Incremental variant of process_agricultural_query
+        Yields text chunks as Gemini produces them
+        """
+        prompt = self._build_query_prompt(query, language)
+        async for chunk in self._stream(self.text_models, prompt):
+            yield chunk
+    
+    async def stream_answer(self, prompt_parts: List[Any]) -> AsyncIterator[str]:
+        """Incremental variant of generate_answer"""
+        async for chunk in self._stream(self.chat_models, prompt_parts):
+            yield chunk
+    
+    async def _stream(self, models: List[Any], contents) -> AsyncIterator[str]:
+        # The in-flight slot is held until the last chunk has arrived; retries
+        # and fallback only apply before the first chunk
+        started = time.perf_counter()
+        async with self.scheduler.session(models, contents, stream=True) as lease:
+            first_chunk = None
+            last = None
+            async for chunk in lease.response:
+                last = chunk
+                try:
+                    text = chunk.text
+                except ValueError:
+                    # Chunks carrying only safety/finish metadata have no text
+                    continue
+                if text:
+                    if first_chunk is None:
+                        first_chunk = time.perf_counter() - started
+                        GEMINI_TTFT_SECONDS.observe(first_chunk, lease.model_name)
+                        record_stage("model_ttft", first_chunk)
+                    yield text
+            record_stage("model_call", time.perf_counter() - started)
+            # The final chunk carries usage_metadata for the whole stream
+            lease.settle(last)
+    
     def _categorize_query(self, query: str) -> str:
         """Categorize the type of agricultural query"""
-        query_lower = query.lower()
-        
-        if any(word in query_lower for word in ["disease", "pest", "infection"]):
-            return "disease_diagnosis"
-        elif any(word in query_lower for word in ["fertilizer", "nutrient", "soil"]):
-            return "soil_nutrition"
-        elif any(word in query_lower for word in ["weather", "rain", "season"]):
-            return "weather_related"
-        elif any(word in query_lower for word in ["price", "market", "sell"]):
-            return "market_info"
-        else:
-            return "general_farming"
+        return self.router.categorize(query)
     
     def _generate_follow_ups(self, query: str) -> List[str]:
         """Generate relevant follow-up questions"""
@@ -354,11 +820,18 @@ If you recommend any chemicals or fertilizers, ensure they are:
         Format analysis for text-to-speech output
         Makes it more conversational and less technical
         """
+        return "".join(self.iter_speech_segments(analysis))
+    
+    def iter_speech_segments(self, analysis: Dict) -> Iterator[str]:
+        """
+        Incremental variant of format_analysis_for_speech
+        Yields one speakable segment at a time so TTS can start on the first
+        """
         crop = analysis.get("crop_type", "your crop")
         disease = analysis.get("disease_name", "a problem")
         severity = analysis.get("severity", "moderate")
         
-        speech_text = f"""
+        yield f"""
 Your {crop} appears to have {disease}. The severity is {severity}.
 
 Here's what you need to do:
@@ -367,15 +840,17 @@ Here's what you need to do:
         
         # Add treatment steps
         for i, step in enumerate(analysis.get("treatment_steps", [])[:3], 1):
-            speech_text += f"{i}. {step}\n"
+            yield f"{i}. {step}\n"
         
-        speech_text += "\nFor best results, follow these steps carefully. "
+        yield "\nFor best results, follow these steps carefully. "
         
         if analysis.get("urgent_action_required"):
-            speech_text += "This requires immediate attention. "
-        
-        return speech_text
+            yield "This requires immediate attention. "
     
     def is_healthy(self) -> bool:
         """Health check"""
-        return self.model is not None and self.vision_model is not None
+        return (
+            self.model is not None
+            and self.vision_model is not None
+            and self.chat_model is not None
+        )
@@ -0,0 +1,37 @@
+"""
+gunicorn.conf.py
+Multi-worker serving: gunicorn -c gunicorn.conf.py main:app
+The app (FastAPI, the Gemini and Firebase SDKs, Pillow, NumPy) is imported
+once in the master and forked, so workers start warm and share those pages
+copy-on-write. Clients, thread pools and SQLite connections are only created
+in the app lifespan, after the fork; what workers must agree on (response
+cache, Gemini quotas, in-flight calls, history invalidation) goes through the
+SQLite files described in shared_state.py.
+"""
+
+import os
+
+from shared_state import available_cpus
+
+# Async workers each drive many requests; one per usable core is enough
+workers = int(os.getenv("WEB_CONCURRENCY") or available_cpus())
+# Workers inherit this and switch to the shared backends
+os.environ["WEB_CONCURRENCY"] = str(workers)
+
+try:
+    import uvicorn_worker  # noqa: F401
+    worker_class = "uvicorn_worker.UvicornWorker"
+except ImportError:
+    worker_class = "uvicorn.workers.UvicornWorker"
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+preload_app = True
+# A streamed crop analysis can hold a request for most of a minute
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+# Room for the lifespan to flush queued Firestore writes on shutdown
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", "5"))
+
+
+def on_starting(server):
+    server.log.info(f"Starting {workers} {worker_class} workers ({available_cpus()} CPUs available)")
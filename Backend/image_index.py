@@ -0,0 +1,234 @@
+"""
+image_index.py
+Near-duplicate index over previously diagnosed crop photos
+A 64-bit DCT perceptual hash plus a colour/texture histogram per image, kept in
+memory-mapped NumPy arrays and searched with vectorized Hamming / cosine distance
+"""
+
+import io
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+HASH_BYTES = 8
+# 8 hue x 4 saturation x 4 value colour bins + 16 gradient-orientation texture bins
+COLOR_BINS = (8, 4, 4)
+TEXTURE_BINS = 16
+EMBEDDING_DIM = COLOR_BINS[0] * COLOR_BINS[1] * COLOR_BINS[2] + TEXTURE_BINS
+
+_THUMB_SIDE = 64
+_HASH_SIDE = 32
+
+
+def _dct_matrix(n: int):
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    matrix[0] /= np.sqrt(2.0)
+    return matrix
+
+
+_DCT = _dct_matrix(_HASH_SIDE) if np is not None else None
+# Set bits per byte value, for vectorized popcount
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8) if np is not None else None
+
+
+def image_features(data: bytes) -> Tuple[Any, Any]:
+    """
+    (hash as 8 uint8, L2-normalised float32 embedding) of an encoded image
+    CPU-bound; run it in the preprocess pool
+    """
+    image = Image.open(io.BytesIO(data))
+    # JPEG can decode straight at 1/2..1/8 scale, far cheaper than full size
+    image.draft("RGB", (_THUMB_SIDE * 2, _THUMB_SIDE * 2))
+    image = image.convert("RGB")
+
+    # pHash: low-frequency DCT coefficients above / below their median
+    gray = np.asarray(image.convert("L").resize((_HASH_SIDE, _HASH_SIDE), Image.BILINEAR), dtype=np.float32)
+    dct = _DCT @ gray @ _DCT.T
+    low = dct[:8, :8].flatten()[1:]  # the DC term only tracks brightness
+    bits = np.append(low > np.median(low), False)
+    phash = np.packbits(bits)
+
+    # Colour: joint HSV histogram survives recompression and small crops/rotations
+    thumb = image.resize((_THUMB_SIDE, _THUMB_SIDE), Image.BILINEAR)
+    hsv = np.asarray(thumb.convert("HSV"), dtype=np.uint16).reshape(-1, 3)
+    h = hsv[:, 0] * COLOR_BINS[0] // 256
+    s = hsv[:, 1] * COLOR_BINS[1] // 256
+    v = hsv[:, 2] * COLOR_BINS[2] // 256
+    color = np.bincount((h * COLOR_BINS[1] + s) * COLOR_BINS[2] + v, minlength=EMBEDDING_DIM - TEXTURE_BINS)
+
+    # Texture: gradient orientations weighted by magnitude (lesion edges, leaf veins)
+    small = np.asarray(thumb.convert("L"), dtype=np.float32)
+    gy, gx = np.gradient(small)
+    magnitude = np.hypot(gx, gy).ravel()
+    orientation = ((np.arctan2(gy, gx).ravel() + np.pi) / (2 * np.pi) * TEXTURE_BINS).astype(np.int64) % TEXTURE_BINS
+    texture = np.bincount(orientation, weights=magnitude, minlength=TEXTURE_BINS)
+
+    color = color / max(color.sum(), 1)
+    texture = texture / max(texture.sum(), 1e-9)
+    embedding = np.concatenate([color, texture]).astype(np.float32)
+    embedding /= max(float(np.linalg.norm(embedding)), 1e-9)
+    return phash, embedding
+
+
+class ImageIndex:
+    """
+    Append-only index persisted as three files next to `path`:
+    .hash (N x 8 uint8 memmap), .emb (N x D float32 memmap) and .meta.jsonl
+    (one diagnosis per row). A row counts once its metadata line is written,
+    so a crash mid-insert leaves at most an unused vector slot behind.
+
+    Several worker processes may share the files: appends hold an flock on the
+    metadata file, and every call first picks up rows other workers added.
+    """
+
+    def __init__(self, path: str = "image_index", initial_capacity: int = 1024):
+        self.path = path
+        self._lock = threading.Lock()
+        self._meta: List[Dict[str, Any]] = []
+        self._meta_offset = 0
+        self._meta_file = open(f"{path}.meta.jsonl", "a+b")
+        self._read_new_rows()
+        capacity = max(initial_capacity, len(self._meta))
+        self._hashes = self._open(f"{path}.hash", np.uint8, HASH_BYTES, capacity)
+        self._embeddings = self._open(f"{path}.emb", np.float32, EMBEDDING_DIM, capacity)
+        capacity = min(len(self._hashes), len(self._embeddings))
+        if len(self._meta) > capacity:
+            self._meta = self._meta[:capacity]
+        self.searches = 0
+        self.matches = 0
+
+    @classmethod
+    def from_env(cls) -> Optional["ImageIndex"]:
+        """IMAGE_INDEX_PATH (default image_index); IMAGE_INDEX=0 or missing NumPy disables it"""
+        if np is None:
+            logger.warning("NumPy not installed, near-duplicate image index disabled")
+            return None
+        if os.getenv("IMAGE_INDEX", "1") == "0":
+            return None
+        try:
+            return cls(os.getenv("IMAGE_INDEX_PATH", "image_index"))
+        except OSError as e:
+            logger.warning(f"Image index unavailable: {str(e)}")
+            return None
+
+    @staticmethod
+    def _open(path: str, dtype, width: int, rows: int):
+        """Memory-map `path`, growing the file to at least `rows` rows"""
+        row_bytes = np.dtype(dtype).itemsize * width
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size < rows * row_bytes:
+            with open(path, "ab") as f:
+                f.truncate(rows * row_bytes)
+            size = rows * row_bytes
+        return np.memmap(path, dtype=dtype, mode="r+", shape=(size // row_bytes, width))
+
+    def __len__(self) -> int:
+        return len(self._meta)
+
+    def _read_new_rows(self):
+        """Load metadata lines appended since the last read, by this or another process"""
+        if os.fstat(self._meta_file.fileno()).st_size <= self._meta_offset:
+            return
+        self._meta_file.seek(self._meta_offset)
+        for line in self._meta_file:
+            if not line.endswith(b"\n"):
+                break  # torn or still being written
+            try:
+                self._meta.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+            self._meta_offset += len(line)
+
+    def _sync(self):
+        """Catch up with other workers, remapping if they grew the vector files"""
+        self._read_new_rows()
+        if len(self._meta) > min(len(self._hashes), len(self._embeddings)):
+            self._hashes = self._open(f"{self.path}.hash", np.uint8, HASH_BYTES, len(self._meta))
+            self._embeddings = self._open(f"{self.path}.emb", np.float32, EMBEDDING_DIM, len(self._meta))
+
+    def add(self, phash, embedding, record: Dict[str, Any]) -> int:
+        """Append one image; blocking file I/O, call via asyncio.to_thread"""
+        with self._lock:
+            if fcntl is not None:
+                fcntl.flock(self._meta_file.fileno(), fcntl.LOCK_EX)
+            try:
+                self._sync()
+                row = len(self._meta)
+                if row >= len(self._hashes):
+                    # Double the backing files; old rows stay where they are
+                    self._hashes.flush()
+                    self._embeddings.flush()
+                    self._hashes = self._open(f"{self.path}.hash", np.uint8, HASH_BYTES, row * 2)
+                    self._embeddings = self._open(f"{self.path}.emb", np.float32, EMBEDDING_DIM, row * 2)
+                self._hashes[row] = phash
+                self._embeddings[row] = embedding
+                self._hashes.flush()
+                self._embeddings.flush()
+                line = (json.dumps(record, ensure_ascii=False, default=str) + "\n").encode("utf-8")
+                self._meta_file.seek(0, os.SEEK_END)
+                self._meta_file.write(line)
+                self._meta_file.flush()
+                self._meta.append(record)
+                self._meta_offset += len(line)
+                return row
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._meta_file.fileno(), fcntl.LOCK_UN)
+
+    def search(self, phash, embedding, max_hamming: int, min_cosine: float) -> Optional[Dict[str, Any]]:
+        """
+        Closest stored image within both thresholds, or None
+        One XOR + popcount and one matrix-vector product over all rows
+        """
+        with self._lock:
+            self._sync()
+            count = len(self._meta)
+            self.searches += 1
+            if count == 0:
+                return None
+            hamming = _POPCOUNT[np.bitwise_xor(self._hashes[:count], phash)].sum(axis=1, dtype=np.int32)
+            cosine = self._embeddings[:count] @ embedding
+            candidates = np.flatnonzero((hamming <= max_hamming) & (cosine >= min_cosine))
+            if candidates.size == 0:
+                return None
+            # Fewest differing hash bits first, colour similarity breaks ties
+            best = candidates[np.lexsort((-cosine[candidates], hamming[candidates]))[0]]
+            self.matches += 1
+            return {
+                "row": int(best),
+                "hamming": int(hamming[best]),
+                "cosine": round(float(cosine[best]), 4),
+                "record": self._meta[best],
+            }
+
+    def close(self):
+        with self._lock:
+            self._hashes.flush()
+            self._embeddings.flush()
+            self._meta_file.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._meta),
+            "capacity": len(self._hashes),
+            "searches": self.searches,
+            "matches": self.matches,
+        }
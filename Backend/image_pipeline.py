@@ -0,0 +1,217 @@
+"""
+image_pipeline.py
+Upload capping and image preprocessing before anything is sent to Gemini
+Phone photos are decoded straight to a small target size and re-encoded compactly
+"""
+
+import io
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, Optional
+
+from PIL import Image, ImageOps
+from starlette.responses import JSONResponse
+
+from shared_state import available_cpus, worker_count
+
+logger = logging.getLogger(__name__)
+
+MAX_UPLOAD_BYTES = int(os.getenv("IMAGE_MAX_UPLOAD_BYTES", str(15 * 1024 * 1024)))
+MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "1024"))
+OUTPUT_FORMAT = os.getenv("IMAGE_OUTPUT_FORMAT", "JPEG").upper()
+OUTPUT_QUALITY = int(os.getenv("IMAGE_OUTPUT_QUALITY", "80"))
+MAX_OUTPUT_BYTES = int(os.getenv("IMAGE_MAX_OUTPUT_BYTES", str(300 * 1024)))
+
+# Boundaries, part headers and the small text fields around the file parts
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+_CHUNK_SIZE = 64 * 1024
+
+_pool: Optional[ThreadPoolExecutor] = None
+
+
+def get_preprocess_pool() -> ThreadPoolExecutor:
+    """
+    Shared worker pool for image decoding (IMAGE_WORKERS, default this process's share of the cores)
+    Pillow releases the GIL while decoding and resampling, so threads run in parallel
+    """
+    global _pool
+    if _pool is None:
+        default = max(available_cpus() // worker_count(), 1)
+        workers = int(os.getenv("IMAGE_WORKERS", str(default)))
+        _pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="image-preprocess")
+    return _pool
+
+
+class UploadTooLargeError(Exception):
+    """Raised when an upload exceeds the configured byte limit"""
+
+    def __init__(self, limit: int):
+        super().__init__(f"Upload exceeds {limit / (1024 * 1024):.1f} MB limit")
+        self.limit = limit
+
+
+class UploadLimitMiddleware:
+    """
+    Pure ASGI check of Content-Length against a per-path body limit
+    Runs before the form is parsed, so an oversized upload is refused without
+    being spooled. Chunked bodies carry no length and are only caught later by
+    read_upload_limited
+    """
+
+    def __init__(self, app, limits: Dict[str, int]):
+        self.app = app
+        self.limits = limits
+
+    async def __call__(self, scope, receive, send):
+        limit = self.limits.get(scope["path"]) if scope["type"] == "http" else None
+        if limit is not None:
+            length = _content_length(scope["headers"])
+            if length is not None and length > limit:
+                logger.warning(f"Refused {length} byte body for {scope['path']} (limit {limit})")
+                error = UploadTooLargeError(limit)
+                response = JSONResponse(status_code=413, content={"answer": f"Error: {str(error)}"})
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+def _content_length(headers) -> Optional[int]:
+    for name, value in headers:
+        if name == b"content-length":
+            try:
+                return int(value)
+            except ValueError:
+                return None
+    return None
+
+
+@dataclass
+class PreparedImage:
+    """Re-encoded image plus the numbers needed to judge the pipeline"""
+    data: bytes
+    mime_type: str
+    width: int
+    height: int
+    original_width: int
+    original_height: int
+    bytes_in: int
+    bytes_out: int
+    decoded_pixels: int
+    elapsed_ms: float
+    # Computed from buffer sizes, not measured: Pillow allocates pixel memory
+    # outside Python's allocator, so tracemalloc would not see it either
+    estimated_peak_kb: int
+
+    def as_blob(self) -> Dict[str, Any]:
+        """Inline part accepted by generate_content"""
+        return {"mime_type": self.mime_type, "data": self.data}
+
+    def stats(self) -> Dict[str, Any]:
+        stats = asdict(self)
+        stats.pop("data")
+        return stats
+
+
+def _buffer_bytes(image: Image.Image) -> int:
+    # Pillow stores 1 byte per pixel for 1/L/P, 2 for 16-bit, 4 for everything else (RGB is padded)
+    if image.mode in ("1", "L", "P"):
+        pixel = 1
+    elif image.mode.startswith("I;16"):
+        pixel = 2
+    else:
+        pixel = 4
+    return image.width * image.height * pixel
+
+
+async def read_upload_limited(upload, max_bytes: int = MAX_UPLOAD_BYTES) -> bytes:
+    """
+    Read an UploadFile in chunks, failing as soon as it passes max_bytes
+    Starlette has already spooled the multipart body by now, so this bounds
+    decode memory only; UploadLimitMiddleware rejects oversized bodies up front
+    """
+    buffer = bytearray()
+    while True:
+        chunk = await upload.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        buffer.extend(chunk)
+        if len(buffer) > max_bytes:
+            raise UploadTooLargeError(max_bytes)
+    return bytes(buffer)
+
+
+def preprocess_image(
+    image_data: bytes,
+    max_side: int = MAX_SIDE,
+    output_format: str = OUTPUT_FORMAT,
+    quality: int = OUTPUT_QUALITY,
+    max_output_bytes: int = MAX_OUTPUT_BYTES
+) -> PreparedImage:
+    """
+    Decode at reduced resolution, fix orientation, drop metadata and re-encode
+    CPU-bound: call through asyncio.to_thread or an executor
+    """
+    started = time.perf_counter()
+
+    image = Image.open(io.BytesIO(image_data))
+    original_width, original_height = image.size
+
+    # JPEG can decode at 1/2, 1/4 or 1/8 scale directly (DCT scaling),
+    # so a 12 MP photo never materializes at full size. The box keeps the photo's
+    # aspect: draft() only scales while both sides stay at or above it, so a
+    # square box would never shrink a 3:2 photo
+    if image.format == "JPEG":
+        scale = max_side / max(original_width, original_height)
+        image.draft("RGB", (max(round(original_width * scale), 1), max(round(original_height * scale), 1)))
+
+    # Applies and removes the EXIF orientation tag
+    image = ImageOps.exif_transpose(image)
+    # Pixels actually decoded (after draft scaling), the per-request memory driver
+    decoded_pixels = image.width * image.height
+    # Estimated high-water mark for this request: the upload plus the pixel
+    # buffers alive at once at each step. Process RSS would mix in every other thread
+    peak = len(image_data) + _buffer_bytes(image)
+
+    if max(image.size) > max_side:
+        decoded = _buffer_bytes(image)
+        # reducing_gap lets Pillow use the cheap reduce() box filter first
+        image.thumbnail((max_side, max_side), Image.LANCZOS, reducing_gap=2.0)
+        peak = max(peak, len(image_data) + decoded + _buffer_bytes(image))
+
+    if image.mode != "RGB":
+        converted = image.convert("RGB")
+        peak = max(peak, len(image_data) + _buffer_bytes(image) + _buffer_bytes(converted))
+        image = converted
+
+    if output_format not in _MIME_TYPES:
+        output_format = "JPEG"
+
+    # Step quality down until the payload fits; metadata is never written
+    data = b""
+    for attempt_quality in range(quality, 29, -10):
+        out = io.BytesIO()
+        image.save(out, format=output_format, quality=attempt_quality, optimize=True)
+        data = out.getvalue()
+        # Encoder buffer and its copy next to the pixels
+        peak = max(peak, len(image_data) + _buffer_bytes(image) + 2 * len(data))
+        if len(data) <= max_output_bytes:
+            break
+
+    return PreparedImage(
+        data=data,
+        mime_type=_MIME_TYPES[output_format],
+        width=image.width,
+        height=image.height,
+        original_width=original_width,
+        original_height=original_height,
+        bytes_in=len(image_data),
+        bytes_out=len(data),
+        decoded_pixels=decoded_pixels,
+        elapsed_ms=round((time.perf_counter() - started) * 1000, 2),
+        estimated_peak_kb=peak // 1024,
+    )
@@ -0,0 +1,332 @@
+"""
+intent_router.py
+Local routing tier that runs before any Gemini call
+Multilingual keyword automaton for intent + BM25 over a curated FAQ
+"""
+
+import json
+import logging
+import math
+import os
+import re
+import time
+from collections import Counter, defaultdict, deque
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from response_cache import normalize_query_text
+
+logger = logging.getLogger(__name__)
+
+FAQ_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "faq.json")
+
+# Keywords per intent in English, Hindi, Marathi, Tamil, Punjabi, Malayalam
+# and common romanized spellings. Order of categories is the tie-break order.
+INTENT_KEYWORDS: Dict[str, List[str]] = {
+    "disease_diagnosis": [
+        "disease", "pest", "infection", "fungus", "blight", "insect", "wilt", "rot", "virus",
+        "रोग", "बीमारी", "कीट", "कीड़ा", "फफूंद", "संक्रमण",          # Hindi
+        "कीड", "कीटक", "बुरशी",                                      # Marathi
+        "நோய்", "பூச்சி", "பூஞ்சை",                                   # Tamil
+        "ਰੋਗ", "ਬਿਮਾਰੀ", "ਕੀੜਾ", "ਕੀੜੇ",                              # Punjabi
+        "രോഗം", "കീടം", "പുഴു",                                      # Malayalam
+        "bimari", "beemari", "rog", "keeda", "kida", "keet", "phaphund", "rogam", "poochi",
+    ],
+    "soil_nutrition": [
+        "fertilizer", "fertiliser", "nutrient", "soil", "manure", "compost", "urea", "npk", "potash",
+        "खाद", "उर्वरक", "मिट्टी", "यूरिया",
+        "खत", "माती",
+        "உரம்", "மண்",
+        "ਖਾਦ", "ਮਿੱਟੀ",
+        "വളം", "മണ്ണ്",
+        "khaad", "khad", "mitti", "urvarak", "khat", "maati", "uram", "valam",
+    ],
+    "weather_related": [
+        "weather", "rain", "season", "monsoon", "drought", "frost", "temperature",
+        "मौसम", "बारिश", "वर्षा", "मानसून", "सूखा",
+        "हवामान", "पाऊस",
+        "வானிலை", "மழை",
+        "ਮੌਸਮ", "ਮੀਂਹ", "ਬਾਰਿਸ਼",
+        "കാലാവസ്ഥ", "മഴ",
+        "mausam", "barish", "baarish", "varsha", "paus", "mazhai", "mazha", "meenh",
+    ],
+    "market_info": [
+        "price", "market", "sell", "mandi", "msp",
+        "भाव", "मंडी", "कीमत", "दाम", "बेचना",
+        "बाजार", "किंमत",
+        "விலை", "சந்தை",
+        "ਭਾਅ", "ਮੰਡੀ", "ਕੀਮਤ",
+        "വില", "ചന്ത",
+        "bhav", "bhaav", "daam", "keemat", "kimat", "vilai", "vila",
+    ],
+}
+
+# Word characters plus the Indic blocks (U+0900-U+0DFF), whose vowel signs
+# are combining marks that \w alone would split on
+_TOKEN = re.compile(r"[\w\u0900-\u0DFF]+")
+_STOPWORDS = {
+    "a", "an", "the", "is", "are", "to", "of", "for", "in", "on", "my", "i", "how", "what",
+    "do", "does", "can", "me", "and", "or", "with", "it", "this", "be", "kaise", "kya", "hai",
+    "ka", "ki", "ke", "ko", "se", "par", "में", "का", "की", "के", "को", "से", "है", "क्या", "कैसे",
+    "पर", "और",
+}
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _TOKEN.findall(normalize_query_text(text)) if t not in _STOPWORDS]
+
+
+# Function words that mark romanized Hindi ("mandi bhav kaise dekhe")
+_ROMANIZED_HINDI = {"kaise", "kya", "hai", "mein", "kab", "kare", "karen", "kaun", "kitna", "aur", "ka", "ki", "ke"}
+
+
+def guess_language(text: str) -> str:
+    """
+    Script-level guess used when the caller gives no language
+    Romanized Hindi gets its own code so it is never answered in plain English
+    """
+    for ch in text:
+        code = ord(ch)
+        if 0x0900 <= code <= 0x097F:
+            return "hi"
+        if 0x0A00 <= code <= 0x0A7F:
+            return "pa"
+        if 0x0B80 <= code <= 0x0BFF:
+            return "ta"
+        if 0x0D00 <= code <= 0x0D7F:
+            return "ml"
+    if _ROMANIZED_HINDI & set(normalize_query_text(text).split()):
+        return "hi-latn"
+    return "en"
+
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick automaton: one pass over the query finds every keyword
+    Latin keywords must start on a word boundary; Indic keywords may match
+    inside a word because suffixes attach directly (e.g. நோய்கள்)
+    """
+
+    def __init__(self, keywords: Dict[str, Iterable[str]]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[List[Tuple[str, int, bool]]] = [[]]
+        for label, words in keywords.items():
+            for word in words:
+                self._add(normalize_query_text(word), label)
+        self._build_links()
+
+    def _add(self, word: str, label: str):
+        node = 0
+        for ch in word:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append([])
+            node = nxt
+        self._out[node].append((label, len(word), word.isascii()))
+
+    def _build_links(self):
+        # Breadth-first so every fail target is finished before it is used
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in self._goto[node].items():
+                queue.append(nxt)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                target = self._goto[fail].get(ch, 0)
+                self._fail[nxt] = target if target != nxt else 0
+                self._out[nxt] = self._out[nxt] + self._out[self._fail[nxt]]
+
+    def match(self, text: str) -> Counter:
+        """Count keyword hits per label"""
+        hits = Counter()
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in self._goto[node]:
+                node = self._fail[node]
+            node = self._goto[node].get(ch, 0)
+            for label, length, ascii_word in self._out[node]:
+                start = i - length + 1
+                if ascii_word and start > 0 and text[start - 1].isalnum():
+                    continue
+                hits[label] += 1
+        return hits
+
+
+class BM25Index:
+    """Okapi BM25 over short documents; small enough to score exhaustively"""
+
+    def __init__(self, documents: List[List[str]], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_freqs = [Counter(doc) for doc in documents]
+        self.doc_lengths = [len(doc) for doc in documents]
+        self.avg_length = sum(self.doc_lengths) / len(documents) if documents else 0.0
+        df = Counter(term for doc in documents for term in set(doc))
+        n = len(documents)
+        self.idf = {term: math.log(1 + (n - freq + 0.5) / (freq + 0.5)) for term, freq in df.items()}
+        self.postings: Dict[str, List[int]] = defaultdict(list)
+        for doc_id, freqs in enumerate(self.doc_freqs):
+            for term in freqs:
+                self.postings[term].append(doc_id)
+
+    def search(self, terms: List[str], top_k: int = 2) -> List[Tuple[int, float]]:
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(terms):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for doc_id in self.postings[term]:
+                tf = self.doc_freqs[doc_id][term]
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / self.avg_length)
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+
+
+@dataclass
+class LocalAnswer:
+    answer: str
+    category: str
+    confidence: float
+    faq_id: str
+    language: str
+
+
+class TierStats:
+    """Per-tier request counts and latency"""
+
+    def __init__(self):
+        self._count: Counter = Counter()
+        self._total_ms: Counter = Counter()
+
+    def record(self, tier: str, elapsed_ms: float):
+        self._count[tier] += 1
+        self._total_ms[tier] += elapsed_ms
+
+    def snapshot(self) -> Dict[str, Any]:
+        total = sum(self._count.values())
+        return {
+            "requests": total,
+            "tiers": {
+                tier: {
+                    "count": count,
+                    "share": round(count / total, 4),
+                    "avg_ms": round(self._total_ms[tier] / count, 3),
+                }
+                for tier, count in self._count.items()
+            },
+        }
+
+
+class IntentRouter:
+    """
+    Categorizes queries and answers high-confidence FAQ matches locally
+    Everything else falls through to Gemini
+    """
+
+    def __init__(
+        self,
+        faq: List[Dict[str, Any]],
+        min_score: float = 4.0,
+        min_coverage: float = 0.7,
+        min_margin: float = 1.3
+    ):
+        self.min_score = min_score
+        self.min_coverage = min_coverage
+        self.min_margin = min_margin
+        self.automaton = KeywordAutomaton(INTENT_KEYWORDS)
+        self.stats = TierStats()
+
+        # One BM25 document per phrasing, each pointing back to its FAQ entry
+        self._entries = faq
+        self._doc_entry: List[int] = []
+        documents = []
+        for entry_id, entry in enumerate(faq):
+            for question in entry["questions"]:
+                documents.append(tokenize(question))
+                self._doc_entry.append(entry_id)
+        self.index = BM25Index(documents)
+
+    @classmethod
+    def load_default(cls, crop_knowledge_base: Optional[Dict[str, Any]] = None) -> "IntentRouter":
+        """Bundled FAQ plus region entries derived from GeminiService.crop_knowledge_base"""
+        faq: List[Dict[str, Any]] = []
+        try:
+            with open(FAQ_PATH, encoding="utf-8") as f:
+                faq = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"FAQ unavailable, local answers disabled: {str(e)}")
+
+        for region, crops in ((crop_knowledge_base or {}).get("regions") or {}).items():
+            name = region.replace("_", " ")
+            faq.append({
+                "id": f"region_crops_{region}",
+                "category": "general_farming",
+                "questions": [f"which crops grow in {name}", f"main crops of {name}"],
+                "answers": {"en": f"The major crops of {name.title()} are {', '.join(crops)}."},
+            })
+
+        return cls(
+            faq,
+            min_score=float(os.getenv("ROUTER_MIN_SCORE", "4.0")),
+            min_coverage=float(os.getenv("ROUTER_MIN_COVERAGE", "0.7")),
+        )
+
+    def categorize(self, query: str) -> str:
+        hits = self.automaton.match(normalize_query_text(query))
+        if not hits:
+            return "general_farming"
+        # Ties resolve in INTENT_KEYWORDS order, like the old if/elif chain
+        best = max(hits.values())
+        return next(label for label in INTENT_KEYWORDS if hits.get(label) == best)
+
+    def answer(self, query: str, language: Optional[str] = None) -> Optional[LocalAnswer]:
+        """A curated answer when the match is unambiguous and exists in the user's language"""
+        terms = tokenize(query)
+        if not terms or not self._entries:
+            return None
+
+        results = self.index.search(terms, top_k=8)
+        if not results:
+            return None
+        best_doc, best_score = results[0]
+        best_entry = self._doc_entry[best_doc]
+        # Runner-up must come from a different FAQ entry to count as competition
+        runner_up = next((score for doc, score in results[1:] if self._doc_entry[doc] != best_entry), 0.0)
+
+        matched = set(self.index.doc_freqs[best_doc])
+        coverage = sum(1 for t in terms if t in matched) / len(terms)
+        if best_score < self.min_score or coverage < self.min_coverage:
+            return None
+        if runner_up and best_score / runner_up < self.min_margin:
+            return None
+
+        entry = self._entries[best_entry]
+        language = language.lower() if language else guess_language(query)
+        # hi-latn -> hi, en-in -> en: the script the user reads beats an English answer
+        language = next((key for key in (language, language.split("-")[0]) if key in entry["answers"]), None)
+        if language is None:
+            return None
+        text = entry["answers"][language]
+
+        return LocalAnswer(
+            answer=text,
+            category=entry.get("category", "general_farming"),
+            confidence=round(min(0.95, 0.5 + 0.45 * coverage), 2),
+            faq_id=entry["id"],
+            language=language,
+        )
+
+    def timed_answer(self, query: str, language: Optional[str] = None) -> Optional[LocalAnswer]:
+        """answer() with latency recorded under the faq tier when it hits"""
+        started = time.perf_counter()
+        local = self.answer(query, language)
+        if local is not None:
+            self.stats.record("faq", (time.perf_counter() - started) * 1000)
+        return local
@@ -0,0 +1,397 @@
+"""
+job_queue.py
+Durable SQLite job queue and worker pool for asynchronous crop analyses
+Clients submit a photo, disconnect, and poll /jobs/{id}; work survives restarts
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+from concurrency import GateFullError
+from metrics import start_trace
+from response_cache import digest_bytes
+from scheduler import BATCH, is_retryable
+from shared_state import connect
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobQueue:
+    """
+    Jobs and their uploads in one SQLite file (WAL)
+    A job is claimed with a lease; a lease left behind by a crashed worker is
+    claimed again once it expires. Each claim bumps `attempts`, which then
+    identifies the lease holder: complete/retry_later/fail from a claim that
+    lost its lease change nothing. Idempotency keys are unique per user, so a
+    retried submit returns the original job.
+    """
+
+    def __init__(
+        self,
+        path: str = "jobs.sqlite3",
+        lease_seconds: float = 300.0,
+        max_attempts: int = 5,
+        retention_seconds: float = 7 * 86400.0
+    ):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.retention_seconds = retention_seconds
+        self._lock = threading.Lock()
+        # Every server worker opens the same file; claims stay atomic across them
+        self._conn = connect(path)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY,"
+            " idempotency_key TEXT UNIQUE NOT NULL,"
+            " user_id TEXT NOT NULL,"
+            " status TEXT NOT NULL,"
+            " params TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " not_before REAL NOT NULL DEFAULT 0,"
+            " lease_until REAL,"
+            " created_at REAL NOT NULL,"
+            " updated_at REAL NOT NULL,"
+            " result TEXT,"
+            " record_id TEXT,"
+            " error TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_ready ON jobs (status, not_before, created_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_leases ON jobs (status, lease_until)")
+        # Uploads live apart so polling never drags megabytes of image off disk
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS job_inputs (job_id TEXT PRIMARY KEY, image BLOB NOT NULL)"
+        )
+
+    @classmethod
+    def from_env(cls) -> "JobQueue":
+        return cls(
+            path=os.getenv("JOB_QUEUE_PATH", "jobs.sqlite3"),
+            lease_seconds=float(os.getenv("JOB_LEASE_SECONDS", "300")),
+            max_attempts=int(os.getenv("JOB_MAX_ATTEMPTS", "5")),
+            retention_seconds=float(os.getenv("JOB_RETENTION_SECONDS", str(7 * 86400))),
+        )
+
+    @staticmethod
+    def derive_key(user_id: str, image_data: bytes, params: Dict[str, Any]) -> str:
+        """Key for clients that send no Idempotency-Key: same user + photo + params"""
+        material = json.dumps([user_id, digest_bytes(image_data), params], sort_keys=True, default=str)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def submit(
+        self,
+        user_id: str,
+        image_data: bytes,
+        params: Dict[str, Any],
+        idempotency_key: str
+    ) -> Tuple[Dict[str, Any], bool]:
+        """Returns (job, created); an existing key returns the original job untouched"""
+        now = time.time()
+        job_id = uuid.uuid4().hex
+        # Scoped to the user: another user's identical key is a different job
+        idempotency_key = json.dumps([user_id, idempotency_key], ensure_ascii=False)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                inserted = self._conn.execute(
+                    "INSERT OR IGNORE INTO jobs (id, idempotency_key, user_id, status, params, created_at, updated_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (job_id, idempotency_key, user_id, QUEUED, json.dumps(params, ensure_ascii=False), now, now)
+                ).rowcount == 1
+                if inserted:
+                    self._conn.execute("INSERT INTO job_inputs VALUES (?, ?)", (job_id, image_data))
+                row = self._conn.execute(
+                    "SELECT * FROM jobs WHERE idempotency_key = ? AND user_id = ?", (idempotency_key, user_id)
+                ).fetchone()
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return self._public(row), inserted
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._public(row) if row is not None else None
+
+    def claim(self) -> Optional[Dict[str, Any]]:
+        """
+        Lease the oldest ready job, or one whose worker died and let its lease lapse
+        The conditional UPDATE keeps two claimers from sharing one
+        """
+        now = time.time()
+        with self._lock:
+            while True:
+                row = self._conn.execute(
+                    "SELECT id, status, attempts, lease_until FROM jobs"
+                    " WHERE (status = ? AND not_before <= ?) OR (status = ? AND lease_until < ?)"
+                    " ORDER BY created_at LIMIT 1",
+                    (QUEUED, now, RUNNING, now)
+                ).fetchone()
+                if row is None:
+                    return None
+                if row["status"] == RUNNING and row["attempts"] >= self.max_attempts:
+                    # Took its worker down every time it ran
+                    self._fail(row["id"], "Worker lost the job too many times", now, row["attempts"])
+                    continue
+                claimed = self._conn.execute(
+                    "UPDATE jobs SET status = ?, attempts = attempts + 1, lease_until = ?, updated_at = ?"
+                    " WHERE id = ? AND status = ? AND lease_until IS ?",
+                    (RUNNING, now + self.lease_seconds, now, row["id"], row["status"], row["lease_until"])
+                ).rowcount
+                if claimed:
+                    job = dict(self._conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone())
+                    image = self._conn.execute(
+                        "SELECT image FROM job_inputs WHERE job_id = ?", (row["id"],)
+                    ).fetchone()
+                    job["image"] = image["image"] if image is not None else None
+                    job["params"] = json.loads(job["params"])
+                    return job
+
+    def complete(self, job_id: str, attempt: int, result: Dict[str, Any], record_id: Optional[str]) -> bool:
+        """
+        Store the result if this claim (its attempt number) still holds the lease
+        False when the lease lapsed and the job was claimed again meanwhile
+        """
+        now = time.time()
+        with self._lock:
+            stored = self._conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, record_id = ?, error = NULL,"
+                " lease_until = NULL, updated_at = ? WHERE id = ? AND status = ? AND attempts = ?",
+                (DONE, json.dumps(result, ensure_ascii=False, default=str), record_id, now, job_id, RUNNING, attempt)
+            ).rowcount == 1
+            if stored:
+                self._conn.execute("DELETE FROM job_inputs WHERE job_id = ?", (job_id,))
+        return stored
+
+    def retry_later(self, job_id: str, attempts: int, error: str, delay: float) -> bool:
+        """Back to the queue after `delay`, or failed for good once attempts run out; False without the lease"""
+        now = time.time()
+        with self._lock:
+            if attempts >= self.max_attempts:
+                return self._fail(job_id, error, now, attempts)
+            return self._conn.execute(
+                "UPDATE jobs SET status = ?, not_before = ?, error = ?, lease_until = NULL,"
+                " updated_at = ? WHERE id = ? AND status = ? AND attempts = ?",
+                (QUEUED, now + delay, error, now, job_id, RUNNING, attempts)
+            ).rowcount == 1
+
+    def fail(self, job_id: str, attempt: int, error: str) -> bool:
+        with self._lock:
+            return self._fail(job_id, error, time.time(), attempt)
+
+    def _fail(self, job_id: str, error: str, now: float, attempt: int) -> bool:
+        # The attempt number fences out a worker whose lease lapsed and was reclaimed
+        failed = self._conn.execute(
+            "UPDATE jobs SET status = ?, error = ?, lease_until = NULL, updated_at = ?"
+            " WHERE id = ? AND status = ? AND attempts = ?",
+            (FAILED, error, now, job_id, RUNNING, attempt)
+        ).rowcount == 1
+        if failed:
+            self._conn.execute("DELETE FROM job_inputs WHERE job_id = ?", (job_id,))
+        return failed
+
+    def release(self, job_ids: Iterable[str]):
+        """Hand leased jobs back on shutdown instead of waiting out their lease"""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "UPDATE jobs SET status = ?, lease_until = NULL, attempts = MAX(attempts - 1, 0),"
+                " updated_at = ? WHERE id = ? AND status = ?",
+                [(QUEUED, now, job_id, RUNNING) for job_id in job_ids]
+            )
+
+    def recover(self) -> int:
+        """Requeue running jobs whose lease expired (the worker died with them) and purge old ones; run on start"""
+        now = time.time()
+        with self._lock:
+            requeued = self._conn.execute(
+                "UPDATE jobs SET status = ?, lease_until = NULL, updated_at = ?"
+                " WHERE status = ? AND lease_until < ?",
+                (QUEUED, now, RUNNING, now)
+            ).rowcount
+            cutoff = now - self.retention_seconds
+            purged = self._conn.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?", (DONE, FAILED, cutoff)
+            ).rowcount
+            self._conn.execute("DELETE FROM job_inputs WHERE job_id NOT IN (SELECT id FROM jobs)")
+        if requeued or purged:
+            logger.info(f"Job queue: requeued {requeued} interrupted, purged {purged} old jobs")
+        return requeued
+
+    def next_ready_in(self) -> Optional[float]:
+        """Seconds until the earliest deferred job becomes ready"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT MIN(not_before) AS at FROM jobs WHERE status = ?", (QUEUED,)
+            ).fetchone()
+        return None if row["at"] is None else max(row["at"] - time.time(), 0.0)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status").fetchall()
+        counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        counts.update({row["status"]: row["n"] for row in rows})
+        return counts
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @staticmethod
+    def _public(row) -> Dict[str, Any]:
+        job = {
+            "job_id": row["id"],
+            "status": row["status"],
+            "attempts": row["attempts"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+        if row["status"] == DONE:
+            job["result"] = json.loads(row["result"])
+            job["record_id"] = row["record_id"]
+        elif row["error"]:
+            job["error"] = row["error"]
+        return job
+
+
+class JobWorkerPool:
+    """
+    Asyncio workers draining the queue through GeminiService.analyze_crop_disease
+    Model calls go through the scheduler's batch lane, so interactive /analyze stays ahead
+    """
+
+    def __init__(self, queue: JobQueue, gemini, firebase, workers: int = 2, base_backoff: float = 5.0):
+        self.queue = queue
+        self.gemini = gemini
+        self.firebase = firebase
+        self.workers = workers
+        self.base_backoff = base_backoff
+        self._tasks: List[asyncio.Task] = []
+        self._active: Set[str] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self.processed = 0
+        self.failed = 0
+        self.retried = 0
+        self.errors = 0
+
+    @classmethod
+    def from_env(cls, queue: JobQueue, gemini, firebase) -> "JobWorkerPool":
+        return cls(queue, gemini, firebase, workers=int(os.getenv("JOB_WORKERS", "2")))
+
+    async def start(self):
+        await asyncio.to_thread(self.queue.recover)
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    def notify(self):
+        """Wake an idle worker after a submit"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Interrupted jobs go straight back to the queue; no attempt is charged
+        await asyncio.to_thread(self.queue.release, list(self._active))
+        self._active.clear()
+
+    async def _run(self):
+        errors = 0
+        while True:
+            try:
+                job = await asyncio.to_thread(self.queue.claim)
+                if job is None:
+                    await self._idle()
+                    errors = 0
+                    continue
+            except Exception as e:
+                # e.g. "database is locked" while other server workers write; the task must survive it
+                errors += 1
+                self.errors += 1
+                delay = min(self.base_backoff * (2 ** min(errors - 1, 6)), 60.0) * random.uniform(0.5, 1.5)
+                logger.error(f"Job worker: queue unavailable ({str(e)}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            errors = 0
+            self._active.add(job["id"])
+            try:
+                await self._process(job)
+            except Exception as e:
+                # Recording the outcome failed; the job's lease lapses and it is claimed again
+                self.errors += 1
+                logger.error(f"Job {job['id']}: could not record the outcome: {str(e)}")
+            finally:
+                self._active.discard(job["id"])
+
+    async def _idle(self):
+        wait = await asyncio.to_thread(self.queue.next_ready_in)
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), min(wait if wait is not None else 5.0, 5.0))
+        except asyncio.TimeoutError:
+            pass
+
+    async def _process(self, job: Dict[str, Any]):
+        # Attributes stage timings and Gemini tokens to the "job" endpoint
+        trace = start_trace("job")
+        try:
+            await self._run_job(job)
+        finally:
+            trace.finish()
+
+    async def _run_job(self, job: Dict[str, Any]):
+        params = job["params"]
+        if job["image"] is None:
+            await asyncio.to_thread(self.queue.fail, job["id"], job["attempts"], "Upload missing")
+            self.failed += 1
+            return
+        try:
+            analysis = await self.gemini.analyze_crop_disease(
+                job["image"], params.get("context"), params.get("location"), priority=BATCH
+            )
+            if analysis.get("degraded"):
+                # Circuit open: keep the job for when the model is back
+                raise GateFullError(int(self.base_backoff))
+            record_id = await self.firebase.store_crop_analysis(job["user_id"], analysis, analysis.get("image_url"), None)
+            if not await asyncio.to_thread(self.queue.complete, job["id"], job["attempts"], analysis, record_id):
+                logger.warning(f"Job {job['id']}: lease lost before completion, result left to the new holder")
+                return
+            self.processed += 1
+        except Exception as e:
+            if isinstance(e, GateFullError) or is_retryable(e):
+                delay = self.base_backoff * (2 ** (job["attempts"] - 1)) * random.uniform(0.5, 1.5)
+                logger.warning(f"Job {job['id']} deferred {delay:.0f}s: {str(e)}")
+                await asyncio.to_thread(self.queue.retry_later, job["id"], job["attempts"], str(e), delay)
+                self.retried += 1
+            else:
+                logger.error(f"Job {job['id']} failed: {str(e)}")
+                await asyncio.to_thread(self.queue.fail, job["id"], job["attempts"], str(e))
+                self.failed += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": len(self._tasks),
+            "processed": self.processed,
+            "failed": self.failed,
+            "retried": self.retried,
+            "errors": self.errors,
+            "jobs": self.queue.stats(),
+        }
@@ -1,60 +1,205 @@
 import os
 import json
+import sqlite3
+import time
+import asyncio
 import uvicorn
 import traceback
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from typing import List
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends, Request, Query, Response, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from dotenv import load_dotenv
-import google.generativeai as genai
-import firebase_admin
-from firebase_admin import credentials, firestore
+from PIL import UnidentifiedImageError
+from audio_pipeline import AUDIO_MAX_UPLOAD_BYTES, TranscodeError, transcode_stream
+from channel_pool import KEEP_WARM_SECONDS, keep_warm
+from compact import COMPRESSION, CompressionMiddleware, compact_response, parse_fields, select_fields
+from concurrency import GateFullError
+from image_pipeline import (
+    MAX_UPLOAD_BYTES, MULTIPART_OVERHEAD_BYTES, UploadLimitMiddleware, UploadTooLargeError,
+    get_preprocess_pool, preprocess_image, read_upload_limited
+)
+from gemini_service import GeminiService, SentenceSplitter
+from firebase_service import FirebaseService, decode_cursor
+from job_queue import JobQueue, JobWorkerPool, QUEUED, RUNNING
+from metrics import REGISTRY, TOKENS, MetricsMiddleware, record_audio, record_error, record_image, record_stage, stage, start_trace
+from outbreak_analytics import PARQUET_AVAILABLE, backfill, encode_jsonl, encode_parquet
+from prompts import CHAT
+from response_cache import digest_bytes, make_cache_key
+from scheduler import BATCH, CircuitOpenError
+from shared_state import get_shared_state
 
 # 1. Load Environment Variables
 load_dotenv()
 
-# 2. Setup Gemini AI
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-if not GOOGLE_API_KEY:
-    print("❌ CRITICAL: GOOGLE_API_KEY not found!")
-else:
-    genai.configure(api_key=GOOGLE_API_KEY)
-    print("✅ Gemini AI Configured")
-    
-    # --- DEBUG: PRINT AVAILABLE MODELS ---
-    print("\n🔍 CHECKING AVAILABLE MODELS...")
+# 2. Service lifecycle
+# Gemini and Firebase clients are built once per process when the app starts
+# and shared by every request through app.state.
+
+def _channel_pools(app: FastAPI) -> list:
+    gemini = app.state.gemini_service
+    pools = [gemini.channels if gemini is not None else None, app.state.firebase_service.channels]
+    return [pool for pool in pools if pool is not None]
+
+async def _warm_up(app: FastAPI):
+    """Open the Gemini/Firestore channels and prime the model list cache, so first requests skip setup"""
+    for pool in _channel_pools(app):
+        started = time.perf_counter()
+        try:
+            connected = await pool.warm()
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            print(f"🔌 {pool.target}: {connected}/{pool.size} channels connected in {elapsed_ms:.0f} ms")
+        except Exception as e:
+            print(f"   ⚠️ Could not warm {pool.target} channels: {e}")
+    gemini = app.state.gemini_service
+    if gemini is None:
+        return
     try:
-        for m in genai.list_models():
-            if 'generateContent' in m.supported_generation_methods:
-                print(f"   👉 {m.name}")
+        models = await gemini.list_available_models()
+        print(f"🔍 {len(models)} Gemini models available")
     except Exception as e:
         print(f"   ⚠️ Could not list models: {e}")
-    print("--------------------------------\n")
-
-# 3. Setup Firebase
-db = None
-try:
-    if not firebase_admin._apps:
-        # Check for Render's Environment Variable first
-        firebase_creds_json = os.getenv("FIREBASE_CREDENTIALS")
-        if firebase_creds_json:
-            cred_dict = json.loads(firebase_creds_json)
-            cred = credentials.Certificate(cred_dict)
-            firebase_admin.initialize_app(cred)
-            db = firestore.client()
-            print("✅ Firebase Connected (via Env Var)")
-        # Fallback to local file (for your laptop)
-        elif os.path.exists("serviceAccountKey.json"):
-            cred = credentials.Certificate("serviceAccountKey.json")
-            firebase_admin.initialize_app(cred)
-            db = firestore.client()
-            print("✅ Firebase Connected (via File)")
-        else:
-            print("⚠️ No Firebase credentials found.")
-except Exception as e:
-    print(f"⚠️ Firebase Error: {e}")
-
-# 4. Initialize FastAPI
-app = FastAPI()
+    try:
+        counts = await gemini.count_template_tokens()
+        print(f"🧮 System instruction tokens: {counts}")
+    except Exception as e:
+        print(f"   ⚠️ Could not count prompt tokens: {e}")
+    finally:
+        app.state.warm = True
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.warm = False
+
+    if not os.getenv("GOOGLE_API_KEY"):
+        print("❌ CRITICAL: GOOGLE_API_KEY not found!")
+    try:
+        app.state.gemini_service = GeminiService()
+        print("✅ Gemini AI Configured")
+    except Exception as e:
+        print(f"⚠️ Gemini Error: {e}")
+        app.state.gemini_service = None
+
+    app.state.firebase_service = FirebaseService()
+    if app.state.firebase_service.is_healthy():
+        print("✅ Firebase Connected")
+    else:
+        print("⚠️ Firebase unavailable")
+    await app.state.firebase_service.start()
+    if app.state.gemini_service is not None:
+        app.state.gemini_service.media = app.state.firebase_service.media
+
+    # Durable queue for /jobs; workers need a model to talk to
+    app.state.job_pool = None
+    try:
+        app.state.job_queue = JobQueue.from_env()
+    except sqlite3.Error as e:
+        print(f"⚠️ Job queue unavailable: {e}")
+        app.state.job_queue = None
+    if app.state.job_queue is not None and app.state.gemini_service is not None:
+        app.state.job_pool = JobWorkerPool.from_env(
+            app.state.job_queue, app.state.gemini_service, app.state.firebase_service
+        )
+        await app.state.job_pool.start()
+
+    # One-off: fold analyses stored before the rollups existed into the counts;
+    # only the first worker to claim it runs the scan
+    analytics = app.state.firebase_service.analytics
+    backfill_task = None
+    if (
+        analytics is not None
+        and os.getenv("ANALYTICS_BACKFILL") == "1"
+        and app.state.firebase_service.is_healthy()
+        and analytics.claim_backfill()
+    ):
+        print("📊 Backfilling outbreak rollups from crop_analyses")
+        pages = app.state.firebase_service.export_crop_analyses(until=datetime.now(timezone.utc))
+        backfill_task = asyncio.create_task(backfill(analytics, pages))
+
+    # Watch channel state from here on, so connects a request triggers are timed too
+    for pool in _channel_pools(app):
+        pool.start()
+    _register_collectors(app)
+    warmup = asyncio.create_task(_warm_up(app))
+    # Optional: reconnect channels the server idled out before a farmer has to wait on it
+    keep_warm_task = None
+    if KEEP_WARM_SECONDS > 0 and _channel_pools(app):
+        keep_warm_task = asyncio.create_task(keep_warm(_channel_pools(app), KEEP_WARM_SECONDS))
+    yield
+    warmup.cancel()
+    if keep_warm_task is not None:
+        keep_warm_task.cancel()
+    if backfill_task is not None:
+        backfill_task.cancel()
+    if app.state.job_pool is not None:
+        await app.state.job_pool.close()
+    if app.state.job_queue is not None:
+        app.state.job_queue.close()
+    # Queued Firestore writes must land (or spill) before the process exits
+    await app.state.firebase_service.close()
+
+def _register_collectors(app: FastAPI):
+    """Expose the stats the services already keep as /metrics gauges"""
+    gemini = app.state.gemini_service
+    firebase = app.state.firebase_service
+    if gemini is not None:
+        REGISTRY.add_collector("bhasha_gemini_gate", gemini.gate.stats)
+        REGISTRY.add_collector("bhasha_scheduler", gemini.scheduler.stats)
+        REGISTRY.add_collector("bhasha_response_cache", gemini.cache.stats)
+        REGISTRY.add_collector("bhasha_singleflight", gemini.flight.stats)
+        REGISTRY.add_collector("bhasha_router", gemini.router.stats.snapshot)
+        if gemini.regions is not None:
+            REGISTRY.add_collector("bhasha_regions", gemini.regions.stats)
+        if gemini.image_index is not None:
+            REGISTRY.add_collector("bhasha_image_index", gemini.image_index.stats)
+    if firebase.writer is not None:
+        REGISTRY.add_collector("bhasha_firestore_queue", firebase.writer.stats)
+    REGISTRY.add_collector("bhasha_history_cache", firebase.history_cache.stats)
+    if firebase.media is not None:
+        REGISTRY.add_collector("bhasha_media", firebase.media.stats)
+    if firebase.analytics is not None:
+        REGISTRY.add_collector("bhasha_outbreak_rollups", firebase.analytics.stats)
+    REGISTRY.add_collector("bhasha_compression", COMPRESSION.snapshot)
+    if app.state.job_pool is not None:
+        REGISTRY.add_collector("bhasha_jobs", app.state.job_pool.stats)
+    shared = get_shared_state()
+    if shared is not None:
+        REGISTRY.add_collector("bhasha_shared_state", shared.stats)
+    for pool in _channel_pools(app):
+        REGISTRY.add_collector(f"bhasha_channels_{pool.target}", pool.stats)
+
+def get_gemini_service(request: Request) -> GeminiService:
+    gemini = request.app.state.gemini_service
+    if gemini is None:
+        raise HTTPException(status_code=503, detail="Gemini service unavailable")
+    return gemini
+
+def get_firebase_service(request: Request) -> FirebaseService:
+    return request.app.state.firebase_service
+
+def get_job_queue(request: Request) -> JobQueue:
+    queue = request.app.state.job_queue
+    if queue is None:
+        raise HTTPException(status_code=503, detail="Job queue unavailable")
+    return queue
+
+# 3. Initialize FastAPI
+app = FastAPI(lifespan=lifespan)
+
+BATCH_MAX_IMAGES = int(os.getenv("BATCH_MAX_IMAGES", "30"))
+
+# Refuse oversized uploads from Content-Length before the multipart body is spooled;
+# innermost, so the 413 still gets CORS headers
+IMAGE_REQUEST_LIMIT = MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES
+app.add_middleware(UploadLimitMiddleware, limits={
+    "/analyze": IMAGE_REQUEST_LIMIT,
+    "/analyze/stream": IMAGE_REQUEST_LIMIT,
+    "/analyze/batch": BATCH_MAX_IMAGES * MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES,
+    "/analyze/voice": AUDIO_MAX_UPLOAD_BYTES,
+    "/jobs": IMAGE_REQUEST_LIMIT,
+})
 
 app.add_middleware(
     CORSMiddleware,
@@ -63,69 +208,604 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Inside the metrics middleware, so response byte counts are what went over the wire
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(MetricsMiddleware)
 
-# 5. Routes
+# 4. Routes
 
 @app.get("/")
 def home():
     return {"message": "Bhasha-Kisan Backend is Live 🟢"}
 
+@app.get("/ready")
+def ready(request: Request):
+    """Readiness probe: 200 once clients are built and warmed up"""
+    gemini = request.app.state.gemini_service
+    firebase = request.app.state.firebase_service
+    status = {
+        "gemini": gemini is not None and gemini.is_healthy(),
+        "firebase": firebase is not None and firebase.is_healthy(),
+        "models_cached": gemini is not None and gemini.models_cached,
+        "warm": request.app.state.warm,
+    }
+    is_ready = status["gemini"] and status["warm"]
+    return JSONResponse(status_code=200 if is_ready else 503, content={"ready": is_ready, **status})
+
 @app.get("/check-models")
-def check_models():
+async def check_models(refresh: bool = False, gemini: GeminiService = Depends(get_gemini_service)):
     """Helper route to see models in the browser"""
     try:
-        model_list = []
-        for m in genai.list_models():
-            if 'generateContent' in m.supported_generation_methods:
-                model_list.append(m.name)
-        return {"available_models": model_list}
+        return {"available_models": await gemini.list_available_models(refresh=refresh)}
     except Exception as e:
         return {"error": str(e)}
 
+@app.get("/metrics")
+def metrics():
+    """Prometheus text exposition"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/cache/stats")
+def cache_stats(gemini: GeminiService = Depends(get_gemini_service)):
+    """Hit/miss/eviction counters of the response cache, plus request coalescing"""
+    return {**gemini.cache.stats(), "singleflight": gemini.flight.stats()}
+
+@app.get("/scheduler/stats")
+def scheduler_stats(gemini: GeminiService = Depends(get_gemini_service)):
+    """Quota buckets, lane queues, retries/fallbacks and circuit breaker state"""
+    return gemini.scheduler.stats()
+
+@app.get("/tokens/stats")
+async def token_stats(gemini: GeminiService = Depends(get_gemini_service)):
+    """Gemini tokens per endpoint plus the system-instruction size of each prompt template"""
+    try:
+        templates = await gemini.count_template_tokens()
+    except Exception as e:
+        templates = {"error": str(e)}
+    return {"endpoints": TOKENS.snapshot(), "system_instruction_tokens": templates}
+
+@app.get("/router/stats")
+def router_stats(gemini: GeminiService = Depends(get_gemini_service)):
+    """Share of queries and average latency per answer tier (faq, cache, gemini)"""
+    return gemini.router.stats.snapshot()
+
+@app.get("/history/{user_id}")
+async def get_history(
+    user_id: str,
+    request: Request,
+    limit: int = Query(20, ge=1, le=50),
+    cursor: str = Query(None),
+    firebase: FirebaseService = Depends(get_firebase_service)
+):
+    """Newest-first query history; pass next_cursor back as ?cursor= for older pages"""
+    try:
+        page = await firebase.get_user_history_page(user_id, limit, cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    except Exception as e:
+        # e.g. a missing Firestore index; an empty page would read as "no history"
+        record_error("history", e)
+        raise HTTPException(status_code=503, detail="History unavailable")
+    return compact_response(request, page, headers={"Cache-Control": "private, no-cache"}, etag=True)
+
+@app.get("/analytics/outbreaks")
+async def get_outbreaks(
+    request: Request,
+    days: int = Query(14, ge=1, le=365),
+    state: str = Query(None),
+    district: str = Query(None),
+    crop: str = Query(None),
+    disease: str = Query(None),
+    limit: int = Query(50, ge=1, le=500),
+    firebase: FirebaseService = Depends(get_firebase_service)
+):
+    """Disease reports per district over the last `days` days, from the pre-aggregated rollups"""
+    if firebase.analytics is None:
+        raise HTTPException(status_code=503, detail="Outbreak analytics unavailable")
+    result = await asyncio.to_thread(
+        firebase.analytics.outbreaks, days, state, district, crop, disease, limit
+    )
+    return compact_response(request, result, headers={"Cache-Control": "public, max-age=60"}, etag=True)
+
+EXPORT_MEDIA_TYPES = {"jsonl": "application/x-ndjson", "parquet": "application/vnd.apache.parquet"}
+
+@app.get("/analytics/export")
+async def export_analyses(
+    format: str = Query("jsonl", pattern="^(jsonl|parquet)$"),
+    since: str = Query(None, description="ISO date or datetime, inclusive"),
+    until: str = Query(None, description="ISO date or datetime, exclusive"),
+    cursor: str = Query(None, description="cursor of the last row already received"),
+    limit: int = Query(None, ge=1),
+    firebase: FirebaseService = Depends(get_firebase_service)
+):
+    """Stream crop analyses oldest first, one Firestore page at a time"""
+    if not firebase.is_healthy():
+        raise HTTPException(status_code=503, detail="Firestore unavailable")
+    try:
+        bounds = [_parse_instant(value) for value in (since, until)]
+        if cursor:
+            decode_cursor(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid since, until or cursor")
+    if format == "parquet" and not PARQUET_AVAILABLE:
+        raise HTTPException(status_code=501, detail="Parquet export needs pyarrow")
+
+    pages = firebase.export_crop_analyses(
+        *bounds, cursor=cursor, page_size=int(os.getenv("ANALYTICS_EXPORT_PAGE", "500")), limit=limit
+    )
+    body = encode_parquet(pages) if format == "parquet" else encode_jsonl(pages)
+    filename = f"crop_analyses.{format}"
+    return StreamingResponse(
+        body,
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+def _parse_instant(value):
+    if not value:
+        return None
+    instant = datetime.fromisoformat(value)
+    return instant if instant.tzinfo else instant.replace(tzinfo=timezone.utc)
+
+async def _build_prompt_parts(text, image):
+    """Question + preprocessed image; also returns the raw upload and the prepared image"""
+    prompt_parts = []
+
+    # The system prompt is the chat models' system_instruction (prompts.CHAT)
+    if text:
+        print(f"📝 Query: {text}")
+        prompt_parts.append(CHAT.render(text=text))
+
+    content = None
+    prepared = None
+    if image:
+        print(f"📸 Image received: {image.filename}")
+        with stage("upload_read"):
+            content = await read_upload_limited(image)
+        with stage("preprocess"):
+            prepared = await asyncio.get_running_loop().run_in_executor(
+                get_preprocess_pool(), preprocess_image, content
+            )
+        record_image(prepared.bytes_in, prepared.bytes_out)
+        print(
+            f"🖼️ {prepared.bytes_in // 1024} KB -> {prepared.bytes_out // 1024} KB "
+            f"({prepared.width}x{prepared.height}, {prepared.elapsed_ms} ms, "
+            f"~{prepared.estimated_peak_kb // 1024} MB estimated peak)"
+        )
+        prompt_parts.append(prepared.as_blob())
+
+    return prompt_parts, content, prepared
+
+async def _record_query(firebase: FirebaseService, user_id, text, content, result, prepared=None):
+    """Enqueue the history record (and the image upload); returns as soon as both are queued"""
+    with stage("firestore_write"):
+        if content:
+            image_url = firebase.store_media(prepared.data, prepared.mime_type, "images") if prepared else None
+            await firebase.store_crop_analysis(user_id, {"query": text, **result}, image_url, None)
+        elif text:
+            await firebase.store_voice_query(user_id, text, "auto", None, answer=result.get("answer"))
+
 @app.post("/analyze")
 async def analyze_crop(
-    text: str = Form(None), 
+    request: Request,
+    response: Response,
+    text: str = Form(None),
     image: UploadFile = File(None),
-    user_id: str = Form("guest")
+    user_id: str = Form("guest"),
+    fields: str = Query(None, description="comma separated fields to return; all includes raw_response"),
+    gemini: GeminiService = Depends(get_gemini_service),
+    firebase: FirebaseService = Depends(get_firebase_service)
 ):
     print("\n--- 🚀 REQUEST START ---")
-    
+
+    started = time.perf_counter()
+    trace = start_trace("analyze")
+    outcome = "gemini"
+    selected = parse_fields(fields)
+
+    def reply(result):
+        # A Response skips the merge of response.headers, so carry the timing here
+        timing = {"Server-Timing": trace.server_timing()}
+        return compact_response(request, select_fields(result, selected), headers=timing)
+
     try:
-        
-        model = genai.GenerativeModel("gemini-flash-latest")
-        
-        prompt_parts = []
-        
-        # System Prompt
-        prompt_parts.append(
-            "You are Bhasha-Kisan, an expert AI agricultural assistant. "
-            "Answer simply in the user's detected language."
-        )
+        # Common text questions are answered from the local FAQ tier
+        if text and not image:
+            local = gemini.router.timed_answer(text)
+            if local is not None:
+                print(f"📚 FAQ hit: {local.faq_id}")
+                outcome = "faq"
+                result = {"answer": local.answer, "source": "faq"}
+                await _record_query(firebase, user_id, text, None, result)
+                return reply(result)
+
+        prompt_parts, content, prepared = await _build_prompt_parts(text, image)
 
-        if text:
-            print(f"📝 Query: {text}")
-            prompt_parts.append(f"User Question: {text}")
-            
-        if image:
-            print(f"📸 Image received: {image.filename}")
-            content = await image.read()
-            image_blob = {"mime_type": image.content_type, "data": content}
-            prompt_parts.append(image_blob)
-
-        # Generate
+        # Same question / same forwarded photo -> reuse the earlier answer
+        cache_key = make_cache_key(text, digest_bytes(content), gemini.chat_model_name, extra={"prompt": CHAT.id})
+        cached = gemini.cache.get(cache_key)
+        if cached is not None:
+            print("♻️ Cache hit")
+            outcome = "cache"
+            gemini.router.stats.record("cache", (time.perf_counter() - started) * 1000)
+            await _record_query(firebase, user_id, text, content, cached, prepared)
+            return reply(cached)
+
+        async def generate():
+            answer_text = await gemini.generate_answer(prompt_parts)
+            result = {"answer": answer_text}
+            gemini.cache.set(cache_key, result)
+            return result
+
+        # Generate (async so the event loop keeps serving other clients);
+        # identical requests already in flight share the same call
         print("📡 Sending to Gemini...")
-        response = model.generate_content(prompt_parts)
+        result = await gemini.flight.do(cache_key, generate)
+        print("✅ Success!")
+        gemini.router.stats.record("gemini", (time.perf_counter() - started) * 1000)
+        await _record_query(firebase, user_id, text, content, result, prepared)
+        return reply(result)
+
+    except UploadTooLargeError as e:
+        print(f"🚫 Rejected upload: {str(e)}")
+        outcome = "too_large"
+        record_error("analyze", e)
+        return JSONResponse(status_code=413, content={"answer": f"Error: {str(e)}"})
+    except CircuitOpenError as e:
+        # Upstream is down: answer instantly instead of queueing behind it
+        print(f"🔌 Degraded: {str(e)}")
+        outcome = "degraded"
+        record_error("analyze", e)
+        return gemini.degraded_answer(text)
+    except GateFullError as e:
+        print(f"⏳ Busy: {str(e)}")
+        outcome = "busy"
+        record_error("analyze", e)
+        return JSONResponse(
+            status_code=503,
+            content={"answer": "Server is busy, please try again shortly."},
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    except Exception as e:
+        print(f"🔥 ERROR: {str(e)}")
+        traceback.print_exc()
+        outcome = "error"
+        record_error("analyze", e)
+        return {"answer": f"Error: {str(e)}"}
+    finally:
+        response.headers["Server-Timing"] = trace.server_timing()
+        trace.finish(outcome)
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/analyze/stream")
+async def analyze_crop_stream(
+    text: str = Form(None),
+    image: UploadFile = File(None),
+    user_id: str = Form("guest"),
+    gemini: GeminiService = Depends(get_gemini_service),
+    firebase: FirebaseService = Depends(get_firebase_service)
+):
+    """
+    Server-Sent Events variant of /analyze for slow links
+    Events: chunk (raw text), sentence (speakable unit), done (timings), error
+    The finished answer is recorded to history like /analyze
+    """
+    print("\n--- 🚀 STREAM START ---")
+    started = time.perf_counter()
+    trace = start_trace("analyze_stream")
+
+    try:
+        prompt_parts, content, prepared = await _build_prompt_parts(text, image)
+    except UploadTooLargeError as e:
+        record_error("analyze_stream", e)
+        trace.finish("too_large")
+        return JSONResponse(status_code=413, content={"answer": f"Error: {str(e)}"})
+    except Exception as e:
+        # Nothing was streamed yet, so the status code can still say it failed
+        print(f"🔥 ERROR: {str(e)}")
+        traceback.print_exc()
+        record_error("analyze_stream", e)
+        trace.finish("error")
+        status = 400 if isinstance(e, UnidentifiedImageError) else 500
+        return JSONResponse(status_code=status, content={"answer": f"Error: {str(e)}"})
+
+    cache_key = make_cache_key(text, digest_bytes(content), gemini.chat_model_name, extra={"prompt": CHAT.id})
+    cached = gemini.cache.get(cache_key)
+
+    async def events():
+        ttft_ms = None
+        answer = []
+        splitter = SentenceSplitter()
+        source = _replay(cached["answer"]) if cached is not None else gemini.stream_answer(prompt_parts)
+
+        try:
+            async for chunk in source:
+                if ttft_ms is None:
+                    ttft_ms = round((time.perf_counter() - started) * 1000, 1)
+                answer.append(chunk)
+                yield _sse("chunk", {"text": chunk})
+                for sentence in splitter.feed(chunk):
+                    yield _sse("sentence", {"text": sentence})
+            for sentence in splitter.flush():
+                yield _sse("sentence", {"text": sentence})
+
+            total_ms = round((time.perf_counter() - started) * 1000, 1)
+            result = {"answer": "".join(answer)}
+            if cached is None:
+                gemini.cache.set(cache_key, result)
+            # Before `done`: a client that hangs up on it must not lose the history record
+            await _record_query(firebase, user_id, text, content, result, prepared)
+            print(f"✅ Streamed: TTFT {ttft_ms} ms, total {total_ms} ms")
+            trace.finish("cache" if cached is not None else "gemini")
+            yield _sse("done", {"ttft_ms": ttft_ms, "total_ms": total_ms, "cached": cached is not None})
+
+        except CircuitOpenError as e:
+            print(f"🔌 Degraded: {str(e)}")
+            record_error("analyze_stream", e)
+            trace.finish("degraded")
+            degraded = gemini.degraded_answer(text)
+            yield _sse("chunk", {"text": degraded["answer"]})
+            yield _sse("sentence", {"text": degraded["answer"]})
+            total_ms = round((time.perf_counter() - started) * 1000, 1)
+            yield _sse("done", {"ttft_ms": None, "total_ms": total_ms, "cached": False, "degraded": True})
+        except GateFullError as e:
+            print(f"⏳ Busy: {str(e)}")
+            record_error("analyze_stream", e)
+            trace.finish("busy")
+            yield f"retry: {e.retry_after * 1000}\n" + _sse(
+                "error", {"answer": "Server is busy, please try again shortly.", "retry_after": e.retry_after}
+            )
+        except Exception as e:
+            print(f"🔥 ERROR: {str(e)}")
+            traceback.print_exc()
+            record_error("analyze_stream", e)
+            trace.finish("error")
+            yield _sse("error", {"answer": f"Error: {str(e)}"})
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/analyze/voice")
+async def analyze_voice(
+    request: Request,
+    response: Response,
+    user_id: str = Query("guest"),
+    language: str = Query(None, description="Language hint, e.g. hi"),
+    text: str = Query(None, description="Optional typed context sent with the audio"),
+    fields: str = Query(None, description="comma separated fields to return"),
+    gemini: GeminiService = Depends(get_gemini_service),
+    firebase: FirebaseService = Depends(get_firebase_service)
+):
+    """
+    Spoken question as the raw request body (webm/ogg/wav/mp3..., chunked upload welcome)
+    Audio is transcoded to 16 kHz mono while it uploads, then transcribed and
+    answered in one Gemini call; the transcript is stored as a voice query
+    """
+    print("\n--- 🎙️ VOICE START ---")
+    trace = start_trace("analyze_voice")
+    outcome = "gemini"
+    try:
+        audio = await transcode_stream(request.stream(), request.headers.get("content-type"))
+        # Upload and transcode overlap; the transcode stage is what ffmpeg adds after the last byte
+        record_stage("upload_read", audio.upload_ms / 1000)
+        record_stage("transcode", (audio.elapsed_ms - audio.upload_ms) / 1000)
+        record_audio(audio.bytes_in, audio.bytes_out)
+        print(f"🎧 Audio {audio.bytes_in} -> {audio.bytes_out} bytes ({audio.mime_type})")
+
+        result = await gemini.process_voice_query(audio.as_blob(), language, text)
+        outcome = result["source"]
+        audio_url = None
+        if result["transcript"]:
+            with stage("firestore_write"):
+                audio_url = firebase.store_media(audio.data, audio.mime_type, "audio")
+                await firebase.store_voice_query(
+                    user_id, result["transcript"], result["language"], result["transcript_confidence"],
+                    audio_url=audio_url, answer=result.get("answer")
+                )
         print("✅ Success!")
-        
-        answer_text = response.text
-        return {"answer": answer_text}
+        return compact_response(
+            request,
+            select_fields({**result, "audio_url": audio_url, "audio": audio.stats()}, parse_fields(fields)),
+            headers={"Server-Timing": trace.server_timing()},
+        )
 
+    except UploadTooLargeError as e:
+        print(f"🚫 Rejected upload: {str(e)}")
+        outcome = "too_large"
+        record_error("analyze_voice", e)
+        return JSONResponse(status_code=413, content={"answer": f"Error: {str(e)}"})
+    except TranscodeError as e:
+        print(f"🚫 Unreadable audio: {str(e)}")
+        outcome = "bad_audio"
+        record_error("analyze_voice", e)
+        return JSONResponse(status_code=415, content={"answer": f"Error: {str(e)}"})
+    except GateFullError as e:
+        print(f"⏳ Busy: {str(e)}")
+        outcome = "busy"
+        record_error("analyze_voice", e)
+        return JSONResponse(
+            status_code=503,
+            content={"answer": "Server is busy, please try again shortly."},
+            headers={"Retry-After": str(e.retry_after)}
+        )
     except Exception as e:
         print(f"🔥 ERROR: {str(e)}")
         traceback.print_exc()
+        outcome = "error"
+        record_error("analyze_voice", e)
         return {"answer": f"Error: {str(e)}"}
+    finally:
+        response.headers["Server-Timing"] = trace.server_timing()
+        trace.finish(outcome)
+
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "4"))
+
+@app.post("/analyze/batch")
+async def analyze_batch(
+    images: List[UploadFile] = File(...),
+    context: str = Form(None),
+    lat: float = Form(None),
+    lng: float = Form(None),
+    user_id: str = Form("guest"),
+    fields: str = Query(None, description="comma separated analysis fields; all includes raw_response"),
+    gemini: GeminiService = Depends(get_gemini_service),
+    firebase: FirebaseService = Depends(get_firebase_service)
+):
+    """
+    Analyze a field survey of many leaf photos in one request
+    Streams one JSON line per image as it finishes, then a field-level summary line
+    """
+    if len(images) > BATCH_MAX_IMAGES:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_IMAGES} images per batch")
+
+    print(f"\n--- 🚀 BATCH START ({len(images)} images) ---")
+    started = time.perf_counter()
+    # Per-image stages add up across the batch
+    trace = start_trace("analyze_batch")
+    location = {"lat": lat, "lng": lng} if lat is not None and lng is not None else None
+
+    uploads = []
+    for image in images:
+        try:
+            with stage("upload_read"):
+                uploads.append((image.filename, await read_upload_limited(image)))
+        except UploadTooLargeError as e:
+            record_error("analyze_batch", e)
+            trace.finish("too_large")
+            raise HTTPException(status_code=413, detail=f"{image.filename}: {str(e)}")
+
+    selected = parse_fields(fields)
+
+    # Bounded fan-out: preprocessing runs on the shared image pool, model calls
+    # are capped per batch so one survey cannot take every gate slot
+    semaphore = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+
+    async def analyze_one(index, filename, content):
+        async with semaphore:
+            item_started = time.perf_counter()
+            try:
+                # Batch lane: interactive queries are admitted first under quota pressure
+                analysis = await gemini.analyze_crop_disease(content, context, location, priority=BATCH)
+                if analysis.get("degraded"):
+                    # Circuit-open placeholder, not a diagnosis: keep it out of history and the summary
+                    result = {"index": index, "filename": filename, "error": "Analysis unavailable, retry later"}
+                else:
+                    with stage("firestore_write"):
+                        await firebase.store_crop_analysis(user_id, analysis, analysis.get("image_url"), None)
+                    result = {"index": index, "filename": filename, "analysis": analysis}
+            except Exception as e:
+                record_error("analyze_batch", e)
+                result = {"index": index, "filename": filename, "error": str(e)}
+            result["elapsed_ms"] = round((time.perf_counter() - item_started) * 1000, 1)
+            return result
+
+    async def results():
+        tasks = [
+            asyncio.create_task(analyze_one(i, filename, content))
+            for i, (filename, content) in enumerate(uploads)
+        ]
+        analyses = []
+        try:
+            for finished in asyncio.as_completed(tasks):
+                result = await finished
+                if "analysis" in result:
+                    # The field summary needs every field, the client only the ones it asked for
+                    analyses.append(result["analysis"])
+                    result["analysis"] = select_fields(result["analysis"], selected)
+                yield json.dumps(result, ensure_ascii=False) + "\n"
+
+            summary = gemini.summarize_field_analyses(analyses)
+            summary["failed"] = len(tasks) - len(analyses)
+            summary["total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+            print(f"✅ Batch done: {len(analyses)}/{len(tasks)} in {summary['total_ms']} ms")
+            trace.finish("ok" if analyses else "error")
+            yield json.dumps({"summary": summary}, ensure_ascii=False) + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(
+        results(),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+JOB_POLL_INTERVAL = int(os.getenv("JOB_POLL_INTERVAL", "3"))
+
+@app.post("/jobs", status_code=202)
+async def submit_job(
+    request: Request,
+    image: UploadFile = File(...),
+    context: str = Form(None),
+    lat: float = Form(None),
+    lng: float = Form(None),
+    user_id: str = Form("guest"),
+    idempotency_key: str = Header(None),
+    fields: str = Query(None, description="comma separated analysis fields; all includes raw_response"),
+    jobs: JobQueue = Depends(get_job_queue)
+):
+    """
+    Queue a crop analysis and return at once; poll GET /jobs/{job_id} for the result
+    Resubmitting with the same Idempotency-Key (or the same photo and fields) returns the first job
+    """
+    try:
+        content = await read_upload_limited(image)
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+    location = {"lat": lat, "lng": lng} if lat is not None and lng is not None else None
+    params = {"context": context, "location": location}
+    key = idempotency_key or JobQueue.derive_key(user_id, content, params)
+    job, created = await asyncio.to_thread(jobs.submit, user_id, content, params, key)
+
+    if created:
+        print(f"📥 Job queued: {job['job_id']}")
+        pool = request.app.state.job_pool
+        if pool is not None:
+            pool.notify()
+    else:
+        print(f"♻️ Job resubmitted: {job['job_id']} ({job['status']})")
+
+    headers = {"Location": f"/jobs/{job['job_id']}"}
+    if job["status"] in (QUEUED, RUNNING):
+        headers["Retry-After"] = str(JOB_POLL_INTERVAL)
+    return compact_response(
+        request, _job_view(job, parse_fields(fields)), status_code=202 if created else 200, headers=headers
+    )
+
+@app.get("/jobs/{job_id}")
+async def get_job(
+    job_id: str,
+    request: Request,
+    fields: str = Query(None, description="comma separated analysis fields; all includes raw_response"),
+    jobs: JobQueue = Depends(get_job_queue)
+):
+    """
+    Job status; the analysis is included once status is done
+    Polls that send the last ETag back get an empty 304 until the job changes
+    """
+    job = await asyncio.to_thread(jobs.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    headers = {"Cache-Control": "private, no-cache"}
+    if job["status"] in (QUEUED, RUNNING):
+        headers["Retry-After"] = str(JOB_POLL_INTERVAL)
+    return compact_response(request, _job_view(job, parse_fields(fields)), headers=headers, etag=True)
+
+def _job_view(job, fields):
+    if "result" not in job:
+        return job
+    return {**job, "result": select_fields(job["result"], fields)}
+
+async def _replay(text: str):
+    yield text
 
 if __name__ == "__main__":
     # Use PORT 8080 to match Render
     port = int(os.environ.get("PORT", 8080))
-    uvicorn.run(app, host="0.0.0.0", port=port)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=port)
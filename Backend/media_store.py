@@ -0,0 +1,203 @@
+"""
+media_store.py
+Content-addressed storage for analysed images and voice audio
+Objects are named after the SHA-256 of their bytes, so a re-uploaded photo is
+stored once; uploads run in the background and never hold up a response
+"""
+
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import os
+import random
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Objects never change once written, so clients and CDNs may keep them forever
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# GCS wants chunk sizes in multiples of 256 KB
+_CHUNK_QUANTUM = 256 * 1024
+
+_EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/webp": ".webp",
+    "image/png": ".png",
+    "audio/ogg": ".ogg",
+    "audio/flac": ".flac",
+    "audio/wav": ".wav",
+    "audio/mpeg": ".mp3",
+}
+
+
+def content_address(data: bytes, content_type: str, kind: str) -> str:
+    """images/ab/abcdef....jpg; the two-character shard keeps listings short"""
+    digest = hashlib.sha256(data).hexdigest()
+    ext = _EXTENSIONS.get(content_type) or mimetypes.guess_extension(content_type or "") or ""
+    return f"{kind}/{digest[:2]}/{digest}{ext}"
+
+
+class GCSMediaBackend:
+    """
+    Firebase Storage / GCS bucket (FirebaseService.bucket)
+    google-cloud-storage honours STORAGE_EMULATOR_HOST, so a local emulator works unchanged
+    """
+
+    def __init__(self, bucket, prefix: str = "media", resumable_threshold: int = 5 * 1024 * 1024):
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        # Larger objects go up in resumable chunks that survive a dropped connection
+        self.chunk_size = max(resumable_threshold // _CHUNK_QUANTUM, 1) * _CHUNK_QUANTUM
+        self.resumable_threshold = resumable_threshold
+
+    def _path(self, name: str) -> str:
+        return f"{self.prefix}/{name}" if self.prefix else name
+
+    def url(self, name: str) -> str:
+        return f"gs://{self.bucket.name}/{self._path(name)}"
+
+    def upload(self, name: str, data: bytes, content_type: str) -> bool:
+        """Blocking; False when the object already existed"""
+        chunk_size = self.chunk_size if len(data) >= self.resumable_threshold else None
+        blob = self.bucket.blob(self._path(name), chunk_size=chunk_size)
+        if blob.exists():
+            return False
+        blob.cache_control = IMMUTABLE_CACHE_CONTROL
+        try:
+            # Generation 0 = "must not exist yet"; another worker winning the race is fine
+            blob.upload_from_string(data, content_type=content_type, if_generation_match=0)
+        except Exception as e:
+            if getattr(e, "code", None) == 412:
+                return False
+            raise
+        return True
+
+
+class LocalMediaBackend:
+    """Directory stand-in for the bucket (MEDIA_STORE_PATH), for development and tests"""
+
+    def __init__(self, root: str):
+        self.root = Path(root).resolve()
+
+    def url(self, name: str) -> str:
+        return (self.root / name).as_uri()
+
+    def upload(self, name: str, data: bytes, content_type: str) -> bool:
+        path = self.root / name
+        if path.exists():
+            return False
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{random.getrandbits(32):08x}.tmp")
+        tmp.write_bytes(data)
+        # Atomic rename: readers never see a half-written object
+        os.replace(tmp, path)
+        return True
+
+
+class MediaStore:
+    """
+    put() returns the object's URL at once and uploads in the background
+    The URL only depends on the bytes, so it can go into the Firestore record
+    before the upload has finished. Recently stored names are remembered so
+    repeats skip even the existence check.
+    """
+
+    def __init__(
+        self,
+        backend,
+        concurrency: int = 4,
+        max_retries: int = 3,
+        base_backoff: float = 1.0,
+        known_size: int = 10000
+    ):
+        self.backend = backend
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.known_size = known_size
+        self._slots = asyncio.Semaphore(concurrency)
+        self._known: "OrderedDict[str, None]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.uploads = 0
+        self.dedup_hits = 0
+        self.failures = 0
+        self.bytes_uploaded = 0
+
+    @classmethod
+    def from_env(cls, bucket=None) -> Optional["MediaStore"]:
+        """MEDIA_STORE_PATH selects the directory stand-in; otherwise the bucket if configured"""
+        path = os.getenv("MEDIA_STORE_PATH")
+        if path:
+            backend = LocalMediaBackend(path)
+        elif bucket is not None and os.getenv("MEDIA_STORE", "1") != "0":
+            backend = GCSMediaBackend(
+                bucket,
+                prefix=os.getenv("MEDIA_STORE_PREFIX", "media"),
+                resumable_threshold=int(os.getenv("MEDIA_RESUMABLE_THRESHOLD", str(5 * 1024 * 1024))),
+            )
+        else:
+            return None
+        return cls(
+            backend,
+            concurrency=int(os.getenv("MEDIA_UPLOAD_CONCURRENCY", "4")),
+            max_retries=int(os.getenv("MEDIA_UPLOAD_RETRIES", "3")),
+        )
+
+    def put(self, data: bytes, content_type: str, kind: str = "images") -> str:
+        """Schedule an upload (needs a running event loop) and return the final URL"""
+        name = content_address(data, content_type, kind)
+        if name in self._known or name in self._inflight:
+            self.dedup_hits += 1
+            if name in self._known:
+                self._known.move_to_end(name)
+        else:
+            self._inflight[name] = asyncio.create_task(self._upload(name, data, content_type))
+        return self.backend.url(name)
+
+    async def _upload(self, name: str, data: bytes, content_type: str):
+        try:
+            async with self._slots:
+                for attempt in range(self.max_retries + 1):
+                    try:
+                        uploaded = await asyncio.to_thread(self.backend.upload, name, data, content_type)
+                        break
+                    except Exception as e:
+                        if attempt == self.max_retries:
+                            self.failures += 1
+                            logger.error(f"Media upload of {name} failed: {str(e)}")
+                            return
+                        delay = self.base_backoff * (2 ** attempt)
+                        await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            if uploaded:
+                self.uploads += 1
+                self.bytes_uploaded += len(data)
+            else:
+                self.dedup_hits += 1
+            self._known[name] = None
+            while len(self._known) > self.known_size:
+                self._known.popitem(last=False)
+        finally:
+            self._inflight.pop(name, None)
+
+    async def close(self, timeout: float = 10.0):
+        """Give pending uploads a chance to finish before shutdown"""
+        tasks = list(self._inflight.values())
+        if not tasks:
+            return
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning(f"{len(pending)} media uploads abandoned at shutdown")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "uploads": self.uploads,
+            "dedup_hits": self.dedup_hits,
+            "failures": self.failures,
+            "bytes_uploaded": self.bytes_uploaded,
+            "pending": len(self._inflight),
+        }
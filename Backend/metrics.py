@@ -0,0 +1,368 @@
+"""
+metrics.py
+Per-stage timing spans and Prometheus metrics served from /metrics
+Dependency-free text exposition; spans are mirrored to OpenTelemetry when OTEL_ENABLED=1
+"""
+
+import contextvars
+import json
+import logging
+import os
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+_tracer = (
+    otel_trace.get_tracer("bhasha_kisan")
+    if otel_trace is not None and os.getenv("OTEL_ENABLED", "0") == "1"
+    else None
+)
+
+# Seconds; model calls dominate, so the upper buckets stay coarse
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelKey = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Iterable[str], values: Iterable[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Monotonic counter; all updates happen on the event loop thread"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1.0, *labels: str):
+        key = tuple(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(tuple(labels), 0.0)
+
+    def render(self) -> List[str]:
+        return [
+            f"{self.name}{_labels(self.labelnames, key)} {value:g}"
+            for key, value in self._values.items()
+        ]
+
+
+class Histogram:
+    """Cumulative-bucket histogram with the usual _bucket/_sum/_count series"""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        labelnames: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS
+    ):
+        self.name = name
+        self.help = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # Per label set: [count per bucket (+Inf last), sum, count]
+        self._values: Dict[LabelKey, list] = {}
+
+    def observe(self, value: float, *labels: str):
+        key = tuple(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound:g}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {total:g}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    """Metrics plus scrape-time collectors for stats the services already keep"""
+
+    def __init__(self):
+        self._metrics: List[Any] = []
+        self._collectors: List[Tuple[str, Callable[[], Dict[str, Any]]]] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, prefix: str, fn: Callable[[], Dict[str, Any]]):
+        """`fn` returns a (possibly nested) stats dict; numeric leaves become gauges"""
+        self._collectors = [(p, f) for p, f in self._collectors if p != prefix]
+        self._collectors.append((prefix, fn))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        for prefix, fn in self._collectors:
+            try:
+                stats = fn()
+            except Exception as e:
+                logger.warning(f"Metrics collector {prefix} failed: {str(e)}")
+                continue
+            for name, value in _flatten(prefix, stats):
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+def _flatten(prefix: str, stats: Dict[str, Any]):
+    for key, value in stats.items():
+        name = f"{prefix}_{key}".replace("-", "_").replace(".", "_")
+        if isinstance(value, bool):
+            yield name, float(value)
+        elif isinstance(value, (int, float)):
+            yield name, float(value)
+        elif isinstance(value, dict):
+            yield from _flatten(name, value)
+
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.register(Counter(
+    "bhasha_requests_total", "HTTP requests by route and status code", ("route", "method", "status")))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "bhasha_request_seconds", "HTTP request latency until the last body byte", ("route",)))
+REQUEST_BYTES = REGISTRY.register(Counter(
+    "bhasha_request_bytes_total", "Request body bytes received", ("route",)))
+RESPONSE_BYTES = REGISTRY.register(Counter(
+    "bhasha_response_bytes_total", "Response body bytes sent", ("route",)))
+ERRORS = REGISTRY.register(Counter(
+    "bhasha_errors_total", "Handled errors by endpoint and exception type", ("endpoint", "type")))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "bhasha_stage_seconds", "Time spent per request stage", ("stage",)))
+IMAGE_BYTES = REGISTRY.register(Counter(
+    "bhasha_image_bytes_total", "Image bytes before and after preprocessing", ("direction",)))
+AUDIO_BYTES = REGISTRY.register(Counter(
+    "bhasha_audio_bytes_total", "Voice upload bytes received and sent upstream after transcoding", ("direction",)))
+GEMINI_CALLS = REGISTRY.register(Counter(
+    "bhasha_gemini_calls_total", "Gemini generate_content calls", ("model",)))
+GEMINI_TOKENS = REGISTRY.register(Counter(
+    "bhasha_gemini_tokens_total", "Gemini tokens from usage_metadata", ("model", "kind")))
+GEMINI_TTFT_SECONDS = REGISTRY.register(Histogram(
+    "bhasha_gemini_ttft_seconds", "Time to first streamed Gemini chunk", ("model",)))
+CONNECT_SECONDS = REGISTRY.register(Histogram(
+    "bhasha_connection_setup_seconds", "Channel connect and credential refresh time before calls can flow", ("target", "phase")))
+
+
+class TokenLedger:
+    """Gemini calls and tokens per endpoint, from usage_metadata"""
+
+    def __init__(self):
+        self._endpoints: Dict[str, Dict[str, int]] = {}
+
+    def record(self, endpoint: str, prompt: int, output: int, cached: int):
+        totals = self._endpoints.get(endpoint)
+        if totals is None:
+            totals = self._endpoints[endpoint] = {"calls": 0, "prompt": 0, "output": 0, "cached": 0}
+        totals["calls"] += 1
+        totals["prompt"] += prompt
+        totals["output"] += output
+        totals["cached"] += cached
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            endpoint: {
+                **totals,
+                "avg_prompt": round(totals["prompt"] / totals["calls"], 1),
+                "avg_output": round(totals["output"] / totals["calls"], 1),
+            }
+            for endpoint, totals in self._endpoints.items()
+        }
+
+
+TOKENS = TokenLedger()
+REGISTRY.add_collector("bhasha_gemini_endpoint_tokens", TOKENS.snapshot)
+
+
+class RequestTrace:
+    """Stage durations (and Gemini tokens) of one request, for the log line and the Server-Timing header"""
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.tokens: Dict[str, int] = {}
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_tokens(self, kind: str, count: int):
+        self.tokens[kind] = self.tokens.get(kind, 0) + count
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in self.stages.items())
+
+    def finish(self, outcome: str = "ok") -> Dict[str, Any]:
+        summary = {
+            "endpoint": self.endpoint,
+            "outcome": outcome,
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 1),
+            "stages_ms": {stage: round(seconds * 1000, 1) for stage, seconds in self.stages.items()},
+        }
+        if self.tokens:
+            summary["tokens"] = self.tokens
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(f"timings {json.dumps(summary)}")
+        return summary
+
+
+_current_trace: contextvars.ContextVar[Optional[RequestTrace]] = contextvars.ContextVar(
+    "bhasha_request_trace", default=None
+)
+
+
+def start_trace(endpoint: str) -> RequestTrace:
+    """Begin collecting stages for the current request (tasks it spawns inherit it)"""
+    trace = RequestTrace(endpoint)
+    _current_trace.set(trace)
+    return trace
+
+
+@contextmanager
+def stage(name: str):
+    """Time one stage into bhasha_stage_seconds and the current request trace"""
+    span = _tracer.start_as_current_span(name) if _tracer is not None else None
+    if span is not None:
+        span.__enter__()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, name)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(name, elapsed)
+        if span is not None:
+            span.__exit__(None, None, None)
+
+
+def record_stage(name: str, seconds: float):
+    """For stages timed elsewhere (e.g. time to first token)"""
+    STAGE_SECONDS.observe(seconds, name)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, seconds)
+
+
+def record_error(endpoint: str, error: BaseException):
+    ERRORS.inc(1, endpoint, type(error).__name__)
+
+
+def record_gemini_usage(model_name: str, response):
+    """
+    Count one call and its tokens per model and per endpoint
+    usage_metadata may be missing on errors and old SDKs
+    """
+    GEMINI_CALLS.inc(1, model_name)
+    usage = getattr(response, "usage_metadata", None)
+    counts = {}
+    for kind, field in (
+        ("prompt", "prompt_token_count"),
+        ("output", "candidates_token_count"),
+        ("cached", "cached_content_token_count"),
+    ):
+        counts[kind] = (getattr(usage, field, 0) or 0) if usage is not None else 0
+        if counts[kind]:
+            GEMINI_TOKENS.inc(counts[kind], model_name, kind)
+
+    trace = _current_trace.get()
+    TOKENS.record(trace.endpoint if trace is not None else "background", **counts)
+    if trace is not None:
+        for kind, count in counts.items():
+            if count:
+                trace.add_tokens(kind, count)
+
+
+def record_image(bytes_in: int, bytes_out: int):
+    IMAGE_BYTES.inc(bytes_in, "in")
+    IMAGE_BYTES.inc(bytes_out, "out")
+
+
+def record_audio(bytes_in: int, bytes_out: int):
+    AUDIO_BYTES.inc(bytes_in, "in")
+    AUDIO_BYTES.inc(bytes_out, "out")
+
+
+class MetricsMiddleware:
+    """
+    Pure ASGI middleware: request count, latency and body bytes per route template
+    Route templates (/history/{user_id}) keep label cardinality bounded
+    """
+
+    def __init__(self, app, skip_paths: Tuple[str, ...] = ("/metrics",)):
+        self.app = app
+        self.skip_paths = skip_paths
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.skip_paths:
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        received = 0
+        sent = 0
+        status = 500
+
+        async def counting_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            nonlocal sent, status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            route = scope.get("route")
+            route_name = getattr(route, "path", None) or "unmatched"
+            REQUESTS.inc(1, route_name, scope["method"], str(status))
+            REQUEST_SECONDS.observe(time.perf_counter() - started, route_name)
+            REQUEST_BYTES.inc(received, route_name)
+            RESPONSE_BYTES.inc(sent, route_name)
@@ -0,0 +1,326 @@
+"""
+outbreak_analytics.py
+Disease reports pre-aggregated by region and day, plus bulk export encoders
+Every stored crop analysis bumps one rollup row (day x state x district x crop
+x disease, with a severity histogram), so an outbreak query reads rows for the
+requested window only, however large crop_analyses grows
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import string
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional
+
+from crop_analysis import SEVERITY_LEVELS
+from shared_state import connect
+
+logger = logging.getLogger(__name__)
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+PARQUET_AVAILABLE = pa is not None
+
+# Reports are bucketed by the farmer's calendar day
+IST = timezone(timedelta(hours=5, minutes=30))
+
+SEVERITY_COLUMNS = {level: level.lower() for level in SEVERITY_LEVELS}
+_SEVERITY_FIELDS = [*SEVERITY_COLUMNS.values(), "unrated"]
+# Diagnoses that are not a disease or pest report; "analysis pending" is the
+# unparseable-reply placeholder, for records stored before parse_failed existed
+_NOT_REPORTS = {"", "unknown", "healthy", "none", "n/a", "analysis pending"}
+
+# Flat export row; also what the rollups read back during a backfill
+EXPORT_FIELDS = [
+    "id", "timestamp", "cursor", "user", "crop_type", "disease_name", "disease_name_scientific",
+    "severity", "urgent_action_required", "degraded", "parse_failed", "state", "district", "zone", "image_url",
+]
+# Document fields the export reads; nothing else leaves Firestore
+EXPORT_SELECT = [
+    "user_id", "timestamp", "image_url", "analysis.crop_type", "analysis.disease_name",
+    "analysis.disease_name_scientific", "analysis.severity", "analysis.urgent_action_required",
+    "analysis.degraded", "analysis.parse_failed", "analysis.region",
+]
+
+
+def _label(value: Any) -> str:
+    # disease_name may arrive as {"english": ..., "hindi": ...}
+    if isinstance(value, dict):
+        value = value.get("english") or value.get("en") or next(iter(value.values()), "")
+    return string.capwords(str(value or "").strip())
+
+
+def report_fields(analysis: Dict[str, Any]) -> Dict[str, Any]:
+    """The fields outbreak analytics care about, flattened out of a stored analysis"""
+    region = analysis.get("region") or {}
+    return {
+        "crop_type": _label(analysis.get("crop_type")) or "Unknown",
+        "disease_name": _label(analysis.get("disease_name")),
+        "disease_name_scientific": str(analysis.get("disease_name_scientific") or "") or None,
+        "severity": analysis.get("severity") if analysis.get("severity") in SEVERITY_COLUMNS else None,
+        "urgent_action_required": bool(analysis.get("urgent_action_required")),
+        "degraded": bool(analysis.get("degraded")),
+        "parse_failed": bool(analysis.get("parse_failed")),
+        "state": region.get("state") or "Unknown",
+        "district": region.get("district") or "Unknown",
+        "zone": region.get("zone") or None,
+    }
+
+
+def pseudonymize(user_id: Optional[str]) -> Optional[str]:
+    """Stable per-user token for exports; ANALYTICS_USER_SALT keeps it from being reversed by guessing"""
+    if not user_id:
+        return None
+    salt = os.getenv("ANALYTICS_USER_SALT", "")
+    return hashlib.sha256(f"{salt}{user_id}".encode("utf-8")).hexdigest()[:16]
+
+
+def report_day(when: Optional[datetime] = None) -> str:
+    when = when or datetime.now(timezone.utc)
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return when.astimezone(IST).date().isoformat()
+
+
+class OutbreakRollups:
+    """
+    SQLite table of report counts; every worker process updates the same file
+    Each report is one UPSERT, so concurrent writers never lose an increment
+    """
+
+    def __init__(self, path: str = "analytics.sqlite3"):
+        self.path = path
+        self.recorded = 0
+        self.skipped = 0
+        self.queries = 0
+        self._lock = threading.Lock()
+        self._conn = connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbreak_rollups ("
+            " day TEXT NOT NULL,"
+            " state TEXT NOT NULL,"
+            " district TEXT NOT NULL,"
+            " crop TEXT NOT NULL,"
+            " disease TEXT NOT NULL,"
+            " reports INTEGER NOT NULL DEFAULT 0,"
+            " urgent INTEGER NOT NULL DEFAULT 0,"
+            + "".join(f" {column} INTEGER NOT NULL DEFAULT 0," for column in _SEVERITY_FIELDS)
+            + " PRIMARY KEY (day, state, district, crop, disease))"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS outbreak_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+
+    @classmethod
+    def from_env(cls) -> Optional["OutbreakRollups"]:
+        """ANALYTICS_PATH (default analytics.sqlite3); ANALYTICS=0 disables the rollups"""
+        if os.getenv("ANALYTICS", "1") == "0":
+            return None
+        try:
+            return cls(os.getenv("ANALYTICS_PATH", "analytics.sqlite3"))
+        except sqlite3.Error as e:
+            logger.error(f"Outbreak rollups unavailable: {str(e)}")
+            return None
+
+    def record(self, analysis: Dict[str, Any], when: Optional[datetime] = None) -> bool:
+        """Count one stored analysis; blocking, call via asyncio.to_thread"""
+        return self.add_many([{**report_fields(analysis), "timestamp": when}]) == 1
+
+    def add_many(self, rows: Iterable[Dict[str, Any]]) -> int:
+        """Count report_fields()-shaped rows (with a timestamp) in one transaction"""
+        params = []
+        for row in rows:
+            # Placeholders (Gemini down, or a reply that could not be parsed) say nothing about the field
+            if row.get("degraded") or row.get("parse_failed") or row["disease_name"].lower() in _NOT_REPORTS:
+                self.skipped += 1
+                continue
+            severity = SEVERITY_COLUMNS.get(row.get("severity"), "unrated")
+            params.append((
+                report_day(row.get("timestamp")), row["state"], row["district"], row["crop_type"],
+                row["disease_name"], int(bool(row.get("urgent_action_required"))),
+                *(int(column == severity) for column in _SEVERITY_FIELDS),
+            ))
+        if not params:
+            return 0
+        columns = ", ".join(_SEVERITY_FIELDS)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    f"INSERT INTO outbreak_rollups (day, state, district, crop, disease, reports, urgent, {columns})"
+                    f" VALUES (?, ?, ?, ?, ?, 1, ?, {', '.join('?' * len(_SEVERITY_FIELDS))})"
+                    " ON CONFLICT (day, state, district, crop, disease) DO UPDATE SET"
+                    " reports = reports + 1, urgent = urgent + excluded.urgent, "
+                    + ", ".join(f"{c} = {c} + excluded.{c}" for c in _SEVERITY_FIELDS),
+                    params
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self.recorded += len(params)
+        return len(params)
+
+    def outbreaks(
+        self,
+        days: int = 14,
+        state: Optional[str] = None,
+        district: Optional[str] = None,
+        crop: Optional[str] = None,
+        disease: Optional[str] = None,
+        limit: int = 50,
+        today: Optional[date] = None
+    ) -> Dict[str, Any]:
+        """
+        Report clusters in the last `days` days, most reports first
+        Reads one row per cluster per day; the analyses themselves are never touched
+        """
+        self.queries += 1
+        today = today or datetime.now(IST).date()
+        since = (today - timedelta(days=days - 1)).isoformat()
+        where, params = ["day >= ?"], [since]
+        for column, value in (("state", state), ("district", district), ("crop", crop), ("disease", disease)):
+            if value:
+                where.append(f"{column} = ? COLLATE NOCASE")
+                params.append(value.strip())
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT state, district, crop, disease, day, reports, urgent, {', '.join(_SEVERITY_FIELDS)}"
+                f" FROM outbreak_rollups WHERE {' AND '.join(where)} ORDER BY day",
+                params
+            ).fetchall()
+
+        clusters: Dict[tuple, Dict[str, Any]] = {}
+        for state_, district_, crop_, disease_, day, reports, urgent, *severity in rows:
+            cluster = clusters.get((state_, district_, crop_, disease_))
+            if cluster is None:
+                cluster = clusters[(state_, district_, crop_, disease_)] = {
+                    "state": state_,
+                    "district": district_,
+                    "crop": crop_,
+                    "disease": disease_,
+                    "reports": 0,
+                    "urgent": 0,
+                    "severity": dict.fromkeys(_SEVERITY_FIELDS, 0),
+                    "daily": {},
+                    "first_day": day,
+                }
+            cluster["reports"] += reports
+            cluster["urgent"] += urgent
+            for column, count in zip(_SEVERITY_FIELDS, severity):
+                cluster["severity"][column] += count
+            cluster["daily"][day] = reports
+            cluster["last_day"] = day
+
+        ranked = sorted(clusters.values(), key=lambda c: (-c["reports"], -c["urgent"], c["last_day"]))
+        return {
+            "since": since,
+            "until": today.isoformat(),
+            "clusters": len(ranked),
+            "outbreaks": ranked[:limit],
+        }
+
+    def claim_backfill(self) -> bool:
+        """True for exactly one caller across all workers, ever, per rollup file"""
+        with self._lock:
+            return self._conn.execute(
+                "INSERT OR IGNORE INTO outbreak_meta VALUES ('backfill', ?)", (str(time.time()),)
+            ).rowcount == 1
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"recorded": self.recorded, "skipped": self.skipped, "queries": self.queries}
+
+
+async def backfill(rollups: OutbreakRollups, pages: AsyncIterator[List[Dict[str, Any]]]) -> int:
+    """Fold export pages (analyses stored before the rollups existed) into the counts"""
+    total = 0
+    try:
+        async for rows in pages:
+            total += await asyncio.to_thread(rollups.add_many, rows)
+    except Exception as e:
+        # Not retried: a second pass would count the first part twice
+        logger.error(f"Outbreak backfill stopped after {total} reports: {str(e)}")
+        return total
+    logger.info(f"Outbreak rollups backfilled with {total} reports")
+    return total
+
+
+def _json_default(value: Any) -> str:
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+
+async def encode_jsonl(pages: AsyncIterator[List[Dict[str, Any]]]) -> AsyncIterator[bytes]:
+    """One JSON object per line, one chunk per Firestore page"""
+    async for rows in pages:
+        yield "".join(
+            json.dumps(row, ensure_ascii=False, default=_json_default) + "\n" for row in rows
+        ).encode("utf-8")
+
+
+class _ChunkSink:
+    """Write-only file object drained after every row group, so a Parquet export never sits in memory whole"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def parquet_schema():
+    return pa.schema([
+        (name, pa.timestamp("us", tz="UTC") if name == "timestamp"
+         else pa.bool_() if name in ("urgent_action_required", "degraded", "parse_failed") else pa.string())
+        for name in EXPORT_FIELDS
+    ])
+
+
+async def encode_parquet(pages: AsyncIterator[List[Dict[str, Any]]]) -> AsyncIterator[bytes]:
+    """One Parquet row group per Firestore page; raises RuntimeError without pyarrow"""
+    if pa is None:
+        raise RuntimeError("Parquet export needs pyarrow")
+    schema = parquet_schema()
+    sink = _ChunkSink()
+    writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    try:
+        async for rows in pages:
+            table = pa.Table.from_pylist(rows, schema=schema)
+            await asyncio.to_thread(writer.write_table, table)
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
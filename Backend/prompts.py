@@ -0,0 +1,127 @@
+"""
+prompts.py
+Versioned prompt templates
+Static instructions go to the model once as system_instruction; each request
+renders only its variable lines. Bump a template's version whenever its text
+changes: the id is part of every response-cache key that depends on it.
+"""
+
+import string
+from dataclasses import dataclass, field
+from typing import Any, Dict, Tuple
+
+
+@dataclass(frozen=True)
+class PromptTemplate:
+    name: str
+    version: int
+    system: str
+    # str.format template for the part every request has
+    user: str
+    # (field, line) pairs appended only when that field has a value
+    optional: Tuple[Tuple[str, str], ...] = ()
+    fields: Tuple[str, ...] = field(init=False, default=())
+
+    def __post_init__(self):
+        # Parse once at import so a typo in a placeholder fails at startup, not mid-request
+        names = []
+        for template in (self.user, *(line for _, line in self.optional)):
+            names.extend(name for _, name, _, _ in string.Formatter().parse(template) if name)
+        object.__setattr__(self, "fields", tuple(dict.fromkeys(names)))
+
+    @property
+    def id(self) -> str:
+        return f"{self.name}@v{self.version}"
+
+    def render(self, **values: Any) -> str:
+        lines = [self.user.format_map(values)]
+        for name, line in self.optional:
+            if values.get(name):
+                lines.append(line.format_map(values))
+        return "\n".join(lines)
+
+
+# v1 was the inline prompt: a markdown outline plus a JSON field list that the
+# response schema now enforces on its own
+CROP_ANALYSIS = PromptTemplate(
+    name="crop_analysis",
+    version=2,
+    system=(
+        "You are an expert agricultural assistant for Indian farmers, specialising in crop diseases and pests.\n"
+        "From the photo identify the crop, its growth stage and health; then the disease or pest "
+        "(common English and Hindi names, scientific name), severity (Mild, Moderate, Severe or Critical), "
+        "affected parts and the symptoms you can see.\n"
+        "Treatment: organic and bio-pesticide remedies first; chemical pesticides only if necessary, only "
+        "products approved by CIB&RC, with dose, application method, safety precautions, re-entry and "
+        "pre-harvest intervals. Never suggest banned pesticides such as Monocrotophos or Methyl Parathion.\n"
+        "Prevention: cultural practices, crop rotation, irrigation and soil health.\n"
+        "Keep solutions affordable for small farmers, include traditional practices where they work, and "
+        "put farmer safety and the environment first. cost_estimate_inr is per acre."
+    ),
+    user="Diagnose the crop in this photo.",
+    optional=(
+        ("context", "Farmer's note: {context}"),
+        ("location", "Location: {location}"),
+        ("prior", "A visually similar photo was earlier diagnosed as {prior}. Confirm or correct this from the image."),
+    ),
+)
+
+QUERY = PromptTemplate(
+    name="query",
+    version=2,
+    system=(
+        "You are a knowledgeable agricultural expert assistant for Indian farmers.\n"
+        "Give practical, actionable advice in a conversational, farmer-friendly tone, with specific steps, "
+        "measurements and timelines. Consider Indian practices and regulations, cost for small farmers, "
+        "regional climate and soil, the season and traditional knowledge. Warn about safety precautions.\n"
+        "Recommend only chemicals or fertilizers approved by Indian authorities (CIB&RC, FSSAI), readily "
+        "available in rural markets and within the reach of small farmers."
+    ),
+    user="User query: {query}\nQuery language: {language}",
+)
+
+VOICE = PromptTemplate(
+    name="voice",
+    version=2,
+    system=(
+        "You are a knowledgeable agricultural expert assistant for Indian farmers. "
+        "The attached audio is a farmer's spoken question.\n"
+        "transcript: exactly what was said, in the script of the spoken language.\n"
+        "language: ISO 639-1 code of the spoken language (e.g. hi, en, mr, ta).\n"
+        "transcript_confidence: 0 to 1, how clearly the speech could be understood.\n"
+        "answer: practical, farmer-friendly advice in the same language with specific steps, doses and "
+        "timings; only chemicals approved in India (CIB&RC), with safety precautions.\n"
+        "If the audio holds no understandable question, leave transcript empty and ask them to repeat."
+    ),
+    user="Answer the farmer's spoken question.",
+    optional=(
+        ("language_hint", "The farmer most likely speaks: {language_hint}"),
+        ("text", "They also typed: {text}"),
+    ),
+)
+
+REGIONAL_ADVICE = PromptTemplate(
+    name="regional_advice",
+    version=2,
+    system=(
+        "You advise Indian farmers on treating a diagnosed crop problem in their specific region. "
+        "In at most 5 short bullet points cover: best timing given the local season and weather, treatments "
+        "approved by CIB&RC that are sold in local markets, and where to get help (nearest KVK or state "
+        "agricultural university). Plain farmer-friendly English; do not repeat general advice."
+    ),
+    user="Crop: {crop}. Disease/pest: {disease}.\nRegion: {region}.",
+)
+
+CHAT = PromptTemplate(
+    name="chat",
+    version=1,
+    system=(
+        "You are Bhasha-Kisan, an expert AI agricultural assistant. "
+        "Answer simply in the user's detected language."
+    ),
+    user="User Question: {text}",
+)
+
+TEMPLATES: Dict[str, PromptTemplate] = {
+    template.name: template for template in (CROP_ANALYSIS, QUERY, VOICE, REGIONAL_ADVICE, CHAT)
+}
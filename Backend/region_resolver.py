@@ -0,0 +1,136 @@
+"""
+region_resolver.py
+Offline coordinates -> district, state and agro-climatic zone lookup
+Nearest bundled district centroid found through a 1-degree grid, so a lookup
+touches a handful of candidates instead of every district
+"""
+
+import json
+import logging
+import math
+import os
+from dataclasses import dataclass, asdict
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DISTRICTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "districts.json")
+
+_KM_PER_DEGREE = 111.2
+
+
+@dataclass(frozen=True)
+class Region:
+    district: str
+    state: str
+    zone_id: int
+    zone: str
+    zone_profile: str
+    distance_km: float
+
+    @property
+    def key(self) -> str:
+        """Stable id for cache keys"""
+        return f"{self.state}/{self.district}".lower()
+
+    def prompt_line(self) -> str:
+        """One compact line for prompts instead of raw coordinates"""
+        return f"{self.district} district, {self.state}; agro-climatic zone: {self.zone} ({self.zone_profile})"
+
+    def as_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+
+
+class RegionResolver:
+    """
+    Grid index over district centroids
+    Coordinates further than `max_km` from every centroid (sea, outside India) resolve to None
+    """
+
+    def __init__(
+        self,
+        districts: List[List[Any]],
+        zones: Dict[str, Dict[str, str]],
+        cell_degrees: float = 1.0,
+        max_km: float = 150.0
+    ):
+        self.cell = cell_degrees
+        self.max_km = max_km
+        self.zones = zones
+        self._districts = districts
+        self._grid: Dict[Tuple[int, int], List[int]] = {}
+        for index, (_, _, _, lat, lng) in enumerate(districts):
+            self._grid.setdefault(self._cell_of(lat, lng), []).append(index)
+        # Rings to search before anything found is certainly beyond max_km
+        self._max_ring = int(math.ceil(max_km / (_KM_PER_DEGREE * cell_degrees))) + 1
+        self.lookups = 0
+        self.misses = 0
+
+    @classmethod
+    def load_default(cls) -> Optional["RegionResolver"]:
+        """Bundled data/districts.json; None (location stays raw) when it cannot be read"""
+        try:
+            with open(DISTRICTS_PATH, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"District data unavailable, regions disabled: {str(e)}")
+            return None
+        return cls(
+            data["districts"],
+            data["zones"],
+            max_km=float(os.getenv("REGION_MAX_KM", "150")),
+        )
+
+    def _cell_of(self, lat: float, lng: float) -> Tuple[int, int]:
+        return int(math.floor(lat / self.cell)), int(math.floor(lng / self.cell))
+
+    def resolve(self, lat: float, lng: float) -> Optional[Region]:
+        self.lookups += 1
+        row, col = self._cell_of(lat, lng)
+        # Longitude degrees shrink with latitude; equirectangular distance is plenty at district scale
+        lng_scale = math.cos(math.radians(lat))
+        best, best_d2 = None, None
+        for ring in range(self._max_ring + 1):
+            for r in range(row - ring, row + ring + 1):
+                for c in range(col - ring, col + ring + 1):
+                    if ring and row - ring < r < row + ring and col - ring < c < col + ring:
+                        continue  # inner cells were searched in earlier rings
+                    for index in self._grid.get((r, c), ()):
+                        d_lat = self._districts[index][3] - lat
+                        d_lng = (self._districts[index][4] - lng) * lng_scale
+                        d2 = d_lat * d_lat + d_lng * d_lng
+                        if best_d2 is None or d2 < best_d2:
+                            best, best_d2 = index, d2
+            # Anything in the next ring is at least `ring` cells away
+            if best is not None and math.sqrt(best_d2) <= ring * self.cell * lng_scale:
+                break
+
+        if best is None:
+            self.misses += 1
+            return None
+        distance_km = math.sqrt(best_d2) * _KM_PER_DEGREE
+        if distance_km > self.max_km:
+            self.misses += 1
+            return None
+        district, state, zone_id, _, _ = self._districts[best]
+        zone = self.zones.get(str(zone_id), {})
+        return Region(
+            district=district,
+            state=state,
+            zone_id=zone_id,
+            zone=zone.get("name", ""),
+            zone_profile=zone.get("profile", ""),
+            distance_km=round(distance_km, 1),
+        )
+
+    def resolve_location(self, location: Optional[Dict]) -> Optional[Region]:
+        """Accepts the {"lat", "lng"} dicts the endpoints pass around"""
+        if not location:
+            return None
+        try:
+            return self.resolve(float(location["lat"]), float(location["lng"]))
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def stats(self) -> Dict[str, Any]:
+        return {"districts": len(self._districts), "lookups": self.lookups, "misses": self.misses}
@@ -0,0 +1,235 @@
+"""
+response_cache.py
+Content-addressed LRU+TTL cache for Gemini answers
+Keys combine normalized query text, image digest, model name and generation config
+"""
+
+import copy
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from shared_state import connect, worker_count
+
+logger = logging.getLogger(__name__)
+
+# Invisible code points that messaging apps and keyboards sprinkle into text.
+# ZWJ/ZWNJ (U+200C/U+200D) are deliberately kept: they change conjunct
+# rendering in Devanagari, Malayalam and other Indic scripts.
+_INVISIBLE = re.compile("[\u00ad\u200b\u2060\ufeff]")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_query_text(text: Optional[str]) -> str:
+    """
+    Canonical form of a user query for cache keys
+    NFKC folds compatibility forms (full-width digits, precomposed nukta letters),
+    then case and whitespace are folded
+    """
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKC", text)
+    text = _INVISIBLE.sub("", text)
+    text = text.casefold()
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def digest_bytes(data: Optional[bytes]) -> str:
+    """SHA-256 of raw upload bytes, empty string when there is no payload"""
+    if not data:
+        return ""
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_cache_key(
+    text: Optional[str],
+    image_digest: str,
+    model_name: str,
+    generation_config: Optional[Dict[str, Any]] = None,
+    extra: Optional[Dict[str, Any]] = None
+) -> str:
+    """Stable key over everything that changes the model's answer"""
+    material = {
+        "text": normalize_query_text(text),
+        "image": image_digest,
+        "model": model_name,
+        "config": generation_config or {},
+        "extra": extra or {},
+    }
+    encoded = json.dumps(material, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class MemoryCacheBackend:
+    """In-process LRU with per-entry expiry"""
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 3600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evictions = 0
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                self.evictions += 1
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SQLiteCacheBackend:
+    """On-disk LRU that survives restarts; values must be JSON-serializable"""
+
+    def __init__(self, path: str, max_entries: int = 10000, ttl: float = 86400.0):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS response_cache_accessed"
+            " ON response_cache (accessed_at)"
+        )
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self._conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                self.evictions += 1
+                return None
+            self._conn.execute(
+                "UPDATE response_cache SET accessed_at = ? WHERE key = ?", (now, key)
+            )
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now + self.ttl, now)
+            )
+            overflow = len(self) - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    "DELETE FROM response_cache WHERE key IN ("
+                    " SELECT key FROM response_cache ORDER BY accessed_at LIMIT ?)",
+                    (overflow,)
+                )
+                self.evictions += overflow
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+
+
+class ResponseCache:
+    """
+    Front for a pluggable backend with hit/miss/eviction counters
+    Callers always get their own copy of cached values
+    """
+
+    def __init__(self, backend=None, enabled: bool = True):
+        self.backend = backend if backend is not None else MemoryCacheBackend()
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_env(cls) -> "ResponseCache":
+        """
+        RESPONSE_CACHE_BACKEND: memory, sqlite or off; sqlite by default under
+        several workers so they share one cache instead of one each
+        RESPONSE_CACHE_PATH / _MAX_ENTRIES / _TTL tune the backend
+        """
+        default = "sqlite" if worker_count() > 1 else "memory"
+        kind = os.getenv("RESPONSE_CACHE_BACKEND", default).lower()
+        max_entries = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1024"))
+        ttl = float(os.getenv("RESPONSE_CACHE_TTL", "21600"))
+
+        if kind == "off":
+            return cls(enabled=False)
+        if kind == "sqlite":
+            path = os.getenv("RESPONSE_CACHE_PATH", "response_cache.sqlite3")
+            try:
+                return cls(SQLiteCacheBackend(path, max_entries, ttl))
+            except sqlite3.Error as e:
+                logger.error(f"SQLite cache unavailable, using memory: {str(e)}")
+        return cls(MemoryCacheBackend(max_entries, ttl))
+
+    def get(self, key: str) -> Optional[Any]:
+        if not self.enabled:
+            return None
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return copy.deepcopy(value)
+
+    def peek(self, key: str) -> Optional[Any]:
+        """get() without touching the hit/miss counters, for pollers"""
+        if not self.enabled:
+            return None
+        value = self.backend.get(key)
+        return copy.deepcopy(value) if value is not None else None
+
+    def set(self, key: str, value: Any):
+        if self.enabled:
+            self.backend.set(key, copy.deepcopy(value))
+
+    @property
+    def shared(self) -> bool:
+        """Whether other processes see what this one stores"""
+        return self.enabled and isinstance(self.backend, SQLiteCacheBackend)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "backend": type(self.backend).__name__,
+            "enabled": self.enabled,
+            "size": len(self.backend),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.backend.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,475 @@
+"""
+scheduler.py
+Quota-aware scheduling of every Gemini generate_content call
+Token buckets per model (RPM/TPM/RPD), priority lanes, jittered retry with
+model fallback, and a circuit breaker that fails fast while upstream is down
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import random
+import time
+from contextlib import AsyncExitStack, asynccontextmanager
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from concurrency import ConcurrencyGate, GateFullError, get_default_gate
+from metrics import record_gemini_usage
+from shared_state import SharedState, get_shared_state
+
+logger = logging.getLogger(__name__)
+
+# Priority lanes; lower runs first
+INTERACTIVE = 0
+BATCH = 1
+BACKGROUND = 2
+LANE_NAMES = {INTERACTIVE: "interactive", BATCH: "batch", BACKGROUND: "background"}
+
+# 429 and the 5xx family; google.api_core exceptions carry the HTTP status in .code
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+# Gemini bills an inline image at a flat 258 tokens
+IMAGE_TOKENS = 258
+
+
+class CircuitOpenError(GateFullError):
+    """Upstream has been failing; callers should serve a degraded answer"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(retry_after)
+        self.args = (f"Gemini circuit open, retry after {retry_after}s",)
+
+
+class UpstreamBusyError(GateFullError):
+    """Retries and fallbacks were exhausted on 429/5xx responses"""
+
+
+def estimate_tokens(contents) -> int:
+    """Cheap pre-call estimate (about four characters per token); settled from usage_metadata afterwards"""
+    if isinstance(contents, (str, dict)):
+        contents = [contents]
+    tokens = 0
+    for part in contents or []:
+        if isinstance(part, str):
+            tokens += len(part) // 4 + 1
+        elif isinstance(part, dict) and "data" in part:
+            tokens += IMAGE_TOKENS
+    return tokens
+
+
+def model_name_of(model) -> str:
+    return getattr(model, "model_name", "unknown").split("/")[-1]
+
+
+def is_retryable(error: BaseException) -> bool:
+    # A call that hung past the per-call timeout counts as an upstream failure
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    code = getattr(error, "code", None)
+    return isinstance(code, int) and code in RETRYABLE_STATUS
+
+
+class TokenBucket:
+    """Continuous-refill bucket; capacity 0 disables the limit"""
+
+    def __init__(self, capacity: float, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period if capacity else 0.0
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        # `now` can predate a bucket created during the same admission pass
+        elapsed = max(now - self.updated, 0.0)
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated = max(now, self.updated)
+
+    def delay(self, amount: float, now: float) -> float:
+        """Seconds until `amount` is available (0 when it is now)"""
+        if not self.capacity:
+            return 0.0
+        self._refill(now)
+        # Never ask for more than fits, or a large prompt would wait forever
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount: float):
+        if self.capacity:
+            self.tokens -= min(amount, self.capacity)
+
+    def settle(self, amount: float):
+        """Correct an earlier estimate; negative refunds"""
+        if self.capacity:
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class ModelQuota:
+    """Requests per minute and per day, prompt tokens per minute, for one model"""
+
+    def __init__(self, rpm: int, tpm: int, rpd: int, bucket: Optional[Callable[..., Any]] = None):
+        # bucket(kind, capacity, period) builds each limit; shared buckets span workers
+        bucket = bucket or (lambda kind, capacity, period: TokenBucket(capacity, period))
+        self.rpm = bucket("rpm", rpm, 60.0)
+        self.tpm = bucket("tpm", tpm, 60.0)
+        self.rpd = bucket("rpd", rpd, 86400.0)
+        self.cooldown_until = 0.0
+
+    def delay(self, tokens: int, now: float) -> float:
+        return max(
+            self.cooldown_until - now,
+            self.rpm.delay(1, now),
+            self.rpd.delay(1, now),
+            self.tpm.delay(tokens, now),
+        )
+
+    def take(self, tokens: int):
+        self.rpm.take(1)
+        self.rpd.take(1)
+        self.tpm.take(tokens)
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive upstream failures
+    After `reset_timeout` one probe call is let through; its result closes or re-opens it
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self.trips = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def check(self):
+        state = self.state
+        if state == "closed":
+            return
+        if state == "half_open" and not self.probing:
+            self.probing = True
+            return
+        remaining = self.reset_timeout - (time.monotonic() - self.opened_at)
+        raise CircuitOpenError(max(int(remaining) + 1, 1))
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.probing or (self.opened_at is None and self.failures >= self.failure_threshold):
+            if self.opened_at is None or self.probing:
+                self.trips += 1
+                logger.warning(f"Gemini circuit opened after {self.failures} consecutive failures")
+            self.opened_at = time.monotonic()
+            self.probing = False
+
+    def release_probe(self):
+        """The probe ended without an upstream verdict (e.g. a client error)"""
+        self.probing = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {"state": self.state, "consecutive_failures": self.failures, "trips": self.trips}
+
+
+def _settle_shared(bucket, amount: float):
+    try:
+        bucket.settle(amount)
+    except Exception as e:
+        logger.warning(f"Token settle on {bucket.name} failed: {str(e)}")
+
+
+class Lease:
+    """One admitted call: which model served it and the tokens charged for it"""
+
+    def __init__(self, scheduler: "GeminiScheduler", model, tokens: int, response):
+        self.scheduler = scheduler
+        self.model = model
+        self.model_name = model_name_of(model)
+        self.tokens = tokens
+        self.response = response
+
+    def settle(self, final_response=None):
+        """Count usage and true up the token bucket from usage_metadata"""
+        response = final_response if final_response is not None else self.response
+        record_gemini_usage(self.model_name, response)
+        usage = getattr(response, "usage_metadata", None)
+        actual = getattr(usage, "prompt_token_count", 0) if usage is not None else 0
+        if actual:
+            bucket = self.scheduler.quota(self.model_name).tpm
+            if self.scheduler.shared is None:
+                bucket.settle(actual - self.tokens)
+            else:
+                # A shared bucket write can wait on another worker; nobody waits on the correction
+                asyncio.get_running_loop().run_in_executor(None, _settle_shared, bucket, actual - self.tokens)
+
+
+class GeminiScheduler:
+    """
+    Front door for generate_content: admission by lane and quota, then the
+    shared in-flight gate, then the call with retry and fallback
+
+    `models` is an ordered list of GenerativeModel objects with the same
+    generation config; later entries are fallbacks used when earlier ones are
+    out of quota or cooling down after a 429/5xx.
+    """
+
+    def __init__(
+        self,
+        gate: Optional[ConcurrencyGate] = None,
+        rpm: int = 15,
+        tpm: int = 1_000_000,
+        rpd: int = 1500,
+        max_retries: int = 3,
+        base_backoff: float = 1.0,
+        max_backoff: float = 30.0,
+        max_wait: float = 20.0,
+        max_queue: int = 256,
+        call_timeout: float = 60.0,
+        breaker: Optional[CircuitBreaker] = None,
+        shared: Optional[SharedState] = None
+    ):
+        self.gate = gate or get_default_gate()
+        # Under several workers the per-model quotas live in the shared SQLite file
+        self.shared = shared
+        self.limits = (rpm, tpm, rpd)
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        # 0 disables; a hung half-open probe would otherwise hold the breaker forever
+        self.call_timeout = call_timeout or None
+        self.breaker = breaker or CircuitBreaker()
+
+        self._quotas: Dict[str, ModelQuota] = {}
+        self._waiters: List[Tuple[int, int, List[Any], int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._pump_task: Optional[asyncio.Task] = None
+
+        self.admitted = {name: 0 for name in LANE_NAMES.values()}
+        self.throttled = 0
+        self.retries = 0
+        self.fallbacks = 0
+        self.rejected = 0
+
+    @classmethod
+    def from_env(cls, gate: Optional[ConcurrencyGate] = None) -> "GeminiScheduler":
+        """GEMINI_RPM / GEMINI_TPM / GEMINI_RPD per model (0 disables), retry and breaker knobs"""
+        return cls(
+            gate=gate,
+            rpm=int(os.getenv("GEMINI_RPM", "15")),
+            tpm=int(os.getenv("GEMINI_TPM", "1000000")),
+            rpd=int(os.getenv("GEMINI_RPD", "1500")),
+            max_retries=int(os.getenv("GEMINI_MAX_RETRIES", "3")),
+            base_backoff=float(os.getenv("GEMINI_BACKOFF", "1.0")),
+            max_wait=float(os.getenv("GEMINI_QUEUE_TIMEOUT", "20")),
+            call_timeout=float(os.getenv("GEMINI_CALL_TIMEOUT", "60")),
+            breaker=CircuitBreaker(
+                failure_threshold=int(os.getenv("GEMINI_BREAKER_FAILURES", "5")),
+                reset_timeout=float(os.getenv("GEMINI_BREAKER_RESET", "30")),
+            ),
+            shared=get_shared_state(),
+        )
+
+    def quota(self, model_name: str) -> ModelQuota:
+        quota = self._quotas.get(model_name)
+        if quota is None:
+            bucket = partial(self.shared.bucket, model_name) if self.shared is not None else None
+            quota = self._quotas[model_name] = ModelQuota(*self.limits, bucket=bucket)
+        return quota
+
+    async def generate(self, models: List[Any], contents, priority: int = INTERACTIVE, **kwargs):
+        """Non-streaming call; returns the response"""
+        async with self.session(models, contents, priority, **kwargs) as lease:
+            lease.settle()
+            return lease.response
+
+    @asynccontextmanager
+    async def session(self, models: List[Any], contents, priority: int = INTERACTIVE, **kwargs):
+        """
+        Admit and call, holding the in-flight slot until the block exits
+        Streaming callers iterate lease.response inside the block and call lease.settle(last_chunk)
+        """
+        self.breaker.check()
+        tokens = estimate_tokens(contents)
+        deadline = time.monotonic() + self.max_wait
+        attempt = 0
+
+        while True:
+            error = None
+            async with AsyncExitStack() as stack:
+                try:
+                    model = await self._admit(models, tokens, priority, deadline)
+                    await stack.enter_async_context(self.gate.slot())
+                except BaseException:
+                    # A half-open probe that never reached upstream must not wedge the breaker
+                    self.breaker.release_probe()
+                    raise
+                try:
+                    response = await asyncio.wait_for(
+                        model.generate_content_async(contents, **kwargs), self.call_timeout
+                    )
+                except Exception as e:
+                    error = e
+                except BaseException:
+                    # Cancelled: no verdict on upstream health
+                    self.breaker.release_probe()
+                    raise
+                if error is None:
+                    self.breaker.record_success()
+                    yield Lease(self, model, tokens, response)
+                    return
+
+            if not is_retryable(error):
+                # Bad request, safety block, auth: not an upstream health signal
+                self.breaker.release_probe()
+                raise error
+
+            self.breaker.record_failure()
+            delay = min(self.base_backoff * (2 ** attempt), self.max_backoff) * random.uniform(0.5, 1.5)
+            name = model_name_of(model)
+            # The failing model cools down; the next admission prefers a fallback
+            self.quota(name).cooldown_until = time.monotonic() + delay
+            logger.warning(f"Gemini {name} failed ({str(error)}), cooling down {delay:.1f}s")
+
+            # Raises CircuitOpenError if this failure tripped the breaker
+            self.breaker.check()
+            if attempt >= self.max_retries or time.monotonic() + delay > deadline:
+                raise UpstreamBusyError(max(int(delay) + 1, 1)) from error
+            attempt += 1
+            self.retries += 1
+
+    async def _admit(self, models: List[Any], tokens: int, priority: int, deadline: float):
+        """Pick the first model with quota, queueing by lane when none has any"""
+        if not self._waiters:
+            model = await self._take(models, tokens)
+            if model is not None:
+                self._admitted(priority, model, models)
+                return model
+
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise GateFullError(int(await self._ready_in(models, tokens)) + 1)
+
+        self.throttled += 1
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), models, tokens, future))
+        self._kick()
+        try:
+            model = await asyncio.wait_for(future, max(deadline - time.monotonic(), 0.0))
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise GateFullError(int(await self._ready_in(models, tokens)) + 1)
+        self._admitted(priority, model, models)
+        return model
+
+    def _admitted(self, priority: int, model, models: List[Any]):
+        self.admitted[LANE_NAMES.get(priority, "background")] += 1
+        if model is not models[0]:
+            self.fallbacks += 1
+
+    def _try_take(self, models: List[Any], tokens: int):
+        now = time.monotonic()
+        for model in models:
+            quota = self.quota(model_name_of(model))
+            if quota.delay(tokens, now) <= 0:
+                quota.take(tokens)
+                return model
+        return None
+
+    def _next_ready(self, models: List[Any], tokens: int) -> float:
+        now = time.monotonic()
+        return min(self.quota(model_name_of(m)).delay(tokens, now) for m in models)
+
+    async def _take(self, models: List[Any], tokens: int):
+        """_try_take, in a thread when the buckets are shared: a SQLite write can wait on another worker"""
+        if self.shared is None:
+            return self._try_take(models, tokens)
+        self._quotas_for(models)
+        return await asyncio.to_thread(self._try_take, models, tokens)
+
+    async def _ready_in(self, models: List[Any], tokens: int) -> float:
+        if self.shared is None:
+            return self._next_ready(models, tokens)
+        self._quotas_for(models)
+        return await asyncio.to_thread(self._next_ready, models, tokens)
+
+    def _quotas_for(self, models: List[Any]):
+        # Created on the loop, so two threads never build the same model's quota
+        for model in models:
+            self.quota(model_name_of(model))
+
+    def _kick(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        self._wakeup.set()
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+
+    async def _pump(self):
+        """Grants waiters strictly in (lane, arrival) order as quota refills"""
+        while self._waiters:
+            head = self._waiters[0]
+            _, _, models, tokens, future = head
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            model = await self._take(models, tokens)
+            if model is not None:
+                # A higher-priority arrival may have become the head while the take ran
+                self._waiters.remove(head)
+                heapq.heapify(self._waiters)
+                if not future.done():
+                    future.set_result(model)
+                continue
+            # Sleep until the head could run, or until a new (maybe higher priority) arrival
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(await self._ready_in(models, tokens), 0.001))
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        waiting = {name: 0 for name in LANE_NAMES.values()}
+        # Also called from a worker thread (sync routes, metrics scrape): iterate copies
+        for priority, _, _, _, future in list(self._waiters):
+            if not future.done():
+                waiting[LANE_NAMES.get(priority, "background")] += 1
+        now = time.monotonic()
+        quotas = dict(self._quotas)
+        for quota in quotas.values():
+            for bucket in (quota.rpm, quota.tpm, quota.rpd):
+                bucket.delay(0, now)  # refill before reporting
+        return {
+            "waiting": waiting,
+            "admitted": dict(self.admitted),
+            "throttled": self.throttled,
+            "retries": self.retries,
+            "fallbacks": self.fallbacks,
+            "rejected": self.rejected,
+            "breaker": self.breaker.stats(),
+            "models": {
+                name: {
+                    "rpm_available": round(quota.rpm.tokens, 2) if quota.rpm.capacity else -1,
+                    "rpd_available": round(quota.rpd.tokens, 2) if quota.rpd.capacity else -1,
+                    "tpm_available": round(quota.tpm.tokens) if quota.tpm.capacity else -1,
+                    "cooling_down": quota.cooldown_until > now,
+                }
+                for name, quota in quotas.items()
+            },
+        }
@@ -0,0 +1,359 @@
+"""
+shared_state.py
+State shared by every worker process on one host
+A single SQLite file in WAL mode stands in for Redis: Gemini quota buckets,
+in-flight leases for cross-worker request coalescing, and invalidation
+counters, so N workers spend one quota and make one upstream call per key
+"""
+
+import asyncio
+import logging
+import math
+import os
+import socket
+import sqlite3
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from concurrency import GateFullError, SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+def _read_cgroup(path: str) -> Optional[str]:
+    try:
+        with open(path, encoding="ascii") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def cgroup_cpu_limit() -> Optional[float]:
+    """CPUs allowed by the container's CFS quota (cgroup v2, then v1); None when unlimited"""
+    line = _read_cgroup("/sys/fs/cgroup/cpu.max")
+    if line:
+        quota, _, period = line.partition(" ")
+        if quota != "max":
+            try:
+                return int(quota) / int(period or 100000)
+            except ValueError:
+                pass
+        return None
+    quota = _read_cgroup("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+    period = _read_cgroup("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+    try:
+        if quota and period and int(quota) > 0:
+            return int(quota) / int(period)
+    except ValueError:
+        pass
+    return None
+
+
+def available_cpus() -> int:
+    """
+    Cores this process can really use: the affinity mask, capped by the cgroup quota
+    os.cpu_count() reports every host core even inside a 2-CPU container
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    limit = cgroup_cpu_limit()
+    if limit:
+        cpus = min(cpus, math.ceil(limit))
+    return max(cpus, 1)
+
+
+def worker_count() -> int:
+    """Server processes on this host; gunicorn.conf.py exports WEB_CONCURRENCY to its workers"""
+    try:
+        return max(int(os.getenv("WEB_CONCURRENCY", "1")), 1)
+    except ValueError:
+        return 1
+
+
+def connect(path: str, timeout: float = 10.0) -> sqlite3.Connection:
+    """
+    Autocommit connection in WAL mode, safe to open from several processes at once
+    Switching a new file to WAL fails fast with "database is locked" instead of
+    waiting on the busy timeout when workers start together, so retry that step
+    """
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=timeout)
+    for attempt in range(50):
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            break
+        except sqlite3.OperationalError:
+            if attempt == 49:
+                conn.close()
+                raise
+            time.sleep(0.02 * (attempt + 1))
+    return conn
+
+
+class SharedState:
+    """
+    Connection to the shared SQLite file; one per process, opened after fork
+    Every operation is a single short statement or an IMMEDIATE transaction,
+    but a write can wait up to the busy timeout on another worker's, so
+    callers on the event loop go through asyncio.to_thread
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._lock = threading.Lock()
+        self._conn = connect(path)
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            " name TEXT PRIMARY KEY,"
+            " tokens REAL NOT NULL,"
+            " updated_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS leases ("
+            " key TEXT PRIMARY KEY,"
+            " owner TEXT NOT NULL,"
+            " expires_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS generations ("
+            " name TEXT PRIMARY KEY,"
+            " value INTEGER NOT NULL)"
+        )
+
+    @classmethod
+    def from_env(cls) -> Optional["SharedState"]:
+        """
+        SHARED_STATE_PATH (default shared_state.sqlite3 when WEB_CONCURRENCY > 1)
+        A single worker keeps everything in process memory and returns None
+        """
+        path = os.getenv("SHARED_STATE_PATH")
+        if not path:
+            if worker_count() <= 1:
+                return None
+            path = "shared_state.sqlite3"
+        try:
+            return cls(path)
+        except sqlite3.Error as e:
+            logger.error(f"Shared state unavailable, workers will not share quotas: {str(e)}")
+            return None
+
+    # Quota buckets
+
+    def bucket(self, scope: str, kind: str, capacity: float, period: float) -> "SharedTokenBucket":
+        return SharedTokenBucket(self, f"{scope}/{kind}", capacity, period)
+
+    def bucket_level(self, name: str, capacity: float, rate: float, delta: float = 0.0) -> float:
+        """Refill `name` to now, add `delta` (negative to spend) and return the new level"""
+        if not delta:
+            return self.peek_bucket(name, capacity, rate)
+        now = time.time()
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT tokens, updated_at FROM buckets WHERE name = ?", (name,)
+                ).fetchone()
+                tokens = self._refilled(row, capacity, rate, now)
+                tokens = min(capacity, tokens + delta)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)", (name, tokens, now)
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return tokens
+
+    def peek_bucket(self, name: str, capacity: float, rate: float) -> float:
+        """Current level without writing; a plain read never waits on the write lock in WAL mode"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT tokens, updated_at FROM buckets WHERE name = ?", (name,)
+            ).fetchone()
+        return self._refilled(row, capacity, rate, time.time())
+
+    @staticmethod
+    def _refilled(row, capacity: float, rate: float, now: float) -> float:
+        if row is None:
+            return capacity
+        return min(capacity, row[0] + max(now - row[1], 0.0) * rate)
+
+    # In-flight leases
+
+    def acquire(self, key: str, ttl: float) -> bool:
+        """Take the lease on `key` unless another live owner holds it"""
+        now = time.time()
+        with self._lock:
+            return self._conn.execute(
+                "INSERT INTO leases VALUES (?, ?, ?)"
+                " ON CONFLICT (key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at"
+                " WHERE leases.expires_at < ?",
+                (key, self.owner, now + ttl, now)
+            ).rowcount == 1
+
+    def held(self, key: str) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT expires_at FROM leases WHERE key = ?", (key,)
+            ).fetchone()
+        return row is not None and row[0] >= time.time()
+
+    def release(self, key: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM leases WHERE key = ? AND owner = ?", (key, self.owner))
+
+    # Invalidation counters
+
+    def generation(self, name: str) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM generations WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, name: str):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO generations VALUES (?, 1)"
+                " ON CONFLICT (name) DO UPDATE SET value = value + 1",
+                (name,)
+            )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            leases = self._conn.execute(
+                "SELECT COUNT(*) FROM leases WHERE expires_at >= ?", (time.time(),)
+            ).fetchone()[0]
+        return {"workers": worker_count(), "active_leases": leases}
+
+
+class SharedTokenBucket:
+    """TokenBucket whose level lives in SharedState, so all workers draw on one quota"""
+
+    def __init__(self, state: SharedState, name: str, capacity: float, period: float):
+        self.state = state
+        self.name = name
+        self.capacity = capacity
+        self.rate = capacity / period if capacity else 0.0
+
+    @property
+    def tokens(self) -> float:
+        return self.state.peek_bucket(self.name, self.capacity, self.rate)
+
+    def delay(self, amount: float, now: float) -> float:
+        """Seconds until `amount` is available; `now` is ignored, the file keeps wall-clock time"""
+        if not self.capacity:
+            return 0.0
+        tokens = self.tokens
+        amount = min(amount, self.capacity)
+        return 0.0 if tokens >= amount else (amount - tokens) / self.rate
+
+    def take(self, amount: float):
+        # Two workers can both pass delay() before either takes; the bucket
+        # goes briefly negative and the next caller waits it off
+        if self.capacity:
+            self.state.bucket_level(self.name, self.capacity, self.rate, -min(amount, self.capacity))
+
+    def settle(self, amount: float):
+        if self.capacity:
+            self.state.bucket_level(self.name, self.capacity, self.rate, -amount)
+
+
+class SharedSingleFlight(SingleFlight):
+    """
+    SingleFlight across workers
+    Within a process calls coalesce as before; the process's leader then takes
+    a lease on the key. A leader in another worker that finds the lease taken
+    polls the shared response cache for the answer instead of calling Gemini,
+    backing off from `poll_interval` to `max_poll_interval`, and takes over if
+    the lease is released or lapses without one. After `max_wait` it gives up
+    with GateFullError, as the scheduler does for a caller queued that long.
+    """
+
+    def __init__(
+        self,
+        state: SharedState,
+        cache,
+        lease_ttl: float = 60.0,
+        poll_interval: float = 0.05,
+        max_poll_interval: float = 1.0,
+        max_wait: float = 20.0
+    ):
+        super().__init__()
+        self.state = state
+        self.cache = cache
+        self.lease_ttl = lease_ttl
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.max_wait = max_wait
+        self.remote_waits = 0
+        self.remote_hits = 0
+        self.remote_timeouts = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        return await super().do(key, lambda: self._lead(key, fn))
+
+    async def _lead(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        # SQLite calls run in a thread: a lease write can wait on another worker's
+        if not await asyncio.to_thread(self.state.acquire, key, self.lease_ttl):
+            self.remote_waits += 1
+            value = await self._wait_for_remote(key)
+            if value is not None:
+                return value
+        try:
+            # Another worker may have stored the answer between our miss and the lease
+            value = await asyncio.to_thread(self.cache.peek, key)
+            if value is not None:
+                return value
+            return await fn()
+        finally:
+            await asyncio.to_thread(self.state.release, key)
+
+    async def _wait_for_remote(self, key: str) -> Optional[Any]:
+        """The other worker's answer, or None once this worker holds the lease instead"""
+        deadline = time.monotonic() + self.max_wait
+        interval = self.poll_interval
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.remote_timeouts += 1
+                raise GateFullError(max(int(self.max_poll_interval), 1))
+            await asyncio.sleep(min(interval, remaining))
+            interval = min(interval * 2, self.max_poll_interval)
+            value = await asyncio.to_thread(self.cache.peek, key)
+            if value is not None:
+                self.remote_hits += 1
+                return value
+            if await asyncio.to_thread(self._take_over, key):
+                return None
+
+    def _take_over(self, key: str) -> bool:
+        # The lease was released or lapsed without an answer
+        return not self.state.held(key) and self.state.acquire(key, self.lease_ttl)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            **super().stats(),
+            "remote_waits": self.remote_waits,
+            "remote_hits": self.remote_hits,
+            "remote_timeouts": self.remote_timeouts,
+        }
+
+
+_shared_state: Optional[SharedState] = None
+_shared_state_opened = False
+
+
+def get_shared_state() -> Optional[SharedState]:
+    """Process-wide SharedState, opened on first use so it never crosses a fork"""
+    global _shared_state, _shared_state_opened
+    if not _shared_state_opened:
+        _shared_state = SharedState.from_env()
+        _shared_state_opened = True
+    return _shared_state
@@ -0,0 +1,54 @@
+"""
+Backend modules are flat, imported the way main.py imports them; the
+benchmark fakes double as the in-memory Firestore for these tests
+"""
+
+import os
+import sys
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+sys.path.insert(0, os.path.join(BACKEND, "benchmarks"))
+
+import pytest
+
+
+@pytest.fixture
+def firestore_db():
+    from fakes import FakeFirestore
+    return FakeFirestore()
+
+
+@pytest.fixture
+def firebase(firestore_db, monkeypatch):
+    """FirebaseService on the in-memory Firestore, writing straight through (no queue, rollups or media)"""
+    from firebase_service import FirebaseService
+
+    monkeypatch.setenv("FIRESTORE_WRITE_BEHIND", "0")
+    monkeypatch.setenv("ANALYTICS", "0")
+    monkeypatch.delenv("MEDIA_STORE_PATH", raising=False)
+
+    def initialize(service):
+        service.db = firestore_db
+        service.bucket = None
+
+    monkeypatch.setattr(FirebaseService, "_initialize_firebase", initialize)
+    return FirebaseService()
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    """GeminiService on the benchmark's fake models: instant replies, in-memory cache, no image index"""
+    import google.generativeai as genai
+
+    import fakes
+    from gemini_service import GeminiService
+
+    monkeypatch.setenv("RESPONSE_CACHE_BACKEND", "memory")
+    monkeypatch.setenv("IMAGE_INDEX", "0")
+    monkeypatch.setattr(fakes.FakeGenerativeModel, "settings", fakes.FakeGeminiSettings(latency_ms=0, jitter_ms=0))
+    monkeypatch.setattr(genai, "configure", lambda *args, **kwargs: None)
+    monkeypatch.setattr(genai, "GenerativeModel", fakes.FakeGenerativeModel)
+    monkeypatch.setattr(genai, "list_models", lambda: [fakes._FakeModelInfo("models/gemini-1.5-flash")])
+    monkeypatch.setattr(GeminiService, "_initialize_transport", lambda service: None)
+    return GeminiService()
@@ -0,0 +1,58 @@
+import asyncio
+import json
+
+import httpx
+import pytest
+
+import main
+
+
+@pytest.fixture
+def client(gemini, firebase):
+    main.app.dependency_overrides[main.get_gemini_service] = lambda: gemini
+    main.app.dependency_overrides[main.get_firebase_service] = lambda: firebase
+    yield httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test")
+    main.app.dependency_overrides.clear()
+
+
+def _post(client, **kwargs):
+    async def run():
+        async with client:
+            return await client.post("/analyze/stream", **kwargs)
+
+    return asyncio.run(run())
+
+
+def _events(body: str):
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.splitlines() if ": " in line)
+        events.append((lines.get("event"), json.loads(lines["data"]) if "data" in lines else None))
+    return events
+
+
+def test_streamed_answer_is_recorded_in_history(client, firebase):
+    response = _post(client, data={"text": "how do I grow okra in summer?", "user_id": "u1"})
+
+    assert response.status_code == 200
+    events = _events(response.text)
+    assert events[-1][0] == "done"
+    answer = "".join(data["text"] for event, data in events if event == "chunk")
+    assert answer
+
+    history = asyncio.run(firebase.get_user_history_page("u1", 10))["history"]
+    assert len(history) == 1
+    assert history[0]["transcript"] == "how do I grow okra in summer?"
+    assert history[0]["response"] == {"answer": answer}
+
+
+def test_unreadable_image_fails_before_streaming(client, firebase):
+    response = _post(
+        client,
+        data={"text": "what is this?", "user_id": "u1"},
+        files={"image": ("leaf.jpg", b"not a jpeg", "image/jpeg")},
+    )
+
+    assert response.status_code == 400
+    assert response.json()["answer"].startswith("Error:")
+    assert asyncio.run(firebase.get_user_history_page("u1", 10))["history"] == []
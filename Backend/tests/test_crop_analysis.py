@@ -0,0 +1,69 @@
+import asyncio
+import io
+import json
+
+import pytest
+from PIL import Image
+
+import fakes
+from crop_analysis import parse_crop_analysis, parse_partial_json
+
+VALID = json.dumps(fakes.FAKE_ANALYSIS)
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"a": 1, "b": [1, 2]}', {"a": 1, "b": [1, 2]}),
+    ('```json\n{"a": 1}\n```', {"a": 1}),
+    ('Here you go: {"a": 1,}', {"a": 1}),
+    ('{"a": "cut mid str', {"a": "cut mid str"}),
+    # A trailing number may be cut short ("2" of "25"), so it is dropped
+    ('{"a": [1, 2', {"a": [1]}),
+    ('{"a": 1, "b": 50', {"a": 1}),
+    ('{"a": 1, "dangling', {"a": 1}),
+    ('{"a": 1, "b":', {"a": 1}),
+    ('{"a": {"b": "x\\', {"a": {"b": "x"}}),
+])
+def test_parse_partial_json_recovers_the_valid_prefix(text, expected):
+    assert parse_partial_json(text) == expected
+
+
+def test_parse_partial_json_without_an_object():
+    assert parse_partial_json("I could not see the leaf clearly.") is None
+
+
+def test_parse_modes():
+    assert parse_crop_analysis(VALID)[1] == "json"
+
+    analysis, mode = parse_crop_analysis(VALID[:VALID.index('"organic_solutions"')])
+    assert mode == "tolerant"
+    assert analysis.disease_name == "Early Blight"
+
+    assert parse_crop_analysis("Sorry, the photo is too dark.") == (None, "none")
+
+
+def _photo() -> bytes:
+    out = io.BytesIO()
+    Image.new("RGB", (64, 48), (40, 120, 40)).save(out, format="JPEG")
+    return out.getvalue()
+
+
+def test_unparseable_reply_is_not_cached(gemini, monkeypatch):
+    replies = ["Sorry, the photo is too dark.", VALID]
+    monkeypatch.setattr(fakes.FakeGenerativeModel, "_answer_for", staticmethod(lambda config: replies[0]))
+    settings = fakes.FakeGenerativeModel.settings
+    photo = _photo()
+
+    fallback = asyncio.run(gemini.analyze_crop_disease(photo))
+    assert fallback["parse_failed"]
+    assert fallback["disease_name"] == "Analysis Pending"
+
+    # The same photo asks Gemini again instead of replaying the fallback
+    replies.pop(0)
+    analysis = asyncio.run(gemini.analyze_crop_disease(photo))
+    assert settings.calls == 2
+    assert analysis["disease_name"] == "Early Blight"
+    assert not analysis.get("parse_failed")
+
+    # A parsed diagnosis is cached
+    assert asyncio.run(gemini.analyze_crop_disease(photo))["disease_name"] == "Early Blight"
+    assert settings.calls == 2
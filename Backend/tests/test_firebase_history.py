@@ -0,0 +1,82 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from firebase_service import decode_cursor, encode_cursor
+
+T0 = datetime(2026, 6, 1, 9, 0, tzinfo=timezone.utc)
+
+
+def _pages(firebase, user_id, limit):
+    async def run():
+        pages, cursor = [], None
+        while True:
+            page = await firebase.get_user_history_page(user_id, limit, cursor)
+            pages.append(page["history"])
+            cursor = page["next_cursor"]
+            if cursor is None:
+                return pages
+
+    return asyncio.run(run())
+
+
+def test_history_has_answers_and_crop_analyses(firebase, firestore_db):
+    async def run():
+        await firebase.store_voice_query("u1", "When to sow wheat?", "en", 0.9, answer="Early November")
+        await firebase.store_crop_analysis(
+            "u1", {"query": "What is on this leaf?", "answer": "Leaf rust, spray propiconazole"}, "file:///a.jpg", None
+        )
+        await firebase.store_crop_analysis(
+            "u1", {"disease_name": "Late Blight", "severity": "High", "treatment_steps": ["..."]}, None, None
+        )
+        await firebase.store_voice_query("u2", "Someone else", "en", 0.9, answer="Not yours")
+        return await firebase.get_user_history_page("u1", 10)
+
+    history = asyncio.run(run())["history"]
+
+    assert len(history) == 3
+    by_question = {item["transcript"]: item for item in history}
+    assert by_question["When to sow wheat?"]["response"] == {"answer": "Early November"}
+    assert "analysis" not in by_question["When to sow wheat?"]
+
+    photo = by_question["What is on this leaf?"]
+    assert photo["analysis"] == "Image Analysis"
+    assert photo["response"]["answer"] == "Leaf rust, spray propiconazole"
+    assert photo["image_url"] == "file:///a.jpg"
+
+    diagnosis = by_question[""]
+    assert diagnosis["response"]["answer"] == "Late Blight (High)"
+    assert (diagnosis["disease_name"], diagnosis["severity"]) == ("Late Blight", "High")
+    # Summary projection only
+    assert "treatment_steps" not in diagnosis
+    assert all(isinstance(item["timestamp"], str) for item in history)
+
+
+def test_pages_interleave_collections_with_tied_timestamps(firebase, firestore_db):
+    expected = []
+    for i in range(7):
+        # Batched writes share one server timestamp; pairs tie here
+        timestamp = T0 + timedelta(minutes=i // 2)
+        collection = "voice_queries" if i % 2 else "crop_analyses"
+        doc_id = f"doc{i}"
+        data = {"user_id": "u1", "timestamp": timestamp}
+        if collection == "voice_queries":
+            data.update(transcript=f"q{i}", response={"answer": f"a{i}"})
+        else:
+            data.update(analysis={"query": f"q{i}", "disease_name": "Rust"})
+        firestore_db.collection(collection).document(doc_id).set(data)
+        expected.append((timestamp, doc_id))
+    expected.sort(reverse=True)
+
+    pages = _pages(firebase, "u1", limit=2)
+
+    assert [len(page) for page in pages] == [2, 2, 2, 1]
+    assert [item["id"] for page in pages for item in page] == [doc_id for _, doc_id in expected]
+
+
+def test_cursor_round_trip_and_bad_cursor(firebase):
+    assert decode_cursor(encode_cursor(T0, "abc")) == (T0, "abc")
+    assert decode_cursor(encode_cursor(T0)) == (T0, None)
+    with pytest.raises(ValueError):
+        asyncio.run(firebase.get_user_history_page("u1", 10, "not-a-cursor"))
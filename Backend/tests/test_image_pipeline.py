@@ -0,0 +1,104 @@
+import asyncio
+import io
+import json
+
+import pytest
+from PIL import Image
+
+import main
+from image_pipeline import (
+    UploadLimitMiddleware, UploadTooLargeError, MAX_UPLOAD_BYTES, preprocess_image, read_upload_limited
+)
+
+
+class FakeUpload:
+    def __init__(self, data: bytes):
+        self._stream = io.BytesIO(data)
+
+    async def read(self, size: int = -1) -> bytes:
+        return self._stream.read(size)
+
+
+def _jpeg(width: int, height: int) -> bytes:
+    out = io.BytesIO()
+    Image.new("RGB", (width, height), (40, 120, 40)).save(out, format="JPEG")
+    return out.getvalue()
+
+
+def _call(app, path: str, headers):
+    """Run one POST through an ASGI app; returns (status, body, whether the body was read)"""
+    scope = {"type": "http", "method": "POST", "path": path, "headers": headers, "query_string": b""}
+    sent = []
+    reads = []
+
+    async def receive():
+        reads.append(True)
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(app(scope, receive, send))
+    status = next(m["status"] for m in sent if m["type"] == "http.response.start")
+    body = b"".join(m.get("body", b"") for m in sent if m["type"] == "http.response.body")
+    return status, body, bool(reads)
+
+
+async def _inner(scope, receive, send):
+    await receive()
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+def test_middleware_refuses_oversized_content_length_without_reading():
+    app = UploadLimitMiddleware(_inner, {"/analyze": 1000})
+
+    status, body, read = _call(app, "/analyze", [(b"content-length", b"1001")])
+
+    assert status == 413
+    assert "limit" in json.loads(body)["answer"]
+    assert not read
+
+
+@pytest.mark.parametrize("path, headers", [
+    ("/analyze", [(b"content-length", b"1000")]),
+    ("/analyze", []),  # chunked: left to read_upload_limited
+    ("/analyze", [(b"content-length", b"junk")]),
+    ("/history", [(b"content-length", b"5000")]),
+])
+def test_middleware_passes_other_requests(path, headers):
+    app = UploadLimitMiddleware(_inner, {"/analyze": 1000})
+
+    status, body, read = _call(app, path, headers)
+
+    assert (status, body, read) == (200, b"ok", True)
+
+
+def test_app_refuses_oversized_upload_before_parsing_the_form():
+    length = str(MAX_UPLOAD_BYTES * 2).encode()
+    headers = [(b"content-type", b"multipart/form-data; boundary=x"), (b"content-length", length)]
+
+    status, _, read = _call(main.app, "/analyze", headers)
+
+    assert status == 413
+    assert not read
+
+
+def test_read_upload_limited():
+    assert asyncio.run(read_upload_limited(FakeUpload(b"x" * 100), max_bytes=100)) == b"x" * 100
+    with pytest.raises(UploadTooLargeError):
+        asyncio.run(read_upload_limited(FakeUpload(b"x" * 101), max_bytes=100))
+
+
+def test_preprocess_downscales_and_estimates_peak():
+    data = _jpeg(3000, 2000)
+
+    prepared = preprocess_image(data, max_side=1024)
+
+    assert max(prepared.width, prepared.height) == 1024
+    assert prepared.mime_type == "image/jpeg"
+    # JPEG draft decoding never materializes the full 6 MP image
+    assert prepared.decoded_pixels < 3000 * 2000
+    # At least the upload plus the decoded RGB buffer
+    assert prepared.estimated_peak_kb * 1024 >= len(data) + prepared.decoded_pixels * 4 - 1024
+    assert "data" not in prepared.stats()
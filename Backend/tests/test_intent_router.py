@@ -0,0 +1,73 @@
+import pytest
+
+from intent_router import IntentRouter, guess_language
+
+
+@pytest.fixture(scope="module")
+def router():
+    return IntentRouter.load_default()
+
+
+@pytest.mark.parametrize("query, language", [
+    ("नीम तेल का छिड़काव कैसे करें", "hi"),
+    ("neem tel spray kaise banaye", "hi-latn"),
+    ("how to make neem oil spray", "en"),
+    ("ਮੰਡੀ ਦਾ ਭਾਅ", "pa"),
+])
+def test_guess_language(query, language):
+    assert guess_language(query) == language
+
+
+@pytest.mark.parametrize("query, faq_id, language", [
+    ("नीम तेल का छिड़काव कैसे करें", "neem_oil_spray", "hi"),
+    ("neem tel spray kaise banaye", "neem_oil_spray", "hi-latn"),
+    ("how to make neem oil spray", "neem_oil_spray", "en"),
+    ("मंडी भाव कैसे देखें", "mandi_prices", "hi"),
+    ("mandi bhav kaise dekhe", "mandi_prices", "hi-latn"),
+    ("where to check mandi prices", "mandi_prices", "en"),
+    ("केंचुआ खाद कैसे बनाएं", "vermicompost", "hi"),
+    ("kenchua khad kaise banaye", "vermicompost", "hi-latn"),
+    ("how to make vermicompost", "vermicompost", "en"),
+    ("pm kisan yojana kya hai", "pm_kisan", "hi-latn"),
+])
+def test_answers_in_the_language_asked(router, query, faq_id, language):
+    local = router.answer(query)
+    assert local is not None
+    assert (local.faq_id, local.language) == (faq_id, language)
+
+
+def test_romanized_answer_is_in_latin_script(router):
+    local = router.answer("neem tel spray kaise banaye")
+    assert local.answer.isascii()
+    assert "neem tel" in local.answer
+
+
+def test_romanized_falls_back_to_devanagari():
+    faq = [{
+        "id": "only_hi",
+        "category": "general_farming",
+        "questions": ["gehu ki buvai kab kare", "wheat sowing time"],
+        "answers": {"en": "November", "hi": "नवंबर"},
+    }]
+    router = IntentRouter(faq, min_score=0.0)
+
+    local = router.answer("gehu ki buvai kab kare")
+    assert (local.answer, local.language) == ("नवंबर", "hi")
+    assert router.answer("gehu ki buvai kab kare", language="hi-IN").answer == "नवंबर"
+    assert router.answer("wheat sowing time", language="ta") is None
+
+
+def test_unrelated_and_ambiguous_queries_go_to_gemini(router):
+    assert router.answer("my tomato leaves have brown spots with yellow rings") is None
+    assert router.answer("kaise") is None
+
+
+@pytest.mark.parametrize("query, category", [
+    ("tamatar mein keeda lag gaya", "disease_diagnosis"),
+    ("गेहूं में कौन सी खाद डालें", "soil_nutrition"),
+    ("will there be rain this week", "weather_related"),
+    ("mandi bhav", "market_info"),
+    ("how to grow okra", "general_farming"),
+])
+def test_categorize(router, query, category):
+    assert router.categorize(query) == category
@@ -0,0 +1,213 @@
+import asyncio
+import sqlite3
+import time
+
+import pytest
+
+from concurrency import GateFullError
+from job_queue import DONE, FAILED, QUEUED, RUNNING, JobQueue, JobWorkerPool
+
+PHOTO = b"\xff\xd8 leaf photo"
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = JobQueue(str(tmp_path / "jobs.sqlite3"), lease_seconds=60.0, max_attempts=3)
+    yield queue
+    queue.close()
+
+
+def _expire_leases(queue):
+    with queue._lock:
+        queue._conn.execute("UPDATE jobs SET lease_until = ? WHERE status = ?", (time.time() - 1, RUNNING))
+
+
+def test_idempotency_key_returns_the_original_job(queue):
+    job, created = queue.submit("u1", PHOTO, {"context": "tomato"}, "key-1")
+    again, created_again = queue.submit("u1", b"other bytes", {"context": "changed"}, "key-1")
+
+    assert created and not created_again
+    assert again["job_id"] == job["job_id"]
+    assert queue.stats()[QUEUED] == 1
+
+
+def test_idempotency_keys_are_scoped_per_user(queue):
+    first, _ = queue.submit("u1", PHOTO, {}, "key-1")
+    second, created = queue.submit("u2", PHOTO, {}, "key-1")
+
+    assert created
+    assert second["job_id"] != first["job_id"]
+
+
+def test_derived_key_depends_on_user_photo_and_params():
+    key = JobQueue.derive_key("u1", PHOTO, {"context": "tomato"})
+    assert key == JobQueue.derive_key("u1", PHOTO, {"context": "tomato"})
+    assert key != JobQueue.derive_key("u2", PHOTO, {"context": "tomato"})
+    assert key != JobQueue.derive_key("u1", PHOTO + b"x", {"context": "tomato"})
+    assert key != JobQueue.derive_key("u1", PHOTO, {"context": "potato"})
+
+
+def test_claim_and_complete(queue):
+    job, _ = queue.submit("u1", PHOTO, {"context": "tomato"}, "key-1")
+
+    claimed = queue.claim()
+    assert (claimed["id"], claimed["image"], claimed["params"]) == (job["job_id"], PHOTO, {"context": "tomato"})
+    assert claimed["attempts"] == 1
+    assert queue.claim() is None
+
+    assert queue.complete(claimed["id"], 1, {"disease_name": "Early Blight"}, "rec-1")
+    done = queue.get(job["job_id"])
+    assert done["status"] == DONE
+    assert done["result"] == {"disease_name": "Early Blight"}
+    assert done["record_id"] == "rec-1"
+    # The upload is dropped once the job is finished
+    assert queue._conn.execute("SELECT COUNT(*) FROM job_inputs").fetchone()[0] == 0
+
+
+def test_lapsed_lease_is_reclaimed_and_the_old_holder_fenced_out(queue):
+    job, _ = queue.submit("u1", PHOTO, {}, "key-1")
+    first = queue.claim()
+    _expire_leases(queue)
+
+    second = queue.claim()
+    assert second["id"] == job["job_id"]
+    assert second["attempts"] == 2
+
+    # The worker that lost its lease finishes late: nothing changes
+    assert not queue.complete(first["id"], first["attempts"], {"disease_name": "stale"}, "rec-old")
+    assert not queue.retry_later(first["id"], first["attempts"], "late error", 0)
+    assert not queue.fail(first["id"], first["attempts"], "late error")
+    assert queue.get(job["job_id"])["status"] == RUNNING
+
+    assert queue.complete(second["id"], second["attempts"], {"disease_name": "fresh"}, "rec-new")
+    assert queue.get(job["job_id"])["result"] == {"disease_name": "fresh"}
+
+
+def test_job_that_keeps_losing_its_worker_fails(queue):
+    job, _ = queue.submit("u1", PHOTO, {}, "key-1")
+    for _ in range(queue.max_attempts):
+        assert queue.claim()["id"] == job["job_id"]
+        _expire_leases(queue)
+
+    assert queue.claim() is None
+    failed = queue.get(job["job_id"])
+    assert failed["status"] == FAILED
+    assert failed["error"] == "Worker lost the job too many times"
+
+
+def test_retry_later_defers_then_gives_up(queue):
+    job, _ = queue.submit("u1", PHOTO, {}, "key-1")
+
+    claimed = queue.claim()
+    assert queue.retry_later(claimed["id"], claimed["attempts"], "429 quota", 60.0)
+    assert queue.get(job["job_id"])["status"] == QUEUED
+    assert queue.claim() is None
+    assert 59 < queue.next_ready_in() <= 60
+
+    with queue._lock:
+        queue._conn.execute("UPDATE jobs SET not_before = 0")
+    for _ in range(queue.max_attempts - 1):
+        claimed = queue.claim()
+        queue.retry_later(claimed["id"], claimed["attempts"], "429 quota", 0.0)
+
+    failed = queue.get(job["job_id"])
+    assert failed["status"] == FAILED
+    assert failed["error"] == "429 quota"
+    assert failed["attempts"] == queue.max_attempts
+
+
+def test_release_requeues_without_charging_an_attempt(queue):
+    job, _ = queue.submit("u1", PHOTO, {}, "key-1")
+    queue.claim()
+    queue.release([job["job_id"]])
+
+    released = queue.get(job["job_id"])
+    assert (released["status"], released["attempts"]) == (QUEUED, 0)
+
+
+class FakeGemini:
+    def __init__(self, error=None):
+        self.error = error
+        self.calls = 0
+
+    async def analyze_crop_disease(self, image, context=None, location=None, priority=None):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        return {"disease_name": "Early Blight", "context": context}
+
+
+class FakeFirebase:
+    def __init__(self):
+        self.records = []
+
+    async def store_crop_analysis(self, user_id, analysis, image_url, audio_url):
+        self.records.append((user_id, analysis))
+        return f"rec-{len(self.records)}"
+
+
+def _drain(pool, until, timeout=5.0):
+    async def run():
+        await pool.start()
+        pool.notify()
+        deadline = time.monotonic() + timeout
+        while not until() and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        await pool.close()
+
+    asyncio.run(run())
+
+
+def test_worker_pool_processes_jobs(queue):
+    firebase = FakeFirebase()
+    pool = JobWorkerPool(queue, FakeGemini(), firebase, workers=2, base_backoff=0.01)
+    jobs = [queue.submit("u1", PHOTO + bytes([i]), {"context": f"c{i}"}, f"key-{i}")[0] for i in range(3)]
+
+    _drain(pool, lambda: pool.processed == 3)
+
+    assert pool.stats()["processed"] == 3
+    assert [queue.get(job["job_id"])["status"] for job in jobs] == [DONE] * 3
+    assert len(firebase.records) == 3
+
+
+def test_worker_survives_a_locked_database(queue):
+    class FlakyQueue(JobQueue):
+        failures = 2
+
+        def claim(self):
+            if self.failures:
+                self.failures -= 1
+                raise sqlite3.OperationalError("database is locked")
+            return super().claim()
+
+    flaky = FlakyQueue(queue.path)
+    job, _ = flaky.submit("u1", PHOTO, {}, "key-1")
+    pool = JobWorkerPool(flaky, FakeGemini(), FakeFirebase(), workers=1, base_backoff=0.01)
+
+    _drain(pool, lambda: pool.processed == 1)
+
+    assert pool.stats()["errors"] == 2
+    assert flaky.get(job["job_id"])["status"] == DONE
+    flaky.close()
+
+
+def test_busy_model_defers_the_job(queue):
+    job, _ = queue.submit("u1", PHOTO, {}, "key-1")
+    gemini = FakeGemini(error=GateFullError(5))
+    pool = JobWorkerPool(queue, gemini, FakeFirebase(), workers=1, base_backoff=30.0)
+
+    _drain(pool, lambda: pool.retried == 1)
+
+    deferred = queue.get(job["job_id"])
+    assert (deferred["status"], deferred["error"]) == (QUEUED, "Model capacity exhausted, retry after 5s")
+    assert queue.next_ready_in() > 10
+    assert gemini.calls == 1
+
+
+def test_client_error_fails_the_job(queue):
+    job, _ = queue.submit("u1", PHOTO, {}, "key-1")
+    pool = JobWorkerPool(queue, FakeGemini(error=ValueError("bad image")), FakeFirebase(), workers=1)
+
+    _drain(pool, lambda: pool.failed == 1)
+
+    assert queue.get(job["job_id"])["status"] == FAILED
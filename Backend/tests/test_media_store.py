@@ -0,0 +1,96 @@
+import asyncio
+import hashlib
+
+from media_store import LocalMediaBackend, MediaStore, content_address
+
+JPEG = b"\xff\xd8\xff\xe0" + b"leaf photo" * 100
+
+
+class FlakyBackend(LocalMediaBackend):
+    """LocalMediaBackend whose next `failures` uploads raise"""
+
+    def __init__(self, root, failures: int):
+        super().__init__(root)
+        self.failures = failures
+
+    def upload(self, name, data, content_type):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("bucket unavailable")
+        return super().upload(name, data, content_type)
+
+
+def _objects(root):
+    return sorted(p.relative_to(root).as_posix() for p in root.rglob("*") if p.is_file())
+
+
+def _put_all(store, *items):
+    async def run():
+        urls = [store.put(data, content_type, kind) for data, content_type, kind in items]
+        await store.close()
+        return urls
+
+    return asyncio.run(run())
+
+
+def test_content_address_is_sharded_sha256():
+    digest = hashlib.sha256(JPEG).hexdigest()
+    assert content_address(JPEG, "image/jpeg", "images") == f"images/{digest[:2]}/{digest}.jpg"
+    assert content_address(JPEG, "image/jpeg", "images") != content_address(JPEG + b"x", "image/jpeg", "images")
+
+
+def test_same_bytes_are_stored_once(tmp_path):
+    store = MediaStore(LocalMediaBackend(tmp_path))
+
+    first, second = _put_all(store, (JPEG, "image/jpeg", "images"), (JPEG, "image/jpeg", "images"))
+
+    assert first == second
+    assert _objects(tmp_path) == [content_address(JPEG, "image/jpeg", "images")]
+    assert store.stats() == {
+        "uploads": 1, "dedup_hits": 1, "failures": 0, "bytes_uploaded": len(JPEG), "pending": 0,
+    }
+
+    # Already known: no task, no existence check
+    _put_all(store, (JPEG, "image/jpeg", "images"))
+    assert store.stats()["dedup_hits"] == 2
+    assert store.stats()["uploads"] == 1
+
+
+def test_existing_object_is_not_rewritten(tmp_path):
+    _put_all(MediaStore(LocalMediaBackend(tmp_path)), (JPEG, "image/jpeg", "images"))
+    path = tmp_path / content_address(JPEG, "image/jpeg", "images")
+    written = path.stat().st_mtime_ns
+
+    # A fresh process has an empty known set; the backend reports the object exists
+    store = MediaStore(LocalMediaBackend(tmp_path))
+    _put_all(store, (JPEG, "image/jpeg", "images"))
+
+    assert store.stats()["uploads"] == 0
+    assert store.stats()["dedup_hits"] == 1
+    assert path.stat().st_mtime_ns == written
+
+
+def test_different_bytes_get_different_objects(tmp_path):
+    store = MediaStore(LocalMediaBackend(tmp_path))
+
+    urls = _put_all(store, (JPEG, "image/jpeg", "images"), (b"RIFF....WAVE", "audio/wav", "audio"))
+
+    assert len(set(urls)) == 2
+    assert len(_objects(tmp_path)) == 2
+    assert store.stats()["uploads"] == 2
+    assert store.stats()["dedup_hits"] == 0
+
+
+def test_failed_upload_is_retried_then_given_up(tmp_path):
+    store = MediaStore(FlakyBackend(tmp_path, failures=1), max_retries=2, base_backoff=0.0)
+    _put_all(store, (JPEG, "image/jpeg", "images"))
+    assert store.stats()["uploads"] == 1
+    assert store.stats()["failures"] == 0
+
+    store = MediaStore(FlakyBackend(tmp_path / "down", failures=100), max_retries=1, base_backoff=0.0)
+    _put_all(store, (JPEG, "image/jpeg", "images"))
+    assert store.stats()["failures"] == 1
+    # Not remembered as stored, so the next put tries again
+    _put_all(store, (JPEG, "image/jpeg", "images"))
+    assert store.stats()["failures"] == 2
+    assert store.stats()["dedup_hits"] == 0
@@ -0,0 +1,225 @@
+import asyncio
+import time
+
+import pytest
+
+from concurrency import ConcurrencyGate, GateFullError
+from scheduler import (
+    BACKGROUND,
+    CircuitBreaker,
+    CircuitOpenError,
+    GeminiScheduler,
+    UpstreamBusyError,
+)
+
+
+class UpstreamError(Exception):
+    def __init__(self, code: int):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+
+
+class FakeModel:
+    """GenerativeModel stand-in: replies, raises, or hangs until cancelled"""
+
+    def __init__(self, name: str = "gemini-test", error: Exception = None, hang: bool = False):
+        self.model_name = f"models/{name}"
+        self.error = error
+        self.hang = hang
+        self.calls = 0
+
+    async def generate_content_async(self, contents, **kwargs):
+        self.calls += 1
+        if self.hang:
+            await asyncio.Event().wait()
+        if self.error is not None:
+            raise self.error
+        return f"reply {self.calls}"
+
+
+def _scheduler(gate=None, **kwargs):
+    kwargs.setdefault("rpm", 0)
+    kwargs.setdefault("tpm", 0)
+    kwargs.setdefault("rpd", 0)
+    kwargs.setdefault("base_backoff", 0.0)
+    kwargs.setdefault("breaker", CircuitBreaker(failure_threshold=2, reset_timeout=30.0))
+    return GeminiScheduler(gate=gate or ConcurrencyGate(max_in_flight=4, max_waiting=4), **kwargs)
+
+
+def _half_open(scheduler):
+    breaker = scheduler.breaker
+    breaker.failures = breaker.failure_threshold
+    breaker.opened_at = time.monotonic() - breaker.reset_timeout
+    assert breaker.state == "half_open"
+
+
+async def _hold_slot(gate, release: asyncio.Event):
+    async with gate.slot():
+        await release.wait()
+
+
+def test_consecutive_failures_trip_the_breaker():
+    scheduler = _scheduler(max_retries=5)
+    failing = FakeModel(error=UpstreamError(503))
+
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(scheduler.generate([failing], "hello"))
+    assert failing.calls == 2
+    assert scheduler.breaker.stats()["state"] == "open"
+    assert scheduler.breaker.trips == 1
+
+    # Open: fails fast without reaching upstream
+    healthy = FakeModel()
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(scheduler.generate([healthy], "hello"))
+    assert healthy.calls == 0
+
+
+def test_retries_exhausted_below_the_threshold():
+    scheduler = _scheduler(max_retries=1, breaker=CircuitBreaker(failure_threshold=5))
+    with pytest.raises(UpstreamBusyError):
+        asyncio.run(scheduler.generate([FakeModel(error=UpstreamError(429))], "hello"))
+    assert scheduler.retries == 1
+    assert scheduler.breaker.state == "closed"
+
+
+def test_half_open_probe_success_closes():
+    scheduler = _scheduler()
+    _half_open(scheduler)
+
+    assert asyncio.run(scheduler.generate([FakeModel()], "hello")) == "reply 1"
+    assert scheduler.breaker.state == "closed"
+    assert not scheduler.breaker.probing
+
+
+def test_half_open_probe_failure_reopens():
+    scheduler = _scheduler()
+    _half_open(scheduler)
+
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(scheduler.generate([FakeModel(error=UpstreamError(500))], "hello"))
+    assert scheduler.breaker.state == "open"
+    assert not scheduler.breaker.probing
+    assert scheduler.breaker.trips == 1
+
+
+def test_only_one_probe_at_a_time():
+    scheduler = _scheduler()
+    _half_open(scheduler)
+    model = FakeModel(hang=True)
+
+    async def run():
+        probe = asyncio.create_task(scheduler.generate([model], "hello"))
+        await asyncio.sleep(0.01)
+        with pytest.raises(CircuitOpenError):
+            await scheduler.generate([FakeModel()], "hello")
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+
+    asyncio.run(run())
+    assert not scheduler.breaker.probing
+
+
+def test_probe_client_error_releases_the_probe():
+    scheduler = _scheduler()
+    _half_open(scheduler)
+
+    with pytest.raises(UpstreamError):
+        asyncio.run(scheduler.generate([FakeModel(error=UpstreamError(400))], "hello"))
+    assert not scheduler.breaker.probing
+    assert asyncio.run(scheduler.generate([FakeModel()], "hello")) == "reply 1"
+
+
+def test_probe_rejected_by_a_full_gate_releases_the_probe():
+    gate = ConcurrencyGate(max_in_flight=1, max_waiting=0)
+    scheduler = _scheduler(gate)
+    _half_open(scheduler)
+
+    async def run():
+        release = asyncio.Event()
+        holder = asyncio.create_task(_hold_slot(gate, release))
+        await asyncio.sleep(0)
+        with pytest.raises(GateFullError):
+            await scheduler.generate([FakeModel()], "hello")
+        assert not scheduler.breaker.probing
+        release.set()
+        await holder
+        return await scheduler.generate([FakeModel()], "hello")
+
+    assert asyncio.run(run()) == "reply 1"
+    assert scheduler.breaker.state == "closed"
+
+
+def test_probe_cancelled_waiting_for_a_slot_releases_the_probe():
+    gate = ConcurrencyGate(max_in_flight=1, max_waiting=4)
+    scheduler = _scheduler(gate)
+    _half_open(scheduler)
+
+    async def run():
+        release = asyncio.Event()
+        holder = asyncio.create_task(_hold_slot(gate, release))
+        await asyncio.sleep(0)
+        probe = asyncio.create_task(scheduler.generate([FakeModel()], "hello"))
+        await asyncio.sleep(0.01)
+        assert gate.stats()["waiting"] == 1
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        assert not scheduler.breaker.probing
+        release.set()
+        await holder
+        return await scheduler.generate([FakeModel()], "hello")
+
+    assert asyncio.run(run()) == "reply 1"
+
+
+def test_hung_probe_times_out_and_reopens():
+    scheduler = _scheduler(max_retries=0, call_timeout=0.05)
+    _half_open(scheduler)
+    model = FakeModel(hang=True)
+
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(scheduler.generate([model], "hello"))
+    assert model.calls == 1
+    assert scheduler.breaker.state == "open"
+    assert not scheduler.breaker.probing
+
+
+def test_exhausted_quota_falls_back_then_rejects():
+    scheduler = _scheduler(rpm=1, max_queue=0, max_wait=0.05)
+    primary, fallback = FakeModel("primary"), FakeModel("fallback")
+
+    async def run():
+        await scheduler.generate([primary, fallback], "hello")
+        await scheduler.generate([primary, fallback], "hello")
+        with pytest.raises(GateFullError):
+            await scheduler.generate([primary, fallback], "hello", priority=BACKGROUND)
+
+    asyncio.run(run())
+    assert (primary.calls, fallback.calls) == (1, 1)
+    assert scheduler.fallbacks == 1
+    assert scheduler.rejected == 1
+    assert scheduler.admitted["interactive"] == 2
+
+
+def test_queued_callers_are_admitted_by_lane():
+    scheduler = _scheduler(rpm=60, max_wait=5.0)
+    model = FakeModel()
+    order = []
+
+    async def call(priority, label):
+        await scheduler.generate([model], "hello", priority=priority)
+        order.append(label)
+
+    async def run():
+        # Drain the bucket so everyone after this queues (one request per second refill)
+        scheduler.quota("gemini-test").rpm.tokens = 0
+        background = asyncio.create_task(call(BACKGROUND, "background"))
+        await asyncio.sleep(0)
+        interactive = asyncio.create_task(call(0, "interactive"))
+        await asyncio.gather(background, interactive)
+
+    asyncio.run(run())
+    assert order == ["interactive", "background"]
+    assert scheduler.throttled == 2
@@ -0,0 +1,164 @@
+import asyncio
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from concurrency import GateFullError
+from response_cache import ResponseCache, SQLiteCacheBackend
+from scheduler import CircuitBreaker, GeminiScheduler
+from shared_state import SharedSingleFlight, SharedState
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "shared.sqlite3")
+
+
+def _hold_write_lock(path, seconds, locked: threading.Event):
+    """Another worker inside a write transaction"""
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("BEGIN IMMEDIATE")
+    locked.set()
+    time.sleep(seconds)
+    conn.execute("COMMIT")
+    conn.close()
+
+
+def test_workers_draw_on_one_bucket(path):
+    first, second = SharedState(path), SharedState(path)
+    a = first.bucket("gemini-test", "rpm", 2, 60.0)
+    b = second.bucket("gemini-test", "rpm", 2, 60.0)
+
+    assert a.delay(1, 0) == 0.0
+    a.take(1)
+    b.take(1)
+    assert a.delay(1, 0) > 0
+    assert b.tokens < 1
+
+
+def test_peek_does_not_write(path):
+    state = SharedState(path)
+    assert state.peek_bucket("fresh", 5, 1.0) == 5
+    assert state.bucket_level("fresh", 5, 1.0) == 5
+    assert state._conn.execute("SELECT COUNT(*) FROM buckets").fetchone()[0] == 0
+
+
+def test_peek_does_not_wait_for_a_writer(path):
+    state = SharedState(path)
+    state.bucket_level("rpm", 5, 0.0, -1)
+    locked = threading.Event()
+    holder = threading.Thread(target=_hold_write_lock, args=(path, 0.5, locked))
+    holder.start()
+    locked.wait()
+
+    started = time.perf_counter()
+    assert state.peek_bucket("rpm", 5, 0.0) == 4
+    assert time.perf_counter() - started < 0.2
+    holder.join()
+
+
+def test_admission_waits_for_the_lock_off_the_event_loop(path):
+    class Model:
+        model_name = "models/gemini-test"
+
+        async def generate_content_async(self, contents, **kwargs):
+            return "ok"
+
+    scheduler = GeminiScheduler(rpm=10, tpm=0, rpd=0, breaker=CircuitBreaker(), shared=SharedState(path))
+
+    async def run():
+        locked = threading.Event()
+        holder = threading.Thread(target=_hold_write_lock, args=(path, 0.3, locked))
+        holder.start()
+        await asyncio.to_thread(locked.wait)
+        ticks = 0
+
+        async def tick():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        ticker = asyncio.create_task(tick())
+        reply = await scheduler.generate([Model()], "hello")
+        ticker.cancel()
+        holder.join()
+        return reply, ticks
+
+    reply, ticks = asyncio.run(run())
+    assert reply == "ok"
+    # The loop kept running while the bucket write waited on the other worker
+    assert ticks >= 10
+
+
+def _flight(path, tmp_path, **kwargs):
+    cache = ResponseCache(SQLiteCacheBackend(str(tmp_path / "cache.sqlite3")))
+    return SharedSingleFlight(SharedState(path), cache, **kwargs), cache
+
+
+def test_second_worker_waits_for_the_first_workers_answer(path, tmp_path):
+    leader, leader_cache = _flight(path, tmp_path)
+    follower, _ = _flight(path, tmp_path)
+    calls = []
+
+    async def run():
+        async def generate():
+            calls.append("leader")
+            await asyncio.sleep(0.2)
+            leader_cache.set("k", {"answer": "neem oil"})
+            return {"answer": "neem oil"}
+
+        async def never():
+            calls.append("follower")
+
+        first = asyncio.create_task(leader.do("k", generate))
+        await asyncio.sleep(0.05)
+        return await asyncio.gather(first, follower.do("k", never))
+
+    assert asyncio.run(run()) == [{"answer": "neem oil"}] * 2
+    assert calls == ["leader"]
+    assert follower.stats()["remote_hits"] == 1
+
+
+def test_follower_takes_over_a_lease_released_without_an_answer(path, tmp_path):
+    leader, _ = _flight(path, tmp_path)
+    follower, _ = _flight(path, tmp_path)
+
+    async def run():
+        async def fail():
+            await asyncio.sleep(0.1)
+            raise RuntimeError("upstream error")
+
+        async def answer():
+            return {"answer": "from the follower"}
+
+        first = asyncio.create_task(leader.do("k", fail))
+        await asyncio.sleep(0.02)
+        second = await follower.do("k", answer)
+        with pytest.raises(RuntimeError):
+            await first
+        return second
+
+    assert asyncio.run(run()) == {"answer": "from the follower"}
+
+
+def test_follower_wait_is_bounded(path, tmp_path):
+    leader, _ = _flight(path, tmp_path)
+    follower, _ = _flight(path, tmp_path, max_wait=0.3, max_poll_interval=0.1)
+
+    async def run():
+        hang = asyncio.Event()
+        first = asyncio.create_task(leader.do("k", hang.wait))
+        await asyncio.sleep(0.02)
+        started = time.monotonic()
+        with pytest.raises(GateFullError):
+            await follower.do("k", hang.wait)
+        waited = time.monotonic() - started
+        hang.set()
+        await first
+        return waited
+
+    assert asyncio.run(run()) < 1.0
+    assert follower.stats()["remote_timeouts"] == 1
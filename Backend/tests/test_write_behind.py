@@ -0,0 +1,123 @@
+import asyncio
+import json
+from datetime import datetime
+
+from firebase_admin import firestore
+
+from fakes import FakeFirestore
+from write_behind import WriteBehindQueue
+
+
+class FlakyFirestore(FakeFirestore):
+    """FakeFirestore whose next `failures` batch commits raise"""
+
+    def __init__(self, failures: int):
+        super().__init__()
+        self.failures = failures
+
+    def batch(self):
+        batch = super().batch()
+        commit = batch.commit
+
+        def flaky_commit():
+            if self.failures:
+                self.failures -= 1
+                raise RuntimeError("Firestore unavailable")
+            commit()
+
+        batch.commit = flaky_commit
+        return batch
+
+
+def _queue(db, tmp_path, **kwargs):
+    kwargs.setdefault("base_backoff", 0.0)
+    return WriteBehindQueue(db, spill_path=str(tmp_path / "spill.jsonl"), **kwargs)
+
+
+def test_flush_commits_in_batches_of_max_batch(tmp_path):
+    db = FakeFirestore()
+    queue = _queue(db, tmp_path, max_batch=2)
+    committed = []
+    queue.on_commit = committed.append
+    for i in range(5):
+        queue.enqueue("voice_queries", f"d{i}", {"n": i, "timestamp": firestore.SERVER_TIMESTAMP})
+
+    asyncio.run(queue.flush())
+
+    assert [len(records) for records in committed] == [2, 2, 1]
+    assert db.stats()["batches"] == 3
+    assert db.stats()["documents"] == 5
+    assert isinstance(db.collection("voice_queries").document("d4").get().to_dict()["timestamp"], datetime)
+
+
+def test_full_batch_wakes_the_flusher_before_the_interval(tmp_path):
+    db = FakeFirestore()
+    queue = _queue(db, tmp_path, max_batch=3, flush_interval=60.0)
+
+    async def run():
+        await queue.start()
+        for i in range(3):
+            queue.enqueue("voice_queries", f"d{i}", {"n": i})
+        for _ in range(100):
+            if queue.committed == 3:
+                break
+            await asyncio.sleep(0.01)
+        committed = queue.committed
+        await queue.close()
+        return committed
+
+    assert asyncio.run(run()) == 3
+    assert db.stats()["batches"] == 1
+
+
+def test_transient_failure_is_retried(tmp_path):
+    db = FlakyFirestore(failures=2)
+    queue = _queue(db, tmp_path, max_retries=3)
+    queue.enqueue("voice_queries", "d0", {"n": 0})
+
+    asyncio.run(queue.flush())
+
+    assert queue.stats()["retries"] == 2
+    assert queue.stats()["spilled"] == 0
+    assert db.stats()["documents"] == 1
+
+
+def test_failed_commit_spills_and_replays_on_next_start(tmp_path):
+    down = FlakyFirestore(failures=100)
+    queue = _queue(down, tmp_path, max_retries=1)
+    for i in range(3):
+        queue.enqueue("voice_queries", f"d{i}", {"n": i, "timestamp": firestore.SERVER_TIMESTAMP})
+
+    asyncio.run(queue.flush())
+
+    spill = tmp_path / "spill.jsonl"
+    rows = [json.loads(line) for line in spill.read_text(encoding="utf-8").splitlines()]
+    assert [row["doc_id"] for row in rows] == ["d0", "d1", "d2"]
+    assert queue.stats()["spilled"] == 3
+    assert down.stats()["documents"] == 0
+
+    # Next process: Firestore is back, the spill is replayed once and removed
+    db = FakeFirestore()
+    replay = _queue(db, tmp_path)
+
+    async def run():
+        await replay.start()
+        await replay.close()
+
+    asyncio.run(run())
+
+    assert not spill.exists()
+    assert list(tmp_path.iterdir()) == []
+    assert db.stats()["documents"] == 3
+    # SERVER_TIMESTAMP was spilled as client time and comes back as a datetime
+    assert isinstance(db.collection("voice_queries").document("d0").get().to_dict()["timestamp"], datetime)
+
+
+def test_enqueue_past_max_pending_spills_instead_of_growing(tmp_path):
+    queue = _queue(FakeFirestore(), tmp_path, max_pending=2)
+    for i in range(5):
+        queue.enqueue("voice_queries", f"d{i}", {"n": i})
+
+    assert queue.stats()["pending"] == 2
+    assert queue.stats()["spilled"] == 3
+    assert len((tmp_path / "spill.jsonl").read_text(encoding="utf-8").splitlines()) == 3
@@ -0,0 +1,227 @@
+"""
+write_behind.py
+Asynchronous write-behind queue for Firestore records
+Request handlers enqueue and return; a background task commits batched writes
+"""
+
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from firebase_admin import firestore
+
+logger = logging.getLogger(__name__)
+
+# Firestore rejects batches larger than 500 writes
+FIRESTORE_BATCH_LIMIT = 500
+
+Record = Tuple[str, str, Dict[str, Any]]
+
+
+class WriteBehindQueue:
+    """
+    Bounded in-memory queue flushed as Firestore batched writes
+    Flushes when `max_batch` records are pending or every `flush_interval` seconds.
+    Failed commits are retried with jittered exponential backoff and finally
+    spilled to a local JSONL file, which is replayed on the next start.
+
+    `db` only needs `batch()` and `collection(name).document(id)`, so the
+    Firestore emulator (FIRESTORE_EMULATOR_HOST) or an in-memory stand-in work.
+    """
+
+    def __init__(
+        self,
+        db,
+        max_batch: int = 100,
+        flush_interval: float = 1.0,
+        max_pending: int = 5000,
+        max_retries: int = 5,
+        base_backoff: float = 0.5,
+        spill_path: str = "firestore_spill.jsonl"
+    ):
+        self.db = db
+        self.max_batch = min(max_batch, FIRESTORE_BATCH_LIMIT)
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.spill_path = spill_path
+
+        self._pending: Deque[Record] = deque()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        # Called with each committed batch, e.g. to invalidate read caches
+        self.on_commit: Optional[Callable[[List[Record]], None]] = None
+
+        self.enqueued = 0
+        self.committed = 0
+        self.batches = 0
+        self.retries = 0
+        self.spilled = 0
+
+    @classmethod
+    def from_env(cls, db) -> "WriteBehindQueue":
+        return cls(
+            db,
+            max_batch=int(os.getenv("FIRESTORE_BATCH_SIZE", "100")),
+            flush_interval=float(os.getenv("FIRESTORE_FLUSH_INTERVAL", "1.0")),
+            max_pending=int(os.getenv("FIRESTORE_MAX_PENDING", "5000")),
+            max_retries=int(os.getenv("FIRESTORE_MAX_RETRIES", "5")),
+            spill_path=os.getenv("FIRESTORE_SPILL_PATH", "firestore_spill.jsonl"),
+        )
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        """Start the flusher and replay records spilled by an earlier run"""
+        if self.running:
+            return
+        self._closing = False
+        self._wakeup = asyncio.Event()
+        for record in self._take_spilled():
+            self.enqueue(*record)
+        self._task = asyncio.create_task(self._run())
+
+    def enqueue(self, collection: str, doc_id: str, data: Dict[str, Any]):
+        """Non-blocking; spills straight to disk once the memory bound is hit"""
+        self.enqueued += 1
+        if len(self._pending) >= self.max_pending:
+            self._spill([(collection, doc_id, data)])
+            return
+        self._pending.append((collection, doc_id, data))
+        if self._wakeup is not None and len(self._pending) >= self.max_batch:
+            self._wakeup.set()
+
+    async def flush(self):
+        """Commit everything pending now (used on shutdown)"""
+        while self._pending:
+            if not await self._commit_with_retry(self._take_batch()):
+                # Firestore is down; do not hold shutdown hostage batch by batch
+                self._spill(list(self._pending))
+                self._pending.clear()
+
+    async def close(self):
+        """Stop the flusher, then flush what is left; unrecoverable leftovers are spilled"""
+        self._closing = True
+        if self._task is not None:
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            while self._pending and not self._closing:
+                await self._commit_with_retry(self._take_batch())
+
+    def _take_batch(self) -> List[Record]:
+        batch = []
+        while self._pending and len(batch) < self.max_batch:
+            batch.append(self._pending.popleft())
+        return batch
+
+    async def _commit_with_retry(self, records: List[Record]) -> bool:
+        for attempt in range(self.max_retries + 1):
+            try:
+                await asyncio.to_thread(self._commit, records)
+                self.committed += len(records)
+                self.batches += 1
+                if self.on_commit is not None:
+                    self.on_commit(records)
+                return True
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error(f"Firestore batch failed, spilling {len(records)} records: {str(e)}")
+                    self._spill(records)
+                    return False
+                self.retries += 1
+                delay = min(self.base_backoff * (2 ** attempt), 30.0) * random.uniform(0.5, 1.5)
+                logger.warning(f"Firestore batch failed ({str(e)}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    def _commit(self, records: List[Record]):
+        batch = self.db.batch()
+        for collection, doc_id, data in records:
+            batch.set(self.db.collection(collection).document(doc_id), data)
+        batch.commit()
+
+    def _spill(self, records: List[Record]):
+        """Append records to the spill file; server timestamps become client time"""
+        now = datetime.now(timezone.utc).isoformat()
+        try:
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for collection, doc_id, data in records:
+                    f.write(json.dumps({
+                        "collection": collection,
+                        "doc_id": doc_id,
+                        "data": _encode(data, now),
+                    }, ensure_ascii=False) + "\n")
+            self.spilled += len(records)
+        except OSError as e:
+            logger.error(f"Could not spill {len(records)} Firestore records: {str(e)}")
+
+    def _take_spilled(self) -> List[Record]:
+        if not os.path.exists(self.spill_path):
+            return []
+        # Every worker tries this at startup; the rename lets exactly one of them replay
+        replay_path = f"{self.spill_path}.{int(time.time())}.{os.getpid()}.replay"
+        try:
+            os.replace(self.spill_path, replay_path)
+        except FileNotFoundError:
+            return []
+        records = []
+        with open(replay_path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    row = json.loads(line)
+                    records.append((row["collection"], row["doc_id"], _decode(row["data"])))
+        os.remove(replay_path)
+        logger.info(f"Replaying {len(records)} spilled Firestore records")
+        return records
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._pending),
+            "enqueued": self.enqueued,
+            "committed": self.committed,
+            "batches": self.batches,
+            "retries": self.retries,
+            "spilled": self.spilled,
+            "running": self.running,
+        }
+
+
+def _encode(value: Any, now: str) -> Any:
+    if value is firestore.SERVER_TIMESTAMP:
+        return {"__timestamp__": now}
+    if isinstance(value, datetime):
+        return {"__timestamp__": value.isoformat()}
+    if isinstance(value, dict):
+        return {k: _encode(v, now) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(v, now) for v in value]
+    return value
+
+
+def _decode(value: Any) -> Any:
+    if isinstance(value, dict):
+        if set(value) == {"__timestamp__"}:
+            return datetime.fromisoformat(value["__timestamp__"])
+        return {k: _decode(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    return value